@@ -1,35 +1,130 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g 
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (Blueprint, Flask, Response, render_template, request, flash,
+                   redirect, session, g, abort, jsonify, current_app,
+                   stream_with_context)
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
 
+from archive import delete_archived, delete_archived_by, find_archived, init_archive
+from cache import cache, init_cache, invalidate_on
+from compression import init_compression
+from config import PROFILES
+from export import EXPORT_MIMETYPES, init_export, parse_kinds, stream_export
+from followgraph import follow_graph, init_follow_graph
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileform
-from models import db, connect_db, User, Message, Likes
+from importer import import_messages, init_importer
+from models import db, connect_db, User, Message, Likes, Follows
+from outbox import emit, init_outbox
+import projections  # registers the outbox projections
+from metrics import init_metrics
+from profiling import init_profiler
+from ratelimit import init_rate_limits
+from readmodels import (author_rows, followed_among, followed_ids, follow_page,
+                        message_rows, user_stats)
+from search import init_search, search
+from sharding import init_sharding
+from singleflight import SingleFlight
+from slowlog import init_slow_query_log
+from snowflake import generator_for, message_ids
+from templating import init_templates
+from trending import Trending, trending
+from timelines import (HighWaterMarks, RecentMessages, high_water_marks,
+                       recent_messages)
+from traffic import init_traffic
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint('warbler', __name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+invalidate_on(User, 'users', key='id')
+invalidate_on(Message, 'messages')
+invalidate_on(Follows, 'follows',
+              collections=(User.following, User.followers))
+invalidate_on(Likes, 'likes', key='user_id', collections=(User.likes,))
 
-connect_db(app)
+
+def create_app(config=None):
+    """Build a Warbler app.
+
+    `config` is a profile name from config.PROFILES ('dev', 'test',
+    'prod'), a config object, or None to use the WARBLER_CONFIG
+    environment variable (default 'dev'). Nothing connects to the
+    database until the first query.
+    """
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'dev')
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    # this app's own state (see extensions.py)
+    worker_id = app.config['WORKER_ID']
+    app.extensions['message_ids'] = generator_for(
+        None if worker_id is None else int(worker_id))
+    app.extensions['trending'] = Trending()
+    app.extensions['recent_messages'] = RecentMessages()
+    app.extensions['high_water_marks'] = HighWaterMarks()
+    app.extensions['profile_flights'] = SingleFlight()
+
+    # registered first so it runs after every other after_request hook
+    init_compression(app)
+    init_traffic(app)
+    # before anything that would query the database for a refused request
+    init_rate_limits(app, CURR_USER_KEY)
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    init_profiler(app)
+    init_metrics(app, db)
+    init_slow_query_log(app, db)
+    init_cache(app)
+    init_sharding(app, db)
+    init_outbox(app)
+    init_search(app)
+    init_follow_graph(app)
+    init_export(app)
+    init_importer(app)
+    init_archive(app)
+    connect_db(app)
+    app.register_blueprint(bp)
+    init_templates(app)
+
+    return app
+
+
+def __getattr__(name):
+    """Build the default `app` the first time someone asks for it.
+
+    Lets `flask run`, WSGI servers and tests use `app:app` while keeping
+    the import itself free of side effects.
+    """
+
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_first_request
+def restore_trending():
+    """Start the trending trackers from the last saved snapshot."""
+
+    trending.restore()
+
+
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -53,7 +148,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -78,6 +173,7 @@ def signup():
             db.session.commit()
 
         except IntegrityError:
+            db.session.rollback()
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
@@ -89,7 +185,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -109,7 +205,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -127,7 +223,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -141,52 +237,104 @@ def list_users():
     else:
         users = User.query.filter(User.username.like(f"%{search}%")).all()
 
-    return render_template('users/index.html', users=users)
+    followed = followed_among(g.user.id, [user.id for user in users]) if g.user else set()
+    return render_template('users/index.html', users=users, followed=followed)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Concurrent requests for the same profile share one set of queries
+    for its messages, likes and counts; each loads its own user.
+    """
 
     user = User.query.get_or_404(user_id)
-    likes = [like.message_id for like in Likes.query.filter_by(user_id = user.id)]
+    likes, messages, stats = current_app.extensions['profile_flights'].do(
+        user_id, lambda: load_profile(user_id),
+        timeout=current_app.config['SINGLE_FLIGHT_TIMEOUT'])
+
+    return render_template('users/show.html', user=user, messages=messages, likes = likes,
+                           stats=stats, **relationship(user_id))
+
+
+def load_profile(user_id):
+    """A user's liked message ids, latest messages and counts.
+
+    Plain rows rather than model instances, so requests can share them.
+    """
+
+    likes = liked_message_ids(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
+    messages = (db.session
+                .query(Message.id, Message.text, Message.timestamp)
                 .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
+                .order_by(Message.id.desc())
                 .limit(100)
                 .all())
-    return render_template('users/show.html', user=user, messages=messages, likes = likes)
+    return likes, messages, user_stats(user_id)
 
 
-@app.route('/users/<int:user_id>/following')
+def liked_message_ids(user_id):
+    """Ids of the messages `user_id` has liked (cached)."""
+
+    return cache.get_or_set(
+        'likes', user_id,
+        lambda: [like.message_id for like in Likes.query.filter_by(user_id = user_id)])
+
+
+def relationship(user_id):
+    """How the logged-in user relates to `user_id`, for the profile sidebar.
+
+    Answered from the in-memory follow graph (see followgraph.py).
+    """
+
+    if not g.user or g.user.id == user_id:
+        return {}
+
+    known = follow_graph.followers_you_know(g.user.id, user_id)
+    return dict(follows_you=follow_graph.follows(user_id, g.user.id),
+                known_followers=author_rows(known[:3]),
+                known_follower_count=len(known))
+
+
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, a page at a time."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following, next_after = follow_page(
+        user_id, after=request.args.get('after', 0, type=int))
+    followed = followed_among(g.user.id, [card.id for card in following])
+    return render_template('users/following.html', user=user, following=following,
+                           followed=followed, next_after=next_after,
+                           stats=user_stats(user_id), **relationship(user_id))
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, a page at a time."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers, next_after = follow_page(
+        user_id, followers=True, after=request.args.get('after', 0, type=int))
+    followed = followed_among(g.user.id, [card.id for card in followers])
+    return render_template('users/followers.html', user=user, followers=followers,
+                           followed=followed, next_after=next_after,
+                           stats=user_stats(user_id), **relationship(user_id))
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -195,13 +343,16 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    if not g.user.is_following(followed_user):
+        db.session.add(Follows(user_following_id=g.user.id,
+                               user_being_followed_id=followed_user.id))
+        emit('follow.created', g.user.id, followed_id=followed_user.id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -209,14 +360,17 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    follow = Follows.query.filter(Follows.user_following_id == g.user.id,
+                                  Follows.user_being_followed_id == follow_id).first()
+    if follow:
+        db.session.delete(follow)
+        emit('follow.deleted', g.user.id, followed_id=follow_id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -243,7 +397,34 @@ def profile():
     return render_template('/users/edit.html', form = form, user_id = g.user.id)
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/export.<format>')
+def export_data(format):
+    """Download the current user's messages, likes and follows.
+
+    Streamed as it's read, so big accounts start downloading at once;
+    'include' narrows it to some of messages, likes and following.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    if format not in EXPORT_MIMETYPES:
+        abort(404)
+    try:
+        kinds = parse_kinds(request.args.get('include'))
+    except ValueError:
+        abort(400)
+
+    pieces = stream_export(g.user.id, format, kinds,
+                           current_app.config['EXPORT_CHUNK_SIZE'])
+    filename = f'warbler-{g.user.username}.{format}'
+    return Response(stream_with_context(pieces),
+                    mimetype=EXPORT_MIMETYPES[format],
+                    headers={'Content-Disposition':
+                             f'attachment; filename="{filename}"'})
+
+
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -253,32 +434,54 @@ def delete_user():
 
     do_logout()
 
+    user_id = g.user.id
+    archived = delete_archived_by(user_id)
+    shards = current_app.extensions.get('shards')
+    if shards:
+        shards.delete_user_references(db.session, user_id, archived)
+    else:
+        # partitioned or archived messages have no foreign key to cascade this
+        messages = select([Message.id]).where(Message.user_id == user_id)
+        Likes.query.filter(Likes.message_id.in_(messages)).delete(
+            synchronize_session=False)
+        if archived:
+            Likes.query.filter(Likes.message_id.in_(archived)).delete(
+                synchronize_session=False)
     db.session.delete(g.user)
+    emit('user.deleted', user_id)
     db.session.commit()
 
     return redirect("/signup")
 
-@app.route('/users/add_like/<int:msg_id>', methods=['POST'])
+@bp.route('/users/add_like/<int:msg_id>', methods=['POST'])
 def like_user_post(msg_id):
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
+    msg = Message.query.get(msg_id)
+    author_id = msg.user_id if msg else None
     like = Likes.query.filter_by(user_id = g.user.id, message_id = msg_id).first()
     if like:
         db.session.delete(like)
+        emit('like.deleted', g.user.id, message_id=msg_id, author_id=author_id)
         db.session.commit()
         return redirect(request.referrer)
 
+    if msg is None:
+        # archived or gone; likes have no foreign key to refuse it
+        abort(404)
     new_like = Likes(
         user_id = g.user.id,
         message_id = msg_id
     )
     db.session.add(new_like)
+    emit('like.created', g.user.id, message_id=msg_id, author_id=author_id)
     db.session.commit()
+
     return redirect(request.referrer)
 
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
 def users_like(user_id):
 
     if not g.user:
@@ -286,15 +489,14 @@ def users_like(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    likes = [like.message_id for like in Likes.query.filter_by(user_id = user_id)]
-    messages = (Message
-                .query
-                .filter(Message.id.in_(likes))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    likes = liked_message_ids(user_id)
+    newest = sorted(likes, reverse=True)[:100]
+    found = {msg.id: msg for msg in Message.query.filter(Message.id.in_(newest))}
+    messages = [found.get(id) or find_archived(id) for id in newest]
+    messages = [msg for msg in messages if msg is not None]
 
-    return render_template('users/likes.html', user=user, messages = messages, likes = likes)
+    return render_template('users/likes.html', user=user, messages = messages, likes = likes,
+                           stats=user_stats(user_id), **relationship(user_id))
 
     
 
@@ -302,7 +504,7 @@ def users_like(user_id):
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -316,8 +518,10 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(id=message_ids.next_id(), text=form.text.data,
+                      user_id=g.user.id)
+        db.session.add(msg)
+        emit('message.created', g.user.id, message_id=msg.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -325,15 +529,53 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/import', methods=["POST"])
+def messages_import():
+    """Import JSON lines of messages, with their original timestamps.
+
+    The body is read as it arrives and saved in batches; answers with a
+    JSON report of what was imported and which lines weren't.
+    """
+
+    if not g.user:
+        abort(401)
+
+    report = import_messages(g.user.id, request.stream,
+                             current_app.config['IMPORT_BATCH_SIZE'],
+                             current_app.config['IMPORT_MAX_ERRORS'])
+    return jsonify(report)
+
+
+@bp.route('/search')
+def messages_search():
+    """Messages matching the 'q' param, best first.
+
+    Pages continue from the 'after' cursor of the previous one.
+    """
+
+    query = request.args.get('q', '').strip()
+    messages, next_cursor = [], None
+    if query:
+        messages, next_cursor = search(query, request.args.get('after'))
+
+    likes = liked_message_ids(g.user.id) if g.user else []
+
+    return render_template('messages/search.html', query=query,
+                           messages=messages, likes=likes,
+                           next_cursor=next_cursor)
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message, looking in the archive for old ones."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get(message_id) or find_archived(message_id)
+    if msg is None:
+        abort(404)
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -341,12 +583,24 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    if g.user.id != msg.user.id:
+    msg = Message.query.get(message_id) or find_archived(message_id)
+    if msg is None:
+        abort(404)
+    if g.user.id != msg.user_id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
+    shards = current_app.extensions.get('shards')
+    if shards:
+        shards.delete_message_references(db.session, msg.id)
+    else:
+        # partitioned or archived messages have no foreign key to cascade this
+        Likes.query.filter_by(message_id=msg.id).delete()
+    if isinstance(msg, Message):
+        db.session.delete(msg)
+    else:
+        delete_archived(msg.id)
+    emit('message.deleted', g.user.id, message_id=msg.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
@@ -356,7 +610,7 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
@@ -365,22 +619,75 @@ def homepage():
     """
 
     if g.user:
-        followed_users = [user.id for user in g.user.following]
+        followed_users = followed_ids(g.user.id)
         followed_users.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followed_users))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes = [like.message_id for like in Likes.query.filter_by(user_id = g.user.id)]
-
-        return render_template('home.html', messages=messages, likes = likes)
+        messages = recent_messages.timeline(followed_users, limit=100)
+        likes = liked_message_ids(g.user.id)
+        stats = user_stats(g.user.id)
+        trending_messages, hot_authors = trending.panel()
+
+        live_url = current_app.config['LIVE_STREAM_URL']
+        live_token = None
+        if live_url:
+            from live import stream_token
+            live_token = stream_token(current_app.config['SECRET_KEY'], g.user.id)
+
+        return render_template('home.html', messages=messages, likes = likes,
+                               stats=stats,
+                               trending_messages=trending_messages,
+                               hot_authors=hot_authors,
+                               live_url=live_url, live_token=live_token)
 
     else:
         return render_template('home-anon.html')
 
 
+@bp.route('/timeline')
+def timeline_since():
+    """New home-timeline messages since message id `since`, as JSON.
+
+    Answers 304 with no body when nothing is newer; while the user's
+    high-water mark is fresh that check is made without any query.
+    """
+
+    if not g.user:
+        abort(401)
+
+    since = request.args.get('since', 0, type=int)
+
+    mark = high_water_marks.get(g.user.id)
+    if mark is not None and mark <= since:
+        return '', 304
+
+    followed_users = followed_ids(g.user.id)
+    followed_users.append(g.user.id)
+    ids = [id for (id,) in (db.session
+                            .query(Message.id)
+                            .filter(Message.user_id.in_(followed_users),
+                                    Message.id > since)
+                            .order_by(Message.id.desc())
+                            .limit(100))]
+    # sharded, each shard returns its own newest 100
+    ids = sorted(ids, reverse=True)[:100]
+    messages = message_rows(ids)
+
+    if ids:
+        newest = ids[0]
+    else:
+        # the client's `since` may be made up; mark what really exists
+        newest = max([id or 0 for (id,) in (db.session
+                                            .query(func.max(Message.id))
+                                            .filter(Message.user_id.in_(followed_users)))]
+                     or [0])
+    high_water_marks.set(g.user.id, followed_users, newest)
+
+    if not messages:
+        return '', 304
+
+    from live import message_event
+    return jsonify(messages=[message_event(msg) for msg in messages])
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -388,7 +695,7 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
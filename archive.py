@@ -0,0 +1,431 @@
+"""Monthly partitions for messages, and a compact archive for old ones.
+
+Nearly every read (timelines, profiles) wants recent messages, so on
+Postgres `flask partition-messages` turns `messages` into a table
+partitioned by RANGE (id). Message ids are snowflakes (see
+snowflake.py), so a range of ids is a range of time:
+
+- messages_history: everything before the oldest month kept hot
+- messages_pYYYYMM: one partition per month, created
+  MESSAGES_PARTITIONS_AHEAD months in advance
+- messages_default: anything no other partition takes
+
+Each partition has its own small primary-key index, and queries for
+recent ids only touch recent partitions. The command takes a lock on
+messages while it copies the rows over, so run it when things are
+quiet; an already partitioned table only gets its upcoming months.
+
+`flask archive-messages`, run monthly, moves messages older than
+MESSAGES_HOT_MONTHS into `message_archive`, ARCHIVE_CHUNK_SIZE at a
+time: each user's messages among them are packed as zlib-compressed
+JSON into a chunk of their own, under its first and last id and the
+user's id, and `message_archive_ids` notes which chunk each message
+went to. A whole old partition is copied and then detached and
+dropped, so nothing is left to vacuum; rows elsewhere (the default
+partition, or a table that isn't partitioned, e.g. SQLite) are moved
+a chunk per transaction. find_archived() reads a message back with a
+primary key lookup in message_archive_ids and a decompress, so
+/messages/<id> still finds it; archived_by() reads a user's back for
+exports, delete_archived() repacks the chunk holding a deleted
+message, and delete_archived_by() drops a deleted user's chunks,
+reading only theirs.
+
+Likes have no foreign key to messages (see models.py): Postgres won't
+detach a partition one points into, and moving a message to the
+archive would cascade to its likes. Partitioning and archiving drop
+the one an older schema made. So nothing relies on it cascading:
+deleting a message or a user deletes the likes of their messages
+itself. Likes of archived messages stay, and read their messages back
+through find_archived(); only live messages can be liked. Archived
+messages no longer count towards a user's message total.
+"""
+
+import bisect
+import json
+import re
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+
+import click
+from flask import current_app
+from sqlalchemy import column, select, table, text
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from models import (db, ArchivedMessageIds, ArchivedMessages, Message,
+                    MESSAGE_SEARCH_INDEX, User)
+from snowflake import first_id_at
+
+ArchivedMessage = namedtuple('ArchivedMessage', 'id text timestamp user_id user')
+
+COLUMNS = ('id', 'user_id', 'timestamp', 'text')
+
+_UPPER_BOUND = re.compile(r'TO \((\d+)\)')
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def hot_cutoff(hot_months, now=None):
+    """The start of the oldest month kept in `messages`."""
+
+    return add_months(month_start(now or datetime.utcnow()), -hot_months)
+
+
+# -- packing ---------------------------------------------------------------
+
+def pack(rows):
+    """(id, user_id, timestamp, text) rows, in id order, as a chunk."""
+
+    return zlib.compress(json.dumps(
+        [[id, user_id, timestamp.isoformat(), text]
+         for id, user_id, timestamp, text in rows],
+        separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(data):
+    """The rows packed into `data`, timestamps as datetimes."""
+
+    rows = json.loads(zlib.decompress(data).decode('utf-8'))
+    for row in rows:
+        row[2] = _parse_timestamp(row[2])
+    return rows
+
+
+def _parse_timestamp(value):
+    format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+    return datetime.strptime(value, format)
+
+
+def save_chunks(conn, rows):
+    """Pack (id, user_id, timestamp, text) `rows` into a chunk per user."""
+
+    rows = sorted(rows, key=itemgetter(1, 0))
+    chunks = [(user_id, list(chunk))
+              for user_id, chunk in groupby(rows, key=itemgetter(1))]
+    conn.execute(ArchivedMessages.__table__.insert(), [
+        dict(first_id=chunk[0][0], last_id=chunk[-1][0], user_id=user_id,
+             count=len(chunk), data=pack(chunk))
+        for user_id, chunk in chunks])
+    conn.execute(ArchivedMessageIds.__table__.insert(), [
+        dict(message_id=row[0], chunk_id=chunk[0][0])
+        for user_id, chunk in chunks for row in chunk])
+
+
+# -- reading ---------------------------------------------------------------
+
+def _chunk_holding(message_id):
+    # chunks overlap (every user has their own), so look the id up
+    return (db.session
+            .query(ArchivedMessages)
+            .join(ArchivedMessageIds,
+                  ArchivedMessageIds.chunk_id == ArchivedMessages.first_id)
+            .filter(ArchivedMessageIds.message_id == message_id)
+            .first())
+
+
+def _connection(user_id):
+    """The session's connection to where `user_id`'s chunks are."""
+
+    shards = current_app.extensions.get('shards')
+    if shards:
+        return db.session.connection(shard_id=shards.shard_for(user_id))
+    return db.session.connection()
+
+
+def _find_row(rows, message_id):
+    i = bisect.bisect_left([row[0] for row in rows], message_id)
+    if i < len(rows) and rows[i][0] == message_id:
+        return rows[i]
+    return None
+
+
+def find_archived(message_id):
+    """The archived message `message_id` as an ArchivedMessage, or None."""
+
+    chunk = _chunk_holding(message_id)
+    row = chunk and _find_row(unpack(chunk.data), message_id)
+    if row is None:
+        return None
+    id, user_id, timestamp, text = row
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    return ArchivedMessage(id, text, timestamp, user_id, user)
+
+
+def _chunk_pages(user_id, page_size):
+    """Lists of `page_size` of `user_id`'s chunks, by first id."""
+
+    after = None
+    while True:
+        query = (db.session
+                 .query(ArchivedMessages)
+                 .filter(ArchivedMessages.user_id == user_id))
+        if after is not None:
+            query = query.filter(ArchivedMessages.first_id > after)
+        chunks = query.order_by(ArchivedMessages.first_id).limit(page_size).all()
+        if not chunks:
+            return
+        after = chunks[-1].first_id
+        yield chunks
+
+
+def archived_by(user_id, page_size=100):
+    """`user_id`'s archived messages as lists of (id, timestamp, text).
+
+    A list per page of their chunks, each list in id order.
+    """
+
+    for chunks in _chunk_pages(user_id, page_size):
+        yield sorted((id, timestamp, text)
+                     for chunk in chunks
+                     for id, owner, timestamp, text in unpack(chunk.data))
+
+
+def delete_archived(message_id):
+    """Remove `message_id` from the archive; True if it was there.
+
+    Changes the session's chunks, so commit afterwards.
+    """
+
+    chunk = _chunk_holding(message_id)
+    if chunk is None:
+        return False
+    kept = [row for row in unpack(chunk.data) if row[0] != message_id]
+    ids = ArchivedMessageIds.__table__
+    _connection(chunk.user_id).execute(
+        ids.delete().where(ids.c.message_id == message_id))
+    if kept:
+        chunk.data = pack(kept)
+        chunk.count = len(kept)
+    else:
+        db.session.delete(chunk)
+    return True
+
+
+def delete_archived_by(user_id, page_size=100):
+    """Remove `user_id`'s messages from the archive; returns their ids.
+
+    Reads only their chunks, a page at a time. Deletes in the session's
+    transaction, so commit afterwards.
+    """
+
+    conn = _connection(user_id)
+    ids = ArchivedMessageIds.__table__
+    deleted = []
+    for chunks in _chunk_pages(user_id, page_size):
+        deleted.extend(row[0] for chunk in chunks for row in unpack(chunk.data))
+        conn.execute(ids.delete().where(
+            ids.c.chunk_id.in_([chunk.first_id for chunk in chunks])))
+    chunks = ArchivedMessages.__table__
+    conn.execute(chunks.delete().where(chunks.c.user_id == user_id))
+    return deleted
+
+
+# -- partitions (Postgres) -------------------------------------------------
+
+def is_partitioned(conn):
+    return conn.dialect.name == 'postgresql' and conn.execute(text(
+        "SELECT relkind = 'p' FROM pg_class "
+        "WHERE relname = 'messages' AND relkind IN ('r', 'p') "
+        "AND pg_table_is_visible(oid)")).scalar()
+
+
+def partitions(conn):
+    """[(name, upper bound id or None), ...] for messages' partitions."""
+
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'messages' AND pg_table_is_visible(p.oid) "
+        "ORDER BY c.relname"))
+    found = []
+    for name, bound in rows:
+        match = _UPPER_BOUND.search(bound)
+        found.append((name, int(match.group(1)) if match else None))
+    return found
+
+
+def partition_name(month):
+    return f'messages_p{month:%Y%m}'
+
+
+def create_partitions(conn, first_month, last_month):
+    """Monthly partitions from `first_month` through `last_month`."""
+
+    existing = {name for name, upper in partitions(conn)}
+    month = first_month
+    while month <= last_month:
+        name = partition_name(month)
+        if name not in existing:
+            conn.execute(text(
+                f'CREATE TABLE {name} PARTITION OF messages '
+                f'FOR VALUES FROM ({first_id_at(month)}) '
+                f'TO ({first_id_at(add_months(month, 1))})'))
+        month = add_months(month, 1)
+
+
+def drop_likes_foreign_key(conn):
+    """Drop likes' foreign key to messages, if it's there."""
+
+    conn.execute(text(
+        'ALTER TABLE IF EXISTS likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey'))
+
+
+def partition_messages(conn, hot_months, ahead, now=None):
+    """Make `messages` partitioned by month; True if it wasn't before."""
+
+    now = now or datetime.utcnow()
+    first_month = hot_cutoff(hot_months, now)
+    last_month = add_months(month_start(now), ahead)
+
+    if is_partitioned(conn):
+        create_partitions(conn, max(first_month, month_start(now)), last_month)
+        return False
+
+    # Postgres can't detach partitions a foreign key points into
+    drop_likes_foreign_key(conn)
+    conn.execute(text('DROP INDEX IF EXISTS ix_messages_text_search'))
+    conn.execute(text('ALTER TABLE messages RENAME TO messages_unpartitioned'))
+    conn.execute(text(
+        'ALTER TABLE messages_unpartitioned '
+        'RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey'))
+
+    messages = Message.__table__
+    create = str(CreateTable(messages).compile(dialect=conn.dialect)).rstrip()
+    conn.execute(text(create + ' PARTITION BY RANGE (id)'))
+    for index in messages.indexes:
+        conn.execute(CreateIndex(index))
+    conn.execute(MESSAGE_SEARCH_INDEX)
+
+    conn.execute(text(
+        f'CREATE TABLE messages_history PARTITION OF messages '
+        f'FOR VALUES FROM (MINVALUE) TO ({first_id_at(first_month)})'))
+    create_partitions(conn, first_month, last_month)
+    conn.execute(text('CREATE TABLE messages_default PARTITION OF messages DEFAULT'))
+
+    conn.execute(text(
+        'INSERT INTO messages (id, text, timestamp, user_id) '
+        'SELECT id, text, timestamp, user_id FROM messages_unpartitioned'))
+    conn.execute(text('DROP TABLE messages_unpartitioned'))
+    return True
+
+
+# -- archiving -------------------------------------------------------------
+
+def _archive_partition(conn, name, chunk_size):
+    """Copy partition `name` into the archive, then drop it."""
+
+    source = table(name, *(column(col) for col in COLUMNS))
+    moved, after = 0, -1
+    while True:
+        rows = conn.execute(select([source.c[col] for col in COLUMNS])
+                            .where(source.c.id > after)
+                            .order_by(source.c.id)
+                            .limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        save_chunks(conn, rows)
+        moved += len(rows)
+        after = rows[-1][0]
+
+    conn.execute(text(f'ALTER TABLE messages DETACH PARTITION {name}'))
+    conn.execute(text(f'DROP TABLE {name}'))
+    return moved
+
+
+def _archive_rows(engine, before_id, chunk_size):
+    """Move rows below `before_id` a chunk per transaction."""
+
+    messages = Message.__table__
+    moved = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select([messages.c[col] for col in COLUMNS])
+                                .where(messages.c.id < before_id)
+                                .order_by(messages.c.id)
+                                .limit(chunk_size)).fetchall()
+            if not rows:
+                return moved
+            save_chunks(conn, rows)
+            conn.execute(messages.delete().where(
+                messages.c.id.in_([row[0] for row in rows])))
+            moved += len(rows)
+
+
+def archive_messages(engine, cutoff, chunk_size=1000):
+    """Archive messages on `engine` created before `cutoff`; returns how many."""
+
+    before_id = first_id_at(cutoff)
+    moved = 0
+
+    with engine.begin() as conn:
+        partitioned = is_partitioned(conn)
+        if conn.dialect.name == 'postgresql':
+            # the likes of archived messages stay
+            drop_likes_foreign_key(conn)
+    if partitioned:
+        with engine.connect() as conn:
+            old = [name for name, upper in partitions(conn)
+                   if upper is not None and upper <= before_id]
+        for name in old:
+            with engine.begin() as conn:
+                moved += _archive_partition(conn, name, chunk_size)
+
+    # what's left: the default partition, or the whole unpartitioned table
+    moved += _archive_rows(engine, before_id, chunk_size)
+    return moved
+
+
+def init_archive(app):
+    """Add the `flask partition-messages` and `flask archive-messages` commands."""
+
+    def engines():
+        shards = app.extensions.get('shards')
+        return list(shards.engines.values()) if shards else [db.engine]
+
+    @app.cli.command('partition-messages')
+    def partition_messages_command():
+        """Partition messages by month on Postgres (or add coming months)."""
+
+        for engine in engines():
+            if engine.dialect.name != 'postgresql':
+                click.echo(f"{engine.url.database}: not Postgres, left as it is")
+                continue
+            with engine.begin() as conn:
+                changed = partition_messages(
+                    conn, app.config['MESSAGES_HOT_MONTHS'],
+                    app.config['MESSAGES_PARTITIONS_AHEAD'])
+            click.echo(f"{engine.url.database}: "
+                       f"{'partitioned' if changed else 'added upcoming partitions'}")
+
+    @app.cli.command('archive-messages')
+    @click.option('--hot-months', type=int, default=None,
+                  help="Months of messages to keep (default MESSAGES_HOT_MONTHS).")
+    def archive_messages_command(hot_months):
+        """Move old messages to the archive; run monthly."""
+
+        if hot_months is None:
+            hot_months = app.config['MESSAGES_HOT_MONTHS']
+        cutoff = hot_cutoff(hot_months)
+        for engine in engines():
+            with engine.begin() as conn:
+                if is_partitioned(conn):
+                    create_partitions(
+                        conn, month_start(datetime.utcnow()),
+                        add_months(month_start(datetime.utcnow()),
+                                   app.config['MESSAGES_PARTITIONS_AHEAD']))
+            moved = archive_messages(engine, cutoff, app.config['ARCHIVE_CHUNK_SIZE'])
+            click.echo(f"{engine.url.database}: archived {moved} messages from "
+                       f"before {cutoff:%Y-%m-%d}")
@@ -0,0 +1,102 @@
+"""Compare memory use of ORM entities and read-model rows on the home page.
+
+Runs the home timeline's reads both ways for the user who follows the
+most people (or --user) and prints the allocations each made, as
+measured by tracemalloc:
+
+    python bench_read_models.py [--user ID] [--repeat N]
+
+Uses the database of the WARBLER_CONFIG profile (default 'dev').
+"""
+
+import argparse
+import gc
+import tracemalloc
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from app import create_app
+from models import db, Follows, Message, User
+from readmodels import followed_ids, message_rows, user_stats
+
+LIMIT = 100
+
+
+def orm_home(user_id):
+    """The home page's reads as they were: full entities throughout."""
+
+    user = User.query.get(user_id)
+    followed = [u.id for u in user.following]
+    followed.append(user.id)
+    messages = (Message
+                .query
+                .options(joinedload(Message.user))
+                .filter(Message.user_id.in_(followed))
+                .order_by(Message.id.desc())
+                .limit(LIMIT)
+                .all())
+    counts = (len(user.messages), len(user.following), len(user.followers))
+    return messages, counts
+
+
+def rows_home(user_id):
+    """The same reads through readmodels."""
+
+    followed = followed_ids(user_id)
+    followed.append(user_id)
+    ids = [id for (id,) in (db.session
+                            .query(Message.id)
+                            .filter(Message.user_id.in_(followed))
+                            .order_by(Message.id.desc())
+                            .limit(LIMIT))]
+    return message_rows(ids), user_stats(user_id)
+
+
+def measure(fn, user_id, repeat):
+    """(peak bytes, bytes still held by the result) over `repeat` runs."""
+
+    peaks, held = [], []
+    for _ in range(repeat):
+        db.session.remove()
+        gc.collect()
+        tracemalloc.start()
+        result = fn(user_id)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+        held.append(current)
+        del result
+    return min(peaks), min(held)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--user', type=int)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        user_id = args.user or (db.session
+                                .query(Follows.user_following_id)
+                                .group_by(Follows.user_following_id)
+                                .order_by(func.count().desc())
+                                .limit(1)
+                                .scalar())
+        if user_id is None:
+            raise SystemExit("no follows in the database; run seed.py first")
+
+        # warm up statement caches so neither side pays for compiling
+        orm_home(user_id)
+        rows_home(user_id)
+
+        print(f"user {user_id}, {LIMIT} messages, best of {args.repeat}")
+        print(f"{'':6} {'peak KiB':>10} {'held KiB':>10}")
+        for name, fn in (('orm', orm_home), ('rows', rows_home)):
+            peak, held = measure(fn, user_id, args.repeat)
+            print(f"{name:6} {peak / 1024:10.1f} {held / 1024:10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""Caching primitives for Warbler.
+
+Two interchangeable backends:
+
+- MemoryBackend: per-process LRU bounded by item count and total bytes,
+  with per-key TTLs.
+- SQLiteBackend: a local SQLite file shared by every worker on the
+  machine (no outside service needed), also with TTLs and a size cap.
+
+Values are pickled in both, so callers always get their own copy.
+
+On top of a backend, Cache gives namespaced keys with versioned
+invalidation: every key is stored under its namespace's current
+version and its own, and bumping either (versions are kept by the
+backend apart from the evictable entries, so every process sharing it
+sees the bump) orphans the old keys. Each app has its own Cache, reached
+through `cache` (see extensions.py). invalidate_on() ties namespaces to
+SQLAlchemy inserts, updates and deletes of a model, including rows
+written through relationship collections such as User.following.
+Changes are collected on the session as it flushes and the versions
+bumped once it commits, so no request can cache what a transaction
+still in flight, or later rolled back, has written; with `key` only
+the changed rows' keys are dropped, e.g. one user's liked ids rather
+than everyone's.
+
+Cache.stats() reports hits and misses per namespace.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_mapper, object_session
+
+import metrics
+from extensions import app_local
+
+_MISSING = object()
+
+
+class MemoryBackend:
+    """In-process LRU with TTLs and item/byte limits."""
+
+    def __init__(self, max_items=10000, max_bytes=64 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            data, expires = item
+            if expires is not None and expires <= time.time():
+                self._remove(key)
+                return None
+            self.items.move_to_end(key)
+            return data
+
+    def set(self, key, data, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self._remove(key)
+            self.items[key] = (data, expires)
+            self.bytes += len(data)
+            while self.items and (len(self.items) > self.max_items or
+                                  self.bytes > self.max_bytes):
+                self._remove(next(iter(self.items)))
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def version(self, namespace):
+        return self.versions.get(namespace, 0)
+
+    def bump_version(self, namespace):
+        with self.lock:
+            self.versions[namespace] = self.versions.get(namespace, 0) + 1
+
+    def _remove(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.bytes -= len(item[0])
+
+
+class SQLiteBackend:
+    """Cache in a local SQLite file shared by all processes on the host."""
+
+    def __init__(self, path, max_items=100000):
+        self.path = path
+        self.max_items = max_items
+        self.local = threading.local()
+        self.writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' key TEXT PRIMARY KEY, value BLOB NOT NULL,'
+            ' expires REAL, used REAL NOT NULL)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS versions ('
+            ' namespace TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+
+    def _conn(self):
+        # one connection per thread and process
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, data, ttl=None):
+        now = time.time()
+        self._conn().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, used)'
+            ' VALUES (?, ?, ?, ?)',
+            (key, data, now + ttl if ttl else None, now))
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.prune()
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache')
+
+    def version(self, namespace):
+        row = self._conn().execute(
+            'SELECT version FROM versions WHERE namespace = ?',
+            (namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_version(self, namespace):
+        conn = self._conn()
+        conn.execute('INSERT OR IGNORE INTO versions VALUES (?, 0)', (namespace,))
+        conn.execute('UPDATE versions SET version = version + 1'
+                     ' WHERE namespace = ?', (namespace,))
+
+    def prune(self):
+        """Drop expired rows, then the least recently written over max_items."""
+
+        conn = self._conn()
+        conn.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+        conn.execute(
+            'DELETE FROM cache WHERE key IN ('
+            ' SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)',
+            (self.max_items,))
+
+
+class Namespace:
+    """A Cache view whose keys are prefixed and versioned."""
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+
+    def get(self, key, default=None):
+        return self.cache.get(self.name, key, default)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(self.name, key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.name, key)
+
+    def get_or_set(self, key, fn, ttl=None):
+        return self.cache.get_or_set(self.name, key, fn, ttl)
+
+    def invalidate(self):
+        self.cache.invalidate(self.name)
+
+
+class Cache:
+    """Namespaced, versioned cache over a pluggable backend."""
+
+    def __init__(self, backend=None, default_ttl=300):
+        self.backend = backend or MemoryBackend()
+        self.default_ttl = default_ttl
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def namespace(self, name):
+        return Namespace(self, name)
+
+    def _key(self, namespace, key):
+        return '{}:{}:{}:{}'.format(namespace, self.backend.version(namespace),
+                                    key, self.backend.version(f'{namespace}:{key}'))
+
+    def _count(self, namespace, outcome):
+        with self.lock:
+            counts = self.counts.setdefault(namespace, {'hits': 0, 'misses': 0})
+            counts[outcome] += 1
+        metrics.registry.inc('warbler_cache_requests_total',
+                             {'namespace': namespace, 'result': outcome})
+
+    def _get(self, namespace, versioned, default):
+        data = self.backend.get(versioned)
+        if data is None:
+            self._count(namespace, 'misses')
+            return default
+        self._count(namespace, 'hits')
+        return pickle.loads(data)
+
+    def _set(self, versioned, value, ttl):
+        self.backend.set(versioned, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                         ttl or self.default_ttl)
+
+    def get(self, namespace, key, default=None):
+        return self._get(namespace, self._key(namespace, key), default)
+
+    def set(self, namespace, key, value, ttl=None):
+        self._set(self._key(namespace, key), value, ttl)
+
+    def delete(self, namespace, key):
+        self.backend.delete(self._key(namespace, key))
+
+    def get_or_set(self, namespace, key, fn, ttl=None):
+        # stored under the versions read before fn() runs, so an
+        # invalidate() while it runs orphans what it computed
+        versioned = self._key(namespace, key)
+        value = self._get(namespace, versioned, _MISSING)
+        if value is _MISSING:
+            value = fn()
+            self._set(versioned, value, ttl)
+        return value
+
+    def invalidate(self, namespace, key=None):
+        """Orphan every key in `namespace`, or just `key`."""
+
+        self.backend.bump_version(namespace if key is None else f'{namespace}:{key}')
+
+    def stats(self):
+        """{namespace: {'hits': n, 'misses': n}}"""
+
+        with self.lock:
+            return {ns: dict(counts) for ns, counts in self.counts.items()}
+
+
+_watched = {}
+
+
+def invalidate_on(model, *namespaces, key=None, collections=()):
+    """Invalidate `namespaces` when changes to `model` rows commit.
+
+    With `key`, the name of a column of `model`, only the cache key
+    equal to a changed row's value is dropped. `collections` are
+    relationship attributes (e.g. User.following) whose appends and
+    removes write `model` rows without going through its mapper; with
+    `key` their owner's primary key is the cache key. Bulk
+    query.update()/delete() on `model` invalidate whole namespaces.
+    The cache invalidated is the one of the app in context.
+    """
+
+    def changed(mapper, connection, target):
+        value = getattr(target, key) if key else None
+        _pending(object_session(target), namespaces, value)
+
+    def written(target, *args):
+        value = object_mapper(target).primary_key_from_instance(target)[0] \
+            if key else None
+        _pending(object_session(target), namespaces, value)
+
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, changed)
+    for attribute in collections:
+        event.listen(attribute, 'append', written)
+        event.listen(attribute, 'remove', written)
+
+    if not _watched:
+        event.listen(Session, 'after_bulk_update', _bulk)
+        event.listen(Session, 'after_bulk_delete', _bulk)
+        event.listen(Session, 'after_commit', _commit)
+        event.listen(Session, 'after_transaction_end', _end)
+    _watched.setdefault(model, []).extend(namespaces)
+
+
+def _pending(session, namespaces, key):
+    if session is None:
+        # not in a transaction, so nothing to wait for
+        for namespace in namespaces:
+            cache.invalidate(namespace, key)
+        return
+    pending = session.info.setdefault('cache_invalidate', set())
+    pending.update((namespace, key) for namespace in namespaces)
+
+
+def _bulk(context):
+    mapper = getattr(context, 'mapper', None)
+    _pending(context.session,
+             _watched.get(getattr(mapper, 'class_', None), ()), None)
+
+
+def _commit(session):
+    for namespace, key in session.info.pop('cache_invalidate', ()):
+        cache.invalidate(namespace, key)
+
+
+def _end(session, transaction):
+    # whatever is left when the outermost transaction ends was rolled back
+    if transaction.parent is None:
+        session.info.pop('cache_invalidate', None)
+
+
+def init_cache(app, workers=None):
+    """Give `app` its own cache on the backend chosen in config.
+
+    'auto' shares the cache between processes unless there is only one
+    worker (`workers`, default SERVER_WORKERS).
+    """
+
+    backend = app.config['CACHE_BACKEND']
+    if backend == 'auto':
+        workers = workers or app.config['SERVER_WORKERS']
+        backend = 'memory' if workers == 1 else 'sqlite'
+
+    if backend == 'sqlite':
+        backend = SQLiteBackend(app.config['CACHE_PATH'],
+                                app.config['CACHE_MAX_ITEMS'])
+    else:
+        backend = MemoryBackend(app.config['CACHE_MAX_ITEMS'],
+                                app.config['CACHE_MAX_BYTES'])
+    app_cache = Cache(backend, app.config['CACHE_DEFAULT_TTL'])
+    app.extensions['cache'] = app_cache
+    return app_cache
+
+
+cache = app_local('cache', Cache())
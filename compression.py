@@ -0,0 +1,177 @@
+"""Response compression.
+
+Dynamic responses larger than COMPRESS_MIN_SIZE with a compressible
+content type are gzip- or brotli-encoded, whichever the client prefers
+in Accept-Encoding. Brotli needs the optional `brotli` package; without
+it only gzip is offered.
+
+Static files are never compressed per request. Instead, build
+precompressed siblings once with:
+
+    flask compress-static
+
+and requests for static/foo.css are answered from static/foo.css.br or
+static/foo.css.gz when the client accepts that encoding. A sibling
+older than its file is ignored (the plain file is served) until
+compress-static is run again.
+"""
+
+import gzip
+import mimetypes
+import os
+
+import click
+from flask import request, safe_join, send_from_directory
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+STATIC_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.txt', '.json', '.ico')
+
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+def choose_encoding(accept_encoding, offered):
+    """Pick the best of `offered` for an Accept-Encoding header, or None.
+
+    Ties go to whichever comes first in `offered`.
+    """
+
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for coding in offered:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(data, encoding, gzip_level=6, brotli_level=5):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_level)
+    return gzip.compress(data, compresslevel=gzip_level)
+
+
+def _fresh(path, sibling):
+    """Whether `sibling` exists and was written no earlier than `path`."""
+
+    try:
+        return os.stat(sibling).st_mtime >= os.stat(path).st_mtime
+    except OSError:
+        return False
+
+
+def compress_static_files(folder, gzip_level=9, brotli_level=11):
+    """Write .gz (and .br) siblings for compressible static files."""
+
+    written = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if not name.endswith(STATIC_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding in available_encodings():
+                with open(path + ENCODING_SUFFIXES[encoding], 'wb') as f:
+                    f.write(compress(data, encoding, gzip_level, brotli_level))
+                written += 1
+    return written
+
+
+def init_compression(app):
+    """Compress dynamic responses and serve precompressed static files."""
+
+    if not app.config['COMPRESS_ENABLED']:
+        return
+
+    min_size = app.config['COMPRESS_MIN_SIZE']
+    gzip_level = app.config['COMPRESS_GZIP_LEVEL']
+    brotli_level = app.config['COMPRESS_BROTLI_LEVEL']
+    offered = available_encodings()
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed or
+                response.status_code < 200 or response.status_code in (204, 304) or
+                'Content-Encoding' in response.headers or
+                not response.mimetype.startswith(COMPRESSIBLE_TYPES)):
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        if response.content_length is not None and response.content_length < min_size:
+            return response
+
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''),
+                                   offered)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        response.set_data(compress(data, encoding, gzip_level, brotli_level))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    serve_static = app.view_functions.get('static')
+
+    if serve_static is not None:
+        def static(filename):
+            try:
+                path = safe_join(app.static_folder, filename)
+            except NotFound:
+                return serve_static(filename)
+
+            encoding = choose_encoding(
+                request.headers.get('Accept-Encoding', ''),
+                [enc for enc in ('br', 'gzip')
+                 if _fresh(path, path + ENCODING_SUFFIXES[enc])])
+            if encoding is None:
+                return serve_static(filename)
+
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(
+                app.static_folder, filename + ENCODING_SUFFIXES[encoding],
+                mimetype=mimetype,
+                cache_timeout=app.get_send_file_max_age(filename))
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+
+        app.view_functions['static'] = static
+
+    @app.cli.command('compress-static')
+    def compress_static():
+        """Write precompressed .gz/.br copies of static files."""
+
+        count = compress_static_files(app.static_folder)
+        click.echo(f"Wrote {count} precompressed files.")
@@ -0,0 +1,182 @@
+"""Configuration profiles for Warbler.
+
+Pick one by name with create_app('dev' | 'test' | 'prod'), or with the
+WARBLER_CONFIG environment variable when the app is loaded as `app:app`.
+"""
+
+import os
+import tempfile
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgres:///warbler')
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Where browsers reach the live SSE stream server (see live.py);
+    # leave unset to disable live timeline updates.
+    LIVE_STREAM_URL = os.environ.get('LIVE_STREAM_URL')
+
+    # Sampling profiler (see profiling.py): profile this fraction of
+    # requests, plus any request sent with the PROFILE_HEADER header.
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_HEADER = os.environ.get('PROFILE_HEADER')
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+    PROFILE_INTERVAL = 0.005
+
+    # Prometheus metrics at /metrics (see metrics.py); each worker
+    # process keeps its counters in a file under METRICS_DIR.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    METRICS_DIR = os.environ.get(
+        'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'warbler-metrics'))
+
+    # Shared on-disk Jinja bytecode cache (see templating.py), in
+    # TEMPLATE_CACHE_DIR or, unset, a private temp directory; set
+    # TEMPLATE_WARM to compile every template when the app is built.
+    TEMPLATE_BYTECODE_CACHE = True
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+    TEMPLATE_WARM = False
+
+    # gzip/brotli for dynamic responses (see compression.py)
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_LEVEL = 5
+
+    # Log statements slower than this many ms (None to disable), with
+    # EXPLAIN plans for a sample of them (see slowlog.py)
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 250))
+    SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'logs/slow_queries.jsonl')
+    SLOW_QUERY_EXPLAIN_RATE = 0.1
+    SLOW_QUERY_MAX_PER_SECOND = 10
+
+    # How long a request waits on an identical in-flight profile load
+    # before doing the work itself (see singleflight.py)
+    SINGLE_FLIGHT_TIMEOUT = 2.0
+
+    # Application cache (see cache.py): 'memory' for a per-process LRU,
+    # 'sqlite' for a file at CACHE_PATH shared by every local worker,
+    # 'auto' for 'memory' only when there is a single worker
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'auto')
+    CACHE_PATH = os.environ.get(
+        'CACHE_PATH', os.path.join(tempfile.gettempdir(), 'warbler-cache.sqlite'))
+    CACHE_MAX_ITEMS = 10000
+    CACHE_MAX_BYTES = 64 * 1024 * 1024
+    CACHE_DEFAULT_TTL = 300
+
+    # Worker id (0-1022) baked into new message ids (see snowflake.py;
+    # 1023, IMPORT_WORKER, is kept for imported history); every process
+    # writing to the same database needs its own. Unset means derive
+    # it from the process id, or under serve.py use the worker's slot.
+    WORKER_ID = os.environ.get('WORKER_ID')
+
+    # Spread users and their rows over these databases (see sharding.py);
+    # a comma-separated list in the environment. Empty means one database.
+    SHARD_URLS = [url for url in os.environ.get('SHARD_URLS', '').split(',') if url]
+
+    # Outbox dispatch (see outbox.py): a thread per process tails the
+    # outbox for local projections; turn OUTBOX_DURABLE off in all but
+    # one process (or run `flask dispatch-outbox` instead). serve.py
+    # leaves it on only in its first worker.
+    OUTBOX_THREAD = True
+    OUTBOX_DURABLE = os.environ.get('OUTBOX_DURABLE', '1') == '1'
+    OUTBOX_POLL_INTERVAL = 1.0
+    OUTBOX_BATCH_SIZE = 100
+    OUTBOX_RETENTION = 7 * 24 * 60 * 60
+
+    # Read the in-memory follow graph (see followgraph.py) in a
+    # background thread at startup; until then, or with this off,
+    # relationship questions are answered from the database
+    FOLLOW_GRAPH_PRELOAD = True
+
+    # Message search (see search.py): 'postgres' for the full-text
+    # index, 'memory' for a per-process inverted index, 'auto' to pick
+    # by database
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+
+    # Append a trace line per request under this directory for
+    # `flask replay-traffic` (see traffic.py); unset to record nothing
+    TRAFFIC_DIR = os.environ.get('TRAFFIC_DIR')
+    TRAFFIC_SAMPLE_RATE = float(os.environ.get('TRAFFIC_SAMPLE_RATE', 1))
+
+    # Preforking server (see serve.py); workers default to one per
+    # core, threads to a few per core shared between them. Workers
+    # restart after about SERVER_MAX_REQUESTS requests or past
+    # SERVER_MAX_MEMORY_MB of resident memory (None for no limit).
+    SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 0)) or None
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 0)) or None
+    SERVER_MAX_REQUESTS = 10000
+    SERVER_MAX_REQUESTS_JITTER = 0.1
+    SERVER_MAX_MEMORY_MB = 512
+    SERVER_GRACEFUL_TIMEOUT = 30
+
+    # Token-bucket limits on POSTs per endpoint and scope (see
+    # ratelimit.py); 'file' shares the buckets between local workers
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORE = os.environ.get('RATELIMIT_STORE', 'file')
+    RATELIMIT_PATH = os.environ.get(
+        'RATELIMIT_PATH',
+        os.path.join(tempfile.gettempdir(), 'warbler-ratelimit.sqlite'))
+    RATELIMIT_LIMITS = {
+        'warbler.login': {'ip': '10/minute', 'username': '5/minute'},
+        'warbler.signup': {'ip': '5/hour'},
+        'warbler.like_user_post': {'ip': '300/minute', 'user': '60/minute'},
+        'warbler.messages_import': {'user': '10/hour'},
+    }
+
+    # Rows per page (one short query each) of data exports (see export.py)
+    EXPORT_CHUNK_SIZE = 1000
+
+    # Bulk message imports (see importer.py): messages inserted per
+    # transaction, and how many bad lines to list in the report
+    IMPORT_BATCH_SIZE = 500
+    IMPORT_MAX_ERRORS = 100
+
+    # Message partitions and archive (see archive.py): months of
+    # messages kept in the messages table, monthly partitions made in
+    # advance on Postgres, and messages packed per archive row
+    MESSAGES_HOT_MONTHS = 12
+    MESSAGES_PARTITIONS_AHEAD = 3
+    ARCHIVE_CHUNK_SIZE = 1000
+
+    # Install Flask-DebugToolbar (imported only when this is on)
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+
+class DevConfig(Config):
+    DEBUG_TOOLBAR = True
+
+
+class TestConfig(Config):
+    TESTING = True
+    METRICS_ENABLED = False
+    TEMPLATE_BYTECODE_CACHE = False
+    CACHE_BACKEND = 'memory'
+    COMPRESS_ENABLED = False
+    OUTBOX_THREAD = False
+    FOLLOW_GRAPH_PRELOAD = False
+    RATELIMIT_ENABLED = False
+    SLOW_QUERY_MS = None
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'TEST_DATABASE_URL', 'postgresql:///warbler-test')
+
+    # Don't have WTForms use CSRF at all, since it's a pain to test
+    WTF_CSRF_ENABLED = False
+
+
+class ProdConfig(Config):
+    TEMPLATE_WARM = True
+
+
+PROFILES = {
+    'dev': DevConfig,
+    'test': TestConfig,
+    'prod': ProdConfig,
+}
@@ -0,0 +1,210 @@
+"""Streaming exports of a user's data.
+
+An export is one record per message, like and follow the user made:
+
+    {"type": "message", "id": ..., "username": ..., "text": ..., "timestamp": ...}
+    {"type": "like", "id": <message id>, "username": <its author>, ...}
+    {"type": "following", "id": <user id>, "username": ..., "text": null, ...}
+
+as JSON lines or as CSV with those columns. Messages include archived
+ones (see archive.py), which come first, being the oldest.
+
+Rows are read in keyset pages of EXPORT_CHUNK_SIZE, each its own short
+query, and the read transaction is ended before a page is written
+out, so a slow download doesn't keep a database connection (and a
+snapshot) open. An export takes the same memory whatever the
+account's size, and the download starts before the last row is read.
+Likes and follows look up their messages and users a page at a time
+(liked messages since archived, one at a time).
+
+Download one as the logged-in user from /users/export.jsonl (or .csv,
+optionally ?include=messages,likes), or from the command line:
+
+    flask export-user alice --format csv -o alice.csv
+"""
+
+import csv
+import io
+import json
+
+import click
+from flask import current_app
+
+from archive import archived_by, find_archived
+from models import db, Follows, Likes, Message, User
+from readmodels import author_rows, message_rows
+
+KINDS = ('messages', 'likes', 'following')
+
+FIELDS = ('type', 'id', 'username', 'text', 'timestamp')
+
+EXPORT_MIMETYPES = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# how much output to gather before handing it to the server
+WRITE_SIZE = 64 * 1024
+
+
+def _record(type, id, username, text=None, timestamp=None):
+    return dict(type=type, id=id, username=username, text=text,
+                timestamp=timestamp.isoformat() if timestamp else None)
+
+
+def _pages(query, key, user_id, page_size):
+    """Lists of `query`'s rows over `user_id`'s data, `page_size` at a time.
+
+    Pages follow `key`, the first column of `query`.
+    """
+
+    shards = current_app.extensions.get('shards')
+    if shards:
+        query = query.set_shard(shards.shard_for(user_id))
+    after = None
+    while True:
+        page = query if after is None else query.filter(key > after)
+        rows = page.order_by(key).limit(page_size).all()
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
+
+
+def _message_pages(user_id, page_size):
+    username = author_rows([user_id])[0].username
+    for rows in archived_by(user_id):
+        yield [_record('message', id, username, text, timestamp)
+               for id, timestamp, text in rows]
+    for rows in _pages(db.session
+                       .query(Message.id, Message.text, Message.timestamp)
+                       .filter(Message.user_id == user_id),
+                       Message.id, user_id, page_size):
+        yield [_record('message', id, username, text, timestamp)
+               for id, text, timestamp in rows]
+
+
+def _like_pages(user_id, page_size):
+    for rows in _pages(db.session
+                       .query(Likes.id, Likes.message_id)
+                       .filter(Likes.user_id == user_id),
+                       Likes.id, user_id, page_size):
+        ids = [message_id for _, message_id in rows]
+        found = {msg.id: msg for msg in message_rows(ids)}
+        page = []
+        for id in ids:
+            msg = found.get(id) or find_archived(id)
+            if msg is None:
+                page.append(_record('like', id, None))
+            else:
+                page.append(_record('like', id, msg.user.username,
+                                    msg.text, msg.timestamp))
+        yield page
+
+
+def _following_pages(user_id, page_size):
+    for rows in _pages(db.session
+                       .query(Follows.user_being_followed_id)
+                       .filter(Follows.user_following_id == user_id),
+                       Follows.user_being_followed_id, user_id, page_size):
+        yield [_record('following', author.id, author.username)
+               for author in author_rows([id for (id,) in rows])]
+
+
+PAGES = {'messages': _message_pages, 'likes': _like_pages,
+         'following': _following_pages}
+
+
+def records(user_id, kinds=KINDS, chunk_size=1000):
+    """Export records for `user_id`, one dict per row, oldest first.
+
+    Ends the session's transaction before each page is handed on.
+    """
+
+    for kind in KINDS:
+        if kind not in kinds:
+            continue
+        for page in PAGES[kind](user_id, chunk_size):
+            # the connection goes back to the pool while this is written
+            db.session.rollback()
+            yield from page
+
+
+def jsonl_lines(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def csv_lines(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_export(user_id, format='jsonl', kinds=KINDS, chunk_size=1000):
+    """An export of `user_id`'s data as an iterable of text pieces.
+
+    The first line goes out on its own so the download starts at once;
+    after that lines are gathered into pieces of about WRITE_SIZE.
+    """
+
+    lines = (csv_lines if format == 'csv' else jsonl_lines)(
+        records(user_id, kinds, chunk_size))
+    yield next(lines, '')
+    pending, size = [], 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= WRITE_SIZE:
+            yield ''.join(pending)
+            pending, size = [], 0
+    if pending:
+        yield ''.join(pending)
+
+
+def parse_kinds(include):
+    """'messages,likes' -> ('messages', 'likes'); empty for all KINDS.
+
+    Raises ValueError for anything not in KINDS.
+    """
+
+    if not include:
+        return KINDS
+    kinds = tuple(kind.strip() for kind in include.split(',') if kind.strip())
+    unknown = set(kinds) - set(KINDS)
+    if unknown:
+        raise ValueError(f"can't export {', '.join(sorted(unknown))}")
+    return kinds
+
+
+def init_export(app):
+    """Add the `flask export-user` command."""
+
+    @app.cli.command('export-user')
+    @click.argument('username')
+    @click.option('--format', 'format', default='jsonl',
+                  type=click.Choice(sorted(EXPORT_MIMETYPES)))
+    @click.option('--include', default=None,
+                  help="Comma-separated kinds to export (default: all).")
+    @click.option('-o', '--output', default='-', type=click.File('w'),
+                  help="File to write (default: stdout).")
+    def export_user(username, format, include, output):
+        """Export a user's messages, likes and follows."""
+
+        try:
+            kinds = parse_kinds(include)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--include')
+
+        user_id = (db.session.query(User.id)
+                   .filter(User.username == username).scalar())
+        if user_id is None:
+            raise click.ClickException(f"no user {username!r}")
+
+        for piece in stream_export(user_id, format, kinds,
+                            app.config['EXPORT_CHUNK_SIZE']):
+            output.write(piece)
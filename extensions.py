@@ -0,0 +1,25 @@
+"""Per-app state behind module-level names.
+
+Modules such as trending.py keep a process default and expose
+
+    trending = app_local('trending', Trending())
+
+create_app() puts each app's own instance in app.extensions, so two
+apps built in one process (tests, a CLI next to a server) don't share
+buffers, caches or counters. Outside an app context the name falls
+back to the default.
+"""
+
+from flask import current_app, has_app_context
+from werkzeug.local import LocalProxy
+
+
+def app_local(name, default):
+    """A proxy to app.extensions[`name`] of the current app, or `default`."""
+
+    def lookup():
+        if has_app_context():
+            return current_app.extensions.get(name, default)
+        return default
+
+    return LocalProxy(lookup)
@@ -0,0 +1,250 @@
+"""In-memory follow graph for relationship questions.
+
+Each app keeps, per user, the ids they follow and the ids following
+them as sorted int64 arrays (8 bytes an edge), so "does X follow Y" is
+a binary search and "mutual follows" or "followers you know" are
+intersections of two sorted arrays, without touching the database.
+
+The graph is read from the follows table in a background thread when
+the app starts serving (FOLLOW_GRAPH_PRELOAD); until it's ready, the
+same questions are answered from the database, so no request waits on
+the load. After that it's kept up to date from follow.created /
+follow.deleted / user.deleted outbox events (see projections.py), so it
+can trail writes made by other processes by up to OUTBOX_POLL_INTERVAL.
+Rows written without an event (seeding, the shell) are only seen after
+another load() or a restart; use User.is_following where an answer must
+be exact.
+"""
+
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+
+from extensions import app_local
+from models import db, Follows
+from readmodels import followed_among, followed_ids, follower_ids
+
+# Follows read per query while loading
+LOAD_BATCH = 10000
+
+logger = logging.getLogger('warbler.followgraph')
+
+
+def _contains(ids, id):
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+
+def _insert(ids, id):
+    i = bisect_left(ids, id)
+    if i == len(ids) or ids[i] != id:
+        ids.insert(i, id)
+
+
+def _discard(ids, id):
+    i = bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        del ids[i]
+
+
+def intersect(a, b):
+    """Ids in both sorted arrays, in order."""
+
+    if len(a) > len(b):
+        a, b = b, a
+    found = []
+    lo = 0
+    for id in a:
+        lo = bisect_left(b, id, lo)
+        if lo == len(b):
+            break
+        if b[lo] == id:
+            found.append(id)
+    return found
+
+
+class FollowGraph:
+    """Who follows whom, as sorted id arrays per user."""
+
+    def __init__(self):
+        self.following = {}
+        self.followers = {}
+        self.loaded = False
+        # while a load runs, updates it may have read past
+        self.loading = False
+        self.missed = []
+        self.lock = threading.RLock()
+
+    def clear(self):
+        """Empty the graph; queries go to the database until load()."""
+
+        with self.lock:
+            self.following = {}
+            self.followers = {}
+            self.loaded = False
+            self.loading = False
+            self.missed = []
+
+    def load(self):
+        """Read every follow and swap the result in.
+
+        The lock is only held for the swap, so queries keep being
+        answered (from the database) while the table is read. Updates
+        that arrive meanwhile are applied on top afterwards.
+        """
+
+        with self.lock:
+            self.loading = True
+            self.missed = []
+        try:
+            following, followers = self._read()
+        except Exception:
+            with self.lock:
+                self.loading = False
+                self.missed = []
+            raise
+
+        with self.lock:
+            self.following = following
+            self.followers = followers
+            self.loaded = True
+            self.loading = False
+            missed, self.missed = self.missed, []
+            for update, args in missed:
+                update(*args)
+
+    def _read(self):
+        """Every follow as (following, followers) arrays per user."""
+
+        following = {}
+        followers = {}
+        after = (0, 0)
+        key = db.tuple_(Follows.user_following_id, Follows.user_being_followed_id)
+        while True:
+            rows = sorted(db.session
+                          .query(Follows.user_following_id,
+                                 Follows.user_being_followed_id)
+                          .filter(key > after)
+                          .order_by(Follows.user_following_id,
+                                    Follows.user_being_followed_id)
+                          .limit(LOAD_BATCH))
+            # sharded, every shard returns a batch; keep the lowest keys
+            # so no shard is skipped past
+            for follower, followed in rows[:LOAD_BATCH]:
+                following.setdefault(follower, array('q')).append(followed)
+                followers.setdefault(followed, array('q')).append(follower)
+            if len(rows) < LOAD_BATCH:
+                break
+            after = tuple(rows[LOAD_BATCH - 1])
+
+        # followers arrive grouped by follower, not in order
+        for ids in followers.values():
+            ids[:] = array('q', sorted(ids))
+
+        return following, followers
+
+    def _ids(self, index, user_id):
+        """A copy of one user's sorted ids, from the database if not loaded."""
+
+        with self.lock:
+            if self.loaded:
+                return array('q', getattr(self, index).get(user_id, ()))
+        if index == 'following':
+            return array('q', sorted(followed_ids(user_id)))
+        return array('q', sorted(follower_ids(user_id)))
+
+    def _unloaded(self, update, *args):
+        """True if not loaded; an update made mid-load is kept for later."""
+
+        if self.loaded:
+            return False
+        if self.loading:
+            self.missed.append((update, args))
+        return True
+
+    # -- updates ----------------------------------------------------------
+
+    def add(self, follower_id, followed_id):
+        with self.lock:
+            if self._unloaded(self.add, follower_id, followed_id):
+                return
+            _insert(self.following.setdefault(follower_id, array('q')), followed_id)
+            _insert(self.followers.setdefault(followed_id, array('q')), follower_id)
+
+    def remove(self, follower_id, followed_id):
+        with self.lock:
+            if self._unloaded(self.remove, follower_id, followed_id):
+                return
+            _discard(self.following.get(follower_id, array('q')), followed_id)
+            _discard(self.followers.get(followed_id, array('q')), follower_id)
+
+    def remove_user(self, user_id):
+        """Drop `user_id` and every follow to or from them."""
+
+        with self.lock:
+            if self._unloaded(self.remove_user, user_id):
+                return
+            for followed_id in self.following.pop(user_id, ()):
+                _discard(self.followers.get(followed_id, array('q')), user_id)
+            for follower_id in self.followers.pop(user_id, ()):
+                _discard(self.following.get(follower_id, array('q')), user_id)
+
+    # -- queries ----------------------------------------------------------
+
+    def follows(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        with self.lock:
+            if self.loaded:
+                return _contains(self.following.get(follower_id, ()), followed_id)
+        return bool(followed_among(follower_id, [followed_id]))
+
+    def following_of(self, user_id):
+        """Sorted ids `user_id` follows."""
+
+        return list(self._ids('following', user_id))
+
+    def followers_of(self, user_id):
+        """Sorted ids following `user_id`."""
+
+        return list(self._ids('followers', user_id))
+
+    def mutuals(self, user_id):
+        """Ids that follow `user_id` and that `user_id` follows back."""
+
+        return intersect(self._ids('following', user_id),
+                         self._ids('followers', user_id))
+
+    def followers_you_know(self, viewer_id, user_id):
+        """Followers of `user_id` that `viewer_id` follows."""
+
+        return intersect(self._ids('following', viewer_id),
+                         self._ids('followers', user_id))
+
+
+def _load_in_background(app, graph):
+    with app.app_context():
+        try:
+            graph.load()
+        except Exception:
+            logger.exception("Loading the follow graph failed; "
+                             "answering from the database")
+
+
+def init_follow_graph(app):
+    """Give `app` its own follow graph and start loading it if configured."""
+
+    graph = FollowGraph()
+    app.extensions['follow_graph'] = graph
+
+    @app.before_first_request
+    def start_loading():
+        if app.config['FOLLOW_GRAPH_PRELOAD']:
+            threading.Thread(target=_load_in_background, args=(app, graph),
+                             daemon=True).start()
+
+    return graph
+
+
+follow_graph = app_local('follow_graph', FollowGraph())
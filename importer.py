@@ -0,0 +1,207 @@
+"""Bulk import of a user's messages from another platform.
+
+The body is JSON lines, one message each:
+
+    {"text": "hello again", "timestamp": "2016-04-01T12:30:00Z"}
+
+`timestamp` (UTC, or with a +HH:MM offset) is when it was first
+posted, defaulting to now. Each message gets an id for its own
+timestamp (historical_id in snowflake.py, which can't collide with
+live posts), so imported history slots into timelines where it belongs
+rather than on top.
+
+Lines are read and checked one at a time as the body streams in, and
+valid messages are inserted IMPORT_BATCH_SIZE to a transaction. A bad
+line is reported and skipped rather than failing the import; if a
+batch fails in the database its rows are retried one at a time, so
+only the offending ones are lost. The report is
+
+    {"imported": 980, "failed": 20, "errors": [{"line": 7, "error": "..."}]}
+
+listing the first IMPORT_MAX_ERRORS errors.
+
+Imports emit one message.imported event per transaction rather than a
+message.created per message, so timelines and search pick them up but
+nothing treats them as new posts (trending, the live stream).
+
+POST the file to /messages/import as the logged-in user, or:
+
+    flask import-messages alice messages.jsonl
+"""
+
+import json
+import re
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Message, User
+from outbox import emit
+from snowflake import EPOCH, message_ids
+
+TEXT_LENGTH = Message.__table__.c.text.type.length
+
+_OFFSET = re.compile(r'([+-])(\d\d):?(\d\d)$')
+
+
+class RowError(ValueError):
+    """A line that can't be imported."""
+
+
+def parse_timestamp(value):
+    """An ISO 8601 timestamp as a naive UTC datetime."""
+
+    if value.endswith('Z'):
+        value = value[:-1]
+    offset = timedelta()
+    match = _OFFSET.search(value)
+    if match and 'T' in value[:match.start()]:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+        if sign == '-':
+            offset = -offset
+        value = value[:match.start()]
+
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format) - offset
+        except ValueError:
+            pass
+    raise RowError(f"can't read timestamp {value!r}")
+
+
+def parse_row(line, now):
+    """(text, timestamp) from one line of an import."""
+
+    try:
+        row = json.loads(line)
+    except ValueError:
+        raise RowError("not valid JSON")
+    if not isinstance(row, dict):
+        raise RowError("expected a JSON object")
+
+    text = row.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise RowError("text is missing")
+    if len(text) > TEXT_LENGTH:
+        raise RowError(f"text is longer than {TEXT_LENGTH} characters")
+
+    timestamp = row.get('timestamp')
+    if timestamp is None:
+        return text, now
+    if not isinstance(timestamp, str):
+        raise RowError("timestamp must be a string")
+    timestamp = parse_timestamp(timestamp)
+    if timestamp < EPOCH:
+        raise RowError(f"timestamp is before {EPOCH:%Y-%m-%d}")
+    if timestamp > now:
+        raise RowError("timestamp is in the future")
+    return text, timestamp
+
+
+class Importer:
+    """Imports lines of messages for one user, a batch at a time."""
+
+    def __init__(self, user_id, batch_size=500, max_errors=100):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.now = None
+
+    def error(self, number, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append(dict(line=number, error=message))
+
+    def _message(self, text, timestamp):
+        if timestamp == self.now:
+            # no timestamp given, so an ordinary new message
+            id = message_ids.next_id()
+        else:
+            id = message_ids.historical_id(timestamp)
+        return Message(id=id, text=text, timestamp=timestamp,
+                       user_id=self.user_id)
+
+    def _insert(self, messages):
+        db.session.add_all(messages)
+        emit('message.imported', self.user_id,
+             message_ids=[msg.id for msg in messages])
+        db.session.commit()
+
+    def flush(self, batch):
+        """Insert `batch` ((line number, Message), ...) in one transaction."""
+
+        if not batch:
+            return
+        try:
+            self._insert([msg for number, msg in batch])
+            self.imported += len(batch)
+            return
+        except SQLAlchemyError:
+            db.session.rollback()
+
+        for number, msg in batch:
+            try:
+                self._insert([self._message(msg.text, msg.timestamp)])
+                self.imported += 1
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                cause = getattr(e, 'orig', None) or e
+                self.error(number, f"couldn't be saved ({type(cause).__name__})")
+
+    def run(self, lines):
+        """Import `lines` (str or bytes); returns the report."""
+
+        now = self.now = datetime.utcnow()
+        batch = []
+        for number, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            if not line.strip():
+                continue
+            try:
+                text, timestamp = parse_row(line, now)
+            except RowError as e:
+                self.error(number, str(e))
+                continue
+
+            batch.append((number, self._message(text, timestamp)))
+            if len(batch) >= self.batch_size:
+                self.flush(batch)
+                batch = []
+        self.flush(batch)
+        return self.report()
+
+    def report(self):
+        return dict(imported=self.imported, failed=self.failed,
+                    errors=self.errors)
+
+
+def import_messages(user_id, lines, batch_size=500, max_errors=100):
+    """Import JSON `lines` of messages for `user_id`; returns the report."""
+
+    return Importer(user_id, batch_size, max_errors).run(lines)
+
+
+def init_importer(app):
+    """Add the `flask import-messages` command."""
+
+    @app.cli.command('import-messages')
+    @click.argument('username')
+    @click.argument('messages', type=click.File('rb'))
+    def import_messages_command(username, messages):
+        """Import JSON lines of messages for a user."""
+
+        user_id = (db.session.query(User.id)
+                   .filter(User.username == username).scalar())
+        if user_id is None:
+            raise click.ClickException(f"no user {username!r}")
+
+        report = import_messages(user_id, messages,
+                                 app.config['IMPORT_BATCH_SIZE'],
+                                 app.config['IMPORT_MAX_ERRORS'])
+        click.echo(json.dumps(report, indent=2))
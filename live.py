@@ -0,0 +1,224 @@
+"""Live timeline updates over Server-Sent Events.
+
+The Flask app publishes each new message as a small UDP datagram to a
+local port (fire-and-forget, so posting never waits on it). A separate
+asyncio process listens for those datagrams and fans them out to the
+browsers following the author, each held open as an idle SSE stream --
+thousands of those cost one coroutine and a small queue apiece.
+
+Browsers authenticate with a short signed token minted on the home
+page that carries only their user id. The stream server looks up who
+they follow once per connection, on a worker thread so the event loop
+never waits on the database, and keeps that set for the life of the
+stream.
+
+Run the stream server with:
+
+    python live.py
+
+and point the app at it with LIVE_STREAM_URL (e.g.
+http://localhost:5001/live/stream).
+"""
+
+import asyncio
+import json
+import os
+import socket
+from urllib.parse import urlsplit, parse_qs
+
+from itsdangerous import URLSafeTimedSerializer, BadData
+
+PUBSUB_HOST = os.environ.get('LIVE_PUBSUB_HOST', '127.0.0.1')
+PUBSUB_PORT = int(os.environ.get('LIVE_PUBSUB_PORT', 5002))
+STREAM_PORT = int(os.environ.get('LIVE_STREAM_PORT', 5001))
+
+TOKEN_SALT = 'live-stream'
+TOKEN_MAX_AGE = 24 * 60 * 60
+KEEPALIVE = 15
+QUEUE_SIZE = 100
+
+_publisher = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+##############################################################################
+# Publishing side (runs inside the Flask app)
+
+
+def stream_token(secret_key, user_id):
+    """Sign the stream subscription for `user_id`."""
+
+    serializer = URLSafeTimedSerializer(secret_key, salt=TOKEN_SALT)
+    return serializer.dumps(user_id)
+
+
+def message_event(msg):
+    """The JSON-able payload the browser needs to render `msg`.
+
+    Ids are strings: message ids (and sharded user ids) don't fit a
+    JavaScript number.
+    """
+
+    return {
+        'id': str(msg.id),
+        'text': msg.text,
+        'timestamp': msg.timestamp.strftime('%d %B %Y'),
+        'user': {
+            'id': str(msg.user.id),
+            'username': msg.user.username,
+            'image_url': msg.user.image_url,
+        },
+    }
+
+
+def publish_message(msg):
+    """Tell the stream server about a new message; never raises."""
+
+    data = json.dumps(message_event(msg)).encode('utf-8')
+    try:
+        _publisher.sendto(data, (PUBSUB_HOST, PUBSUB_PORT))
+    except OSError:
+        pass
+
+
+##############################################################################
+# Stream server (asyncio)
+
+
+class Hub:
+    """Author id -> queues of the connected followers."""
+
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, author_ids):
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        for author_id in author_ids:
+            self.subscribers.setdefault(author_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, author_ids, queue):
+        for author_id in author_ids:
+            queues = self.subscribers.get(author_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.subscribers[author_id]
+
+    def publish(self, event):
+        for queue in self.subscribers.get(int(event['user']['id']), ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                pass  # slow reader; it will catch up on next page load
+
+
+class PubSubProtocol(asyncio.DatagramProtocol):
+    """Receives message datagrams from the app and hands them to the hub."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def datagram_received(self, data, addr):
+        try:
+            event = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return
+        self.hub.publish(event)
+
+
+class StreamServer:
+    """Minimal HTTP server that only speaks GET /live/stream."""
+
+    def __init__(self, secret_key, followed_ids, hub=None):
+        self.serializer = URLSafeTimedSerializer(secret_key, salt=TOKEN_SALT)
+        self.followed_ids = followed_ids
+        self.hub = hub or Hub()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            try:
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            except ValueError:
+                return
+
+            url = urlsplit(target)
+            token = parse_qs(url.query).get('token', [''])[0]
+
+            if method != 'GET' or url.path != '/live/stream':
+                writer.write(b'HTTP/1.1 404 Not Found\r\n'
+                             b'Content-Length: 0\r\n\r\n')
+                return
+
+            try:
+                user_id = self.serializer.loads(token, max_age=TOKEN_MAX_AGE)
+            except BadData:
+                writer.write(b'HTTP/1.1 403 Forbidden\r\n'
+                             b'Content-Length: 0\r\n\r\n')
+                return
+
+            followed_ids = await asyncio.get_event_loop().run_in_executor(
+                None, self.followed_ids, user_id)
+            await self.stream(writer, set(followed_ids) | {user_id})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, writer, author_ids):
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Access-Control-Allow-Origin: *\r\n'
+                     b'\r\n')
+        await writer.drain()
+
+        queue = self.hub.subscribe(author_ids)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                else:
+                    writer.write(
+                        'id: {}\ndata: {}\n\n'.format(
+                            event['id'], json.dumps(event)).encode('utf-8'))
+                await writer.drain()
+        finally:
+            self.hub.unsubscribe(author_ids, queue)
+
+    async def serve(self, host='0.0.0.0', port=STREAM_PORT,
+                    pubsub_host=PUBSUB_HOST, pubsub_port=PUBSUB_PORT):
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(
+            lambda: PubSubProtocol(self.hub),
+            local_addr=(pubsub_host, pubsub_port))
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    from app import create_app
+    from models import db
+    from readmodels import followed_ids
+
+    app = create_app()
+
+    def app_followed_ids(user_id):
+        with app.app_context():
+            try:
+                return followed_ids(user_id)
+            finally:
+                db.session.remove()
+
+    server = StreamServer(app.config['SECRET_KEY'], app_followed_ids)
+    asyncio.run(server.serve())
+
+
+if __name__ == '__main__':
+    main()
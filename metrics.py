@@ -0,0 +1,449 @@
+"""Prometheus metrics for Warbler, safe across worker processes.
+
+Every process writes its counters into its own small mmap-backed file
+under METRICS_DIR, so recording a sample is a dict lookup and an
+8-byte write under a process-local lock -- no cross-process locking.
+GET /metrics reads every process's file and adds them up (gauges are
+reported per live process instead, with a `pid` label). The counters
+of processes that have exited are folded into one archive file and
+their own files removed, so the directory doesn't grow with every
+recycled worker and a reused pid starts from a clean file.
+
+Recorded per request: latency histogram and status counts per
+endpoint, plus how much of that time went to SQL and to Jinja
+rendering. Also recorded: connection-pool checkout wait and pool
+size/usage for the engine behind `db`, and bcrypt hash/check counts.
+
+Each app records into the registry for its METRICS_DIR; until
+init_metrics() runs (METRICS_ENABLED), recording is a no-op.
+"""
+
+import fcntl
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import Response, g, request, before_render_template, template_rendered
+from flask_bcrypt import Bcrypt
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from extensions import app_local
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'warbler_request_duration_seconds':
+        ('histogram', 'Request latency by endpoint.'),
+    'warbler_requests_total':
+        ('counter', 'Requests by endpoint and status code.'),
+    'warbler_request_db_seconds_total':
+        ('counter', 'Time spent executing SQL, by endpoint.'),
+    'warbler_request_render_seconds_total':
+        ('counter', 'Time spent rendering templates, by endpoint.'),
+    'warbler_db_pool_checkout_wait_seconds':
+        ('histogram', 'Time spent waiting for a pooled DB connection.'),
+    'warbler_db_pool_size':
+        ('gauge', 'Configured size of the DB connection pool.'),
+    'warbler_db_pool_checked_out':
+        ('gauge', 'DB connections currently checked out.'),
+    'warbler_bcrypt_operations_total':
+        ('counter', 'bcrypt hashes and checks.'),
+    'warbler_bcrypt_seconds_total':
+        ('counter', 'Time spent in bcrypt.'),
+    'warbler_cache_requests_total':
+        ('counter', 'Cache lookups by namespace and hit/miss.'),
+    'warbler_rate_limited_total':
+        ('counter', 'Requests refused with 429 by endpoint.'),
+}
+
+_HEADER = struct.Struct('Q')
+_KEY_LEN = struct.Struct('I')
+_VALUE = struct.Struct('d')
+
+
+class MmapValues:
+    """Append-only file of (key, float) slots for one process.
+
+    Layout: 8-byte used length, then entries of 4-byte key length, the
+    UTF-8 key padded to 8 bytes, and an 8-byte double.
+    """
+
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        self.file = open(path, 'a+b')
+        if os.fstat(self.file.fileno()).st_size < self.INITIAL_SIZE:
+            self.file.truncate(self.INITIAL_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.used = _HEADER.unpack_from(self.map, 0)[0] or _HEADER.size
+        for key, value, offset in read_entries(self.map, self.used):
+            self.offsets[key] = offset
+
+    def _add_slot(self, key):
+        encoded = key.encode('utf-8')
+        padded = len(encoded) + (-(_KEY_LEN.size + len(encoded)) % 8)
+        needed = _KEY_LEN.size + padded + _VALUE.size
+
+        while self.used + needed > len(self.map):
+            new_size = 2 * len(self.map)
+            self.map.close()
+            self.file.truncate(new_size)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+        start = self.used
+        _KEY_LEN.pack_into(self.map, start, len(encoded))
+        self.map[start + _KEY_LEN.size:start + _KEY_LEN.size + len(encoded)] = encoded
+        offset = start + _KEY_LEN.size + padded
+        _VALUE.pack_into(self.map, offset, 0.0)
+
+        self.used += needed
+        _HEADER.pack_into(self.map, 0, self.used)
+        self.offsets[key] = offset
+        return offset
+
+    def add(self, key, amount):
+        offset = self.offsets.get(key) or self._add_slot(key)
+        value = _VALUE.unpack_from(self.map, offset)[0]
+        _VALUE.pack_into(self.map, offset, value + amount)
+
+    def set(self, key, value):
+        offset = self.offsets.get(key) or self._add_slot(key)
+        _VALUE.pack_into(self.map, offset, value)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def read_entries(buf, used=None):
+    """Yield (key, value, offset) from a MmapValues buffer."""
+
+    if used is None:
+        used = _HEADER.unpack_from(buf, 0)[0]
+    pos = _HEADER.size
+    while pos + _KEY_LEN.size <= used:
+        length = _KEY_LEN.unpack_from(buf, pos)[0]
+        key_start = pos + _KEY_LEN.size
+        key = bytes(buf[key_start:key_start + length]).decode('utf-8')
+        offset = key_start + length + (-(_KEY_LEN.size + length) % 8)
+        yield key, _VALUE.unpack_from(buf, offset)[0], offset
+        pos = offset + _VALUE.size
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+class Registry:
+    """Records samples into this process's file and renders all of them."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.values = None
+        self.pid = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _values(self):
+        # re-open after fork so each process gets its own file
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            path = os.path.join(self.directory, 'metrics.{}.db'.format(self.pid))
+            with self._archive_lock():
+                # left by an earlier process with our pid
+                if os.path.exists(path):
+                    self._archive(path)
+                self.values = MmapValues(path)
+        return self.values
+
+    def _archive_lock(self):
+        return _FileLock(os.path.join(self.directory, 'metrics.lock'))
+
+    def _archive(self, path):
+        """Add the counters in `path` to the archive and remove it."""
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) >= _HEADER.size:
+            archive = MmapValues(os.path.join(self.directory, 'archive.db'))
+            try:
+                for key, value, offset in read_entries(data):
+                    if METRICS.get(json.loads(key)[0], ('counter',))[0] != 'gauge':
+                        archive.add(key, value)
+            finally:
+                archive.close()
+        os.remove(path)
+
+    def inc(self, name, labels, amount=1.0):
+        with self.lock:
+            self._values().add(_key(name, labels), amount)
+
+    def set(self, name, labels, value):
+        labels = dict(labels, pid=str(os.getpid()))
+        with self.lock:
+            self._values().set(_key(name, labels), value)
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            values = self._values()
+            for bound in buckets:
+                values.add(_key(name + '_bucket', dict(labels, le=str(bound))),
+                           1 if value <= bound else 0)
+            values.add(_key(name + '_bucket', dict(labels, le='+Inf')), 1)
+            values.add(_key(name + '_sum', labels), value)
+            values.add(_key(name + '_count', labels), 1)
+
+    def collect(self):
+        """Sum every process's samples into {key: value}."""
+
+        totals = {}
+        with self._archive_lock():
+            live = []
+            for path in glob.glob(os.path.join(self.directory, 'metrics.*.db')):
+                if _pid_alive(int(path.rsplit('.', 2)[1])):
+                    live.append(path)
+                else:
+                    self._archive(path)
+
+            archive = os.path.join(self.directory, 'archive.db')
+            for path in live + ([archive] if os.path.exists(archive) else []):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if len(data) < _HEADER.size:
+                    continue
+                for key, value, offset in read_entries(data):
+                    if METRICS.get(json.loads(key)[0], ('counter',))[0] == 'gauge':
+                        totals[key] = value
+                    else:
+                        totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def render(self):
+        """Prometheus text exposition of collect()."""
+
+        samples = {}
+        for key, value in self.collect().items():
+            name, labels = json.loads(key)
+            samples.setdefault(_family(name), []).append((name, labels, value))
+
+        lines = []
+        for family in sorted(samples):
+            kind, help = METRICS.get(family, ('untyped', ''))
+            lines.append('# HELP {} {}'.format(family, help))
+            lines.append('# TYPE {} {}'.format(family, kind))
+            for name, labels, value in sorted(samples[family], key=_sample_order):
+                label_text = ','.join('{}="{}"'.format(k, _escape(v))
+                                      for k, v in labels)
+                if label_text:
+                    lines.append('{}{{{}}} {}'.format(name, label_text, _number(value)))
+                else:
+                    lines.append('{} {}'.format(name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sample_order(sample):
+    name, labels, value = sample
+    plain = [(k, v) for k, v in labels if k != 'le']
+    le = dict(labels).get('le')
+    return (plain, name, float(le) if le is not None else 0.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+class _FileLock:
+    """An exclusive flock on `path` between processes, as a context manager."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _Noop:
+    def inc(self, *args, **kwargs):
+        pass
+
+    set = observe = inc
+
+
+registry = app_local('metrics', _Noop())
+_registries = {}
+_timings = threading.local()
+
+
+##############################################################################
+# Instrumentation
+
+
+class InstrumentedBcrypt(Bcrypt):
+    """Flask-Bcrypt that counts and times its work."""
+
+    def generate_password_hash(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().generate_password_hash(*args, **kwargs)
+        finally:
+            _record_bcrypt('hash', time.perf_counter() - start)
+
+    def check_password_hash(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().check_password_hash(*args, **kwargs)
+        finally:
+            _record_bcrypt('check', time.perf_counter() - start)
+
+
+def _record_bcrypt(op, seconds):
+    registry.inc('warbler_bcrypt_operations_total', {'op': op})
+    registry.inc('warbler_bcrypt_seconds_total', {'op': op}, seconds)
+
+
+def _add_timing(kind, seconds):
+    if getattr(_timings, 'active', False):
+        setattr(_timings, kind, getattr(_timings, kind, 0.0) + seconds)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # on the statement's own context, so a failed one leaves nothing behind
+    context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is not None:
+        _add_timing('db', time.perf_counter() - start)
+
+
+def _before_render(sender, template, context, **extra):
+    if getattr(_timings, 'active', False):
+        _timings.render_starts.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    starts = getattr(_timings, 'render_starts', None)
+    if starts:
+        _add_timing('render', time.perf_counter() - starts.pop())
+
+
+def instrument_pool(pool):
+    """Time how long checkouts wait on `pool`."""
+
+    if getattr(pool, '_warbler_timed', False):
+        return
+    do_get = pool._do_get
+
+    def timed_do_get():
+        start = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            registry.observe('warbler_db_pool_checkout_wait_seconds', {},
+                                 time.perf_counter() - start)
+
+    pool._do_get = timed_do_get
+    pool._warbler_timed = True
+
+
+def _pool_gauges(pool):
+    if hasattr(pool, 'size'):
+        registry.set('warbler_db_pool_size', {}, pool.size())
+    if hasattr(pool, 'checkedout'):
+        registry.set('warbler_db_pool_checked_out', {}, pool.checkedout())
+
+
+def init_metrics(app, db):
+    """Start recording metrics for `app` and serve them at /metrics."""
+
+    if not app.config['METRICS_ENABLED']:
+        return None
+
+    # apps in one process writing to one directory share its files
+    directory = app.config['METRICS_DIR']
+    if directory not in _registries:
+        _registries[directory] = Registry(directory)
+    app_registry = _registries[directory]
+
+    @app.before_request
+    def start_request_timer():
+        _timings.active = True
+        _timings.db = 0.0
+        _timings.render = 0.0
+        _timings.render_starts = []
+        g._metrics_start = time.perf_counter()
+        instrument_pool(db.get_engine().pool)
+
+    @app.after_request
+    def record_request(response):
+        _record_request(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failed_request(exc):
+        if exc is not None and '_metrics_start' in g:
+            _record_request(500)
+        _timings.active = False
+
+    def _record_request(status):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return
+        endpoint = request.endpoint or 'unknown'
+        labels = {'endpoint': endpoint}
+        app_registry.observe('warbler_request_duration_seconds', labels,
+                             time.perf_counter() - start)
+        app_registry.inc('warbler_requests_total',
+                         {'endpoint': endpoint, 'status': str(status)})
+        app_registry.inc('warbler_request_db_seconds_total', labels,
+                         getattr(_timings, 'db', 0.0))
+        app_registry.inc('warbler_request_render_seconds_total', labels,
+                         getattr(_timings, 'render', 0.0))
+        _pool_gauges(db.get_engine().pool)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    def metrics_view():
+        return Response(app_registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    app.extensions['metrics'] = app_registry
+    return app_registry
@@ -2,26 +2,41 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 
-bcrypt = Bcrypt()
+from metrics import InstrumentedBcrypt
+from snowflake import message_ids
+
+bcrypt = InstrumentedBcrypt()
 db = SQLAlchemy()
 
+# A 64-bit autoincrementing key (users need 64 bits so sharded
+# deployments can hand out snowflake ids, see sharding.py); SQLite only
+# autoincrements a plain INTEGER key
+BigKey = db.BigInteger().with_variant(db.Integer, 'sqlite')
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
 
+    # the primary key serves "who follows X"; this serves "who does X
+    # follow" (see readmodels.follow_page)
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
     )
 
     user_following_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
     )
@@ -38,13 +53,14 @@ class Likes(db.Model):
     )
 
     user_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # no foreign key: likes outlive their messages' move to the archive
+    # (see archive.py), and sharded, messages are on other shards
     message_id = db.Column(
-        db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
+        db.BigInteger,
         unique=True
     )
 
@@ -55,7 +71,7 @@ class User(db.Model):
     __tablename__ = 'users'
 
     id = db.Column(
-        db.Integer,
+        BigKey,
         primary_key=True,
     )
 
@@ -94,7 +110,8 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # the database's ON DELETE CASCADE removes them with the user
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -112,7 +129,9 @@ class User(db.Model):
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin=(Likes.user_id == id),
+        secondaryjoin="foreign(Likes.message_id) == Message.id"
     )
 
     def __repr__(self):
@@ -121,14 +140,19 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        # a key lookup on follows rather than loading self.following,
+        # which can't be joined across shards
+        follow = (Follows
+                  .query
+                  .filter(Follows.user_following_id == self.id,
+                          Follows.user_being_followed_id == other_user.id)
+                  .first())
+        return follow is not None
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -175,9 +199,12 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # time-ordered, so ORDER BY id is ORDER BY creation (see snowflake.py)
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=lambda: message_ids.next_id(),
     )
 
     text = db.Column(
@@ -188,11 +215,11 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('users.id', ondelete='CASCADE'),
         nullable=False,
     )
@@ -200,6 +227,201 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+# Postgres full-text index for message search (see search.py)
+MESSAGE_SEARCH_INDEX = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_search "
+    "ON messages USING gin (to_tsvector('english', text))")
+
+event.listen(Message.__table__, 'after_create',
+             MESSAGE_SEARCH_INDEX.execute_if(dialect='postgresql'))
+
+
+class ArchivedMessages(db.Model):
+    """A run of one user's old messages, packed together (see archive.py)."""
+
+    __tablename__ = 'message_archive'
+
+    # a user's chunks, for exports and account deletion
+    __table_args__ = (
+        db.Index('ix_message_archive_user_id', 'user_id', 'first_id'),
+    )
+
+    first_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    user_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    last_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # zlib-compressed JSON: [[id, user_id, timestamp, text], ...] by id
+    data = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+
+class ArchivedMessageIds(db.Model):
+    """Which chunk of the archive holds an archived message."""
+
+    __tablename__ = 'message_archive_ids'
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    chunk_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('message_archive.first_id', ondelete='cascade'),
+        nullable=False,
+        index=True,
+    )
+
+
+class UserName(db.Model):
+    """A username or email in use, kept on one shard so each is unique
+    across all of them (see sharding.py)."""
+
+    __tablename__ = 'user_names'
+
+    # 'username' or 'email'
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+class TrendingSnapshot(db.Model):
+    """Last saved top-K of the trending trackers (see trending.py)."""
+
+    __tablename__ = 'trending_snapshots'
+
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    key = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    taken_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class OutboxEvent(db.Model):
+    """A domain change, written in the same transaction (see outbox.py)."""
+
+    __tablename__ = 'outbox'
+
+    id = db.Column(
+        BigKey,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the user whose change this is; keeps the event on their shard
+    user_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # "host:pid" of the process that wrote it
+    origin = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class ProjectionCheckpoint(db.Model):
+    """How far a durable projection has read the outbox of one shard."""
+
+    __tablename__ = 'projection_checkpoints'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    position = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+    failures = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    retry_at = db.Column(
+        db.DateTime,
+    )
+
+    # ids stepped over as gaps, still looked for: JSON {id: when}
+    skipped = db.Column(
+        db.Text,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
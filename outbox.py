@@ -0,0 +1,444 @@
+"""Transactional outbox and the dispatcher that feeds projections.
+
+Routes record what changed with emit() before they commit, so the
+outbox row commits (or rolls back) with the change itself. Derived
+views subscribe to event kinds and get batches of events, in outbox
+order, instead of being called from the routes:
+
+- local projections keep per-process, in-memory state (timeline
+  buffers, trending). The process that wrote an event queues it on
+  commit and hands it over on the dispatcher thread, or before its
+  next request at the latest, so it reads its own writes without
+  the commit waiting on projections; every other process picks it up
+  by tailing the outbox, from where the outbox was when it started.
+- durable projections (publishing to the live stream, ...) must see
+  each event once overall. Their position is stored per shard in
+  projection_checkpoints and only moves once a batch has been handled
+  (in the same transaction as anything the handler wrote with
+  db.session); a failing batch is retried with exponential backoff,
+  and the projection waits rather than skip it.
+
+Projections register with subscribe() when projections.py is
+imported, and every app made afterwards gets its own Dispatcher for
+them (see extensions.py), with its own queue, positions and thread.
+Events are queued on the dispatcher of the app they were committed
+in, or outside an app context, of the app the session was made for.
+
+The tailing thread (OUTBOX_THREAD) polls every OUTBOX_POLL_INTERVAL
+seconds. Run durable projections in just one process: set
+OUTBOX_DURABLE in that one, or run `flask dispatch-outbox`.
+
+Outbox ids can commit out of order, so a gap in the ids is only
+stepped over once it is GAP_TIMEOUT seconds old. The ids stepped over
+are remembered (durable projections keep them in their checkpoint) and
+looked for again on every pass for GAP_RESCAN seconds, so an event
+whose transaction committed late is still delivered, just out of
+order; ids from rolled-back transactions are forgotten then.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, has_app_context
+from sqlalchemy import and_, event, func, select
+from sqlalchemy.orm import Session
+
+from extensions import app_local
+from models import db, OutboxEvent, ProjectionCheckpoint
+
+GAP_TIMEOUT = 5.0
+GAP_RESCAN = 10 * 60
+MAX_BACKOFF = 300
+
+# events deleted per statement by prune()
+PRUNE_BATCH = 1000
+
+logger = logging.getLogger('warbler.outbox')
+
+Event = namedtuple('Event', 'id kind user_id payload origin')
+
+Projection = namedtuple('Projection', 'name kinds handler durable from_start')
+
+# what subscribe() registered, handed to each app's Dispatcher
+PROJECTIONS = []
+
+_origin = (None, None)
+
+
+def origin():
+    """This process, as "host:pid" (re-read after a fork)."""
+
+    global _origin
+    pid = os.getpid()
+    if _origin[0] != pid:
+        _origin = (pid, f"{socket.gethostname()}:{pid}")
+    return _origin[1]
+
+
+def emit(kind, user_id, **payload):
+    """Add an event to the current transaction of `db.session`."""
+
+    db.session.add(OutboxEvent(kind=kind, user_id=user_id, origin=origin(),
+                               payload=json.dumps(payload)))
+
+
+def _event(row):
+    return Event(row.id, row.kind, row.user_id, json.loads(row.payload), row.origin)
+
+
+def subscribe(name, kinds, durable=False, from_start=False):
+    """Register the decorated fn(events) with the dispatchers of apps
+    created from now on; see Dispatcher.subscribe.
+    """
+
+    def decorator(fn):
+        PROJECTIONS.append(
+            Projection(name, frozenset(kinds), fn, durable, from_start))
+        return fn
+    return decorator
+
+
+class Dispatcher:
+    """Delivers outbox events to registered projections."""
+
+    def __init__(self, app=None, projections=()):
+        self.projections = list(projections)
+        self.app = app
+        shards = app.extensions.get('shards') if app else None
+        self.shards = shards.shard_ids if shards else [None]
+        self.local_positions = {}
+        self.local_skipped = {}
+        self.gaps = {}
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.deliver_lock = threading.Lock()
+        self.thread = None
+        self.wake = threading.Event()
+
+    def subscribe(self, name, kinds, durable=False, from_start=False):
+        """Register the decorated fn(events) for events of `kinds`.
+
+        A new durable projection starts at the current end of the
+        outbox, or at the beginning with `from_start`.
+        """
+
+        def decorator(fn):
+            self.projections.append(
+                Projection(name, frozenset(kinds), fn, durable, from_start))
+            return fn
+        return decorator
+
+    def _wanted(self, projection, events):
+        return [e for e in events if e.kind in projection.kinds]
+
+    def _call(self, projection, events):
+        events = self._wanted(projection, events)
+        if events:
+            projection.handler(events)
+
+    # -- local delivery ---------------------------------------------------
+
+    def deliver_local(self, events):
+        """Hand events this process just committed to local projections."""
+
+        for projection in self.projections:
+            if projection.durable:
+                continue
+            try:
+                self._call(projection, events)
+            except Exception:
+                logger.exception("local projection %s failed", projection.name)
+
+    def queue_local(self, events):
+        """Queue events this process just committed for drain()."""
+
+        with self.pending_lock:
+            self.pending.extend(events)
+        self.wake.set()
+
+    def drain(self):
+        """Deliver the queued events to local projections, in order."""
+
+        with self.deliver_lock:
+            with self.pending_lock:
+                events, self.pending = self.pending, []
+            if events:
+                self.deliver_local(events)
+
+    def _query(self, shard, after, limit):
+        query = (OutboxEvent
+                 .query
+                 .filter(OutboxEvent.id > after)
+                 .order_by(OutboxEvent.id)
+                 .limit(limit))
+        if shard is not None:
+            query = query.set_shard(shard)
+        return [_event(row) for row in query]
+
+    def head(self, shard):
+        query = db.session.query(func.max(OutboxEvent.id))
+        if shard is not None:
+            query = query.set_shard(shard)
+        return max([id or 0 for (id,) in query] or [0])
+
+    def _ready(self, key, events, position, now, skipped=None):
+        """The prefix of `events` with no young gaps before it.
+
+        Ids stepped over are added to `skipped` ({id: when}).
+        """
+
+        ready = []
+        for event in events:
+            if event.id != position + 1:
+                first_seen = self.gaps.setdefault((key, position), now)
+                if now - first_seen < GAP_TIMEOUT:
+                    break
+                if skipped is not None:
+                    skipped.update(dict.fromkeys(range(position + 1, event.id), now))
+            self.gaps.pop((key, position), None)
+            ready.append(event)
+            position = event.id
+        return ready
+
+    def _rescan(self, shard, skipped, now):
+        """Events that have since turned up in `skipped`, which loses them
+        and ids older than GAP_RESCAN.
+        """
+
+        for id, when in list(skipped.items()):
+            if now - when >= GAP_RESCAN:
+                del skipped[id]
+        if not skipped:
+            return []
+        query = (OutboxEvent
+                 .query
+                 .filter(OutboxEvent.id.in_(list(skipped)))
+                 .order_by(OutboxEvent.id))
+        if shard is not None:
+            query = query.set_shard(shard)
+        late = [_event(row) for row in query]
+        for event in late:
+            del skipped[event.id]
+        return late
+
+    def tail_local(self, batch_size=100, now=None):
+        """Deliver other processes' new events to local projections."""
+
+        now = time.time() if now is None else now
+        me = origin()
+        delivered = 0
+        for shard in self.shards:
+            position = self.local_positions.get(shard)
+            if position is None:
+                self.local_positions[shard] = self.head(shard)
+                continue
+            skipped = self.local_skipped.setdefault(shard, {})
+            late = self._rescan(shard, skipped, now)
+            events = self._ready(('local', shard),
+                                 self._query(shard, position, batch_size),
+                                 position, now, skipped)
+            if not late and not events:
+                continue
+            self.deliver_local([e for e in late + events if e.origin != me])
+            if events:
+                self.local_positions[shard] = events[-1].id
+            delivered += len(late) + len(events)
+        return delivered
+
+    # -- durable delivery -------------------------------------------------
+
+    def _checkpoint(self, projection, shard):
+        key = shard or '0'
+        checkpoint = ProjectionCheckpoint.query.get((projection.name, key))
+        if checkpoint is None:
+            position = 0 if projection.from_start else self.head(shard)
+            checkpoint = ProjectionCheckpoint(name=projection.name, shard=key,
+                                              position=position, failures=0)
+            db.session.add(checkpoint)
+        return checkpoint
+
+    def run_durable(self, batch_size=100, now=None):
+        """Deliver one batch per durable projection and shard."""
+
+        now = time.time() if now is None else now
+        delivered = 0
+        for projection in self.projections:
+            if not projection.durable:
+                continue
+            for shard in self.shards:
+                delivered += self._run_one(projection, shard, batch_size, now)
+        return delivered
+
+    def _run_one(self, projection, shard, batch_size, now):
+        checkpoint = self._checkpoint(projection, shard)
+        if checkpoint.retry_at and checkpoint.retry_at > datetime.utcfromtimestamp(now):
+            db.session.commit()
+            return 0
+
+        skipped = {int(id): when
+                   for id, when in json.loads(checkpoint.skipped or '{}').items()}
+        late = self._rescan(shard, skipped, now)
+        events = self._ready((projection.name, shard),
+                             self._query(shard, checkpoint.position, batch_size),
+                             checkpoint.position, now, skipped)
+        checkpoint.skipped = json.dumps(skipped) if skipped else None
+        if not late and not events:
+            db.session.commit()
+            return 0
+
+        try:
+            self._call(projection, late + events)
+        except Exception as e:
+            logger.exception("projection %s failed at event %s",
+                             projection.name, events[0].id)
+            db.session.rollback()
+            checkpoint = self._checkpoint(projection, shard)
+            checkpoint.failures += 1
+            checkpoint.last_error = f"{type(e).__name__}: {e}"
+            delay = min(MAX_BACKOFF, 2 ** (checkpoint.failures - 1))
+            checkpoint.retry_at = datetime.utcfromtimestamp(now) + timedelta(seconds=delay)
+            db.session.commit()
+            return 0
+
+        if events:
+            checkpoint.position = events[-1].id
+        checkpoint.failures = 0
+        checkpoint.last_error = None
+        checkpoint.retry_at = None
+        db.session.commit()
+        return len(late) + len(events)
+
+    def _connection(self, shard):
+        if shard is None:
+            return db.session.connection()
+        return db.session.connection(shard_id=shard)
+
+    def prune(self, older_than, batch_size=PRUNE_BATCH):
+        """Delete events every durable projection has read that are older
+        than `older_than` seconds, `batch_size` per statement.
+        """
+
+        cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+        outbox = OutboxEvent.__table__
+        deleted = 0
+        for shard in self.shards:
+            positions = [self._checkpoint(p, shard).position
+                         for p in self.projections if p.durable]
+            db.session.commit()
+            where = outbox.c.created_at < cutoff
+            if positions:
+                where = and_(where, outbox.c.id <= min(positions))
+            while True:
+                batch = (select([outbox.c.id]).where(where)
+                         .order_by(outbox.c.id).limit(batch_size))
+                count = self._connection(shard).execute(
+                    outbox.delete().where(outbox.c.id.in_(batch))).rowcount
+                db.session.commit()
+                deleted += count
+                if count < batch_size:
+                    break
+        return deleted
+
+    # -- background thread ------------------------------------------------
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        config = self.app.config
+        while True:
+            with self.app.app_context():
+                try:
+                    self.drain()
+                    self.tail_local(config['OUTBOX_BATCH_SIZE'])
+                    if config['OUTBOX_DURABLE']:
+                        self.run_durable(config['OUTBOX_BATCH_SIZE'])
+                except Exception:
+                    logger.exception("outbox dispatch failed")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            self.wake.wait(config['OUTBOX_POLL_INTERVAL'])
+            self.wake.clear()
+
+
+def _collect(session, flush_context):
+    # ids exist now, and no SQL may be run after the commit
+    events = sorted((_event(obj) for obj in session.new
+                     if isinstance(obj, OutboxEvent)), key=lambda e: e.id)
+    if events:
+        session.info.setdefault('outbox', []).extend(events)
+
+
+def _app_of(session):
+    if has_app_context():
+        return current_app
+    # Flask-SQLAlchemy's sessions (and sharding's) know their app
+    return getattr(session, 'app', None)
+
+
+def _deliver(session):
+    events = session.info.pop('outbox', None)
+    app = _app_of(session)
+    if events and app is not None and 'outbox' in app.extensions:
+        app.extensions['outbox'].queue_local(events)
+
+
+def _forget(session):
+    session.info.pop('outbox', None)
+
+
+event.listen(Session, 'after_flush', _collect)
+event.listen(Session, 'after_commit', _deliver)
+event.listen(Session, 'after_rollback', _forget)
+
+
+def init_outbox(app):
+    """Give `app` its own dispatcher and start it if configured.
+
+    Call after init_sharding, so it knows the shards.
+    """
+
+    app_dispatcher = Dispatcher(app, PROJECTIONS)
+    app.extensions['outbox'] = app_dispatcher
+
+    @app.before_first_request
+    def start_dispatcher():
+        if app.config['OUTBOX_THREAD']:
+            app_dispatcher.start()
+
+    # whatever the thread hasn't got to yet, so requests read their writes
+    app.before_request(app_dispatcher.drain)
+
+    @app.cli.command('dispatch-outbox')
+    @click.option('--once', is_flag=True, help="Deliver one batch and exit.")
+    def dispatch_outbox(once):
+        """Run the durable projections."""
+
+        while True:
+            count = app_dispatcher.run_durable(app.config['OUTBOX_BATCH_SIZE'])
+            if once:
+                click.echo(f"Delivered {count} events.")
+                return
+            if not count:
+                time.sleep(app.config['OUTBOX_POLL_INTERVAL'])
+
+    @app.cli.command('prune-outbox')
+    def prune_outbox():
+        """Delete delivered events older than OUTBOX_RETENTION."""
+
+        click.echo(f"Deleted {app_dispatcher.prune(app.config['OUTBOX_RETENTION'])} events.")
+
+    return app_dispatcher
+
+
+dispatcher = app_local('outbox', Dispatcher())
@@ -0,0 +1,140 @@
+"""Sampling profiler for finding where slow routes spend their time.
+
+When enabled, a fraction of requests (PROFILE_SAMPLE_RATE), plus any
+request carrying the PROFILE_HEADER header, are watched by a background
+thread that snapshots the request thread's Python stack every
+PROFILE_INTERVAL seconds. Samples are added up per endpoint and written
+as collapsed stacks, one file per endpoint and process:
+
+    PROFILE_DIR/<endpoint>.<pid>.collapsed
+
+which flamegraph.pl (or speedscope) turns into a flamegraph:
+
+    cat profiles/warbler.homepage.*.collapsed | flamegraph.pl > home.svg
+
+With neither setting on, no hooks are installed at all.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+
+
+class StackSampler:
+    """Background thread sampling the stacks of registered threads."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, thread_id):
+        """Start collecting samples for `thread_id`."""
+
+        counts = Counter()
+        with self.lock:
+            self.watched[thread_id] = counts
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return counts
+
+    def stop(self, thread_id):
+        """Stop sampling `thread_id` and return its Counter of stacks."""
+
+        with self.lock:
+            return self.watched.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.watched:
+                    self.thread = None
+                    return
+                for thread_id, counts in self.watched.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counts[collapse(frame)] += 1
+
+
+def collapse(frame):
+    """Render a stack as 'outer;...;inner' for flamegraph tools."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """Per-endpoint collapsed-stack aggregation for a Flask app."""
+
+    def __init__(self, sample_rate=0.0, header=None, directory='profiles',
+                 interval=0.005):
+        self.sample_rate = sample_rate
+        self.header = header
+        self.directory = directory
+        self.sampler = StackSampler(interval)
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def should_profile(self):
+        if self.header and self.header in request.headers:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def before_request(self):
+        if self.should_profile():
+            g._profile_thread = threading.get_ident()
+            self.sampler.start(g._profile_thread)
+
+    def teardown_request(self, exc):
+        thread_id = g.pop('_profile_thread', None)
+        if thread_id is None:
+            return
+
+        counts = self.sampler.stop(thread_id)
+        endpoint = request.endpoint or 'unknown'
+
+        with self.lock:
+            totals = self.totals.setdefault(endpoint, Counter())
+            totals.update(counts)
+            self.write(endpoint, totals)
+
+    def write(self, endpoint, totals):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory,
+                            '{}.{}.collapsed'.format(endpoint, os.getpid()))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            for stack, count in totals.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        os.replace(tmp, path)
+
+
+def init_profiler(app):
+    """Install the profiler on `app` if PROFILE_* config asks for it."""
+
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    header = app.config['PROFILE_HEADER']
+    if not sample_rate and not header:
+        return None
+
+    profiler = Profiler(sample_rate, header, app.config['PROFILE_DIR'],
+                        app.config['PROFILE_INTERVAL'])
+    app.before_request(profiler.before_request)
+    app.teardown_request(profiler.teardown_request)
+    app.extensions['profiler'] = profiler
+    return profiler
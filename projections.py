@@ -0,0 +1,95 @@
+"""Views derived from outbox events (see outbox.py).
+
+Event kinds and their payloads (every event also has the acting
+user's id as user_id):
+
+- message.created, message.deleted: message_id
+- message.imported: message_ids (a batch of old messages, see importer.py)
+- like.created, like.deleted: message_id, author_id
+- follow.created, follow.deleted: followed_id
+- user.deleted
+
+Each app's dispatcher delivers to these (see outbox.py), so the state
+they update is the app's own.
+"""
+
+from flask import current_app
+
+from followgraph import follow_graph
+from outbox import subscribe
+from readmodels import message_rows
+from search import message_index
+from timelines import recent_messages, high_water_marks
+from trending import trending
+
+
+@subscribe('timelines', {'message.created', 'message.deleted',
+                         'message.imported',
+                         'follow.created', 'follow.deleted',
+                         'user.deleted'})
+def update_timelines(events):
+    """Keep this process's timeline buffers and high-water marks fresh."""
+
+    for event in events:
+        if event.kind.startswith('follow.'):
+            high_water_marks.forget(event.user_id)
+            continue
+        recent_messages.invalidate(event.user_id)
+        if event.kind == 'message.created':
+            high_water_marks.bump(event.user_id, event.payload['message_id'])
+
+
+@subscribe('follow_graph', {'follow.created', 'follow.deleted',
+                            'user.deleted'})
+def update_follow_graph(events):
+    """Keep this process's follow graph current."""
+
+    for event in events:
+        if event.kind == 'follow.created':
+            follow_graph.add(event.user_id, event.payload['followed_id'])
+        elif event.kind == 'follow.deleted':
+            follow_graph.remove(event.user_id, event.payload['followed_id'])
+        else:
+            follow_graph.remove_user(event.user_id)
+
+
+@subscribe('trending', {'message.created', 'like.created', 'like.deleted'})
+def update_trending(events):
+    """Count posts and net likes in this process's trending trackers."""
+
+    for event in events:
+        if event.kind == 'like.created':
+            trending.record_like(event.payload['message_id'],
+                                 event.payload['author_id'])
+        elif event.kind == 'like.deleted':
+            trending.record_unlike(event.payload['message_id'],
+                                   event.payload['author_id'])
+        elif event.kind == 'message.created':
+            trending.record_message(event.user_id)
+
+
+@subscribe('search', {'message.created', 'message.deleted',
+                      'message.imported'})
+def update_search(events):
+    """Keep this process's in-memory search index current."""
+
+    for event in events:
+        if event.kind == 'message.created':
+            message_index.created(event.payload['message_id'])
+        elif event.kind == 'message.imported':
+            for id in event.payload['message_ids']:
+                message_index.created(id)
+        else:
+            message_index.remove(event.payload['message_id'])
+
+
+@subscribe('live', {'message.created'}, durable=True)
+def publish_live(events):
+    """Send new messages to the live stream server, once each."""
+
+    if not current_app.config['LIVE_STREAM_URL']:
+        return
+
+    from live import publish_message
+    for msg in message_rows([event.payload['message_id'] for event in events]):
+        publish_message(msg)
@@ -0,0 +1,237 @@
+"""Token-bucket rate limits for expensive POSTs.
+
+RATELIMIT_LIMITS maps an endpoint to limits per scope:
+
+    'warbler.login': {'ip': '10/minute', 'username': '5/minute'}
+
+- ip: the client address (put werkzeug's ProxyFix in front when behind
+  a proxy, so this is the client and not the proxy)
+- user: the logged-in user id, read from the signed session cookie
+- username: the submitted `username` form field, from the client
+  address; keyed on both, so guessing at someone's password from one
+  address can't lock them out from everywhere else
+
+"N/period" is a bucket of N tokens refilled at N per period (second,
+minute, hour or day); each POST takes a token from every bucket that
+applies, and only if all of them have one. Over the limit the client
+gets a plain 429 with Retry-After from a hook that runs before any
+that use the database, so it costs no query and no bcrypt work.
+
+Buckets live in a SQLite file (RATELIMIT_STORE = 'file', at
+RATELIMIT_PATH) shared by every worker on the host, or in process
+memory ('memory').
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import Response, request, session
+
+import metrics
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 60 * 60, 'day': 24 * 60 * 60}
+
+# drop buckets that have refilled completely every this many takes
+PRUNE_EVERY = 1000
+
+
+def parse_limit(limit):
+    """'10/minute' -> (rate in tokens per second, burst)."""
+
+    count, _, period = limit.partition('/')
+    count = int(count)
+    return count / PERIODS[period.strip().rstrip('s')], count
+
+
+def refill(tokens, updated, rate, burst, now):
+    """Tokens in a bucket last left at `tokens` at time `updated`."""
+
+    if tokens is None:
+        return float(burst)
+    return min(float(burst), tokens + (now - updated) * rate)
+
+
+def _take(current, buckets, now):
+    """Work out one take across `buckets`.
+
+    `current` maps key -> (tokens, updated) or None. Returns (seconds
+    to wait, 0 if allowed; {key: (tokens, updated, full_at)} to save).
+    """
+
+    levels = {}
+    wait = 0.0
+    for key, rate, burst in buckets:
+        tokens = refill(*(current.get(key) or (None, None)), rate, burst, now)
+        levels[key] = (tokens, rate, burst)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+
+    if wait:
+        return wait, {}
+    saved = {}
+    for key, (tokens, rate, burst) in levels.items():
+        tokens -= 1
+        saved[key] = (tokens, now, now + (burst - tokens) / rate)
+    return 0.0, saved
+
+
+class MemoryStore:
+    """Buckets in this process only."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.takes = 0
+        self.lock = threading.RLock()
+
+    def take(self, buckets, now=None):
+        """Take a token from each of `buckets` ((key, rate, burst), ...)
+        if all have one; returns 0, or the seconds until they would.
+        """
+
+        now = time.time() if now is None else now
+        with self.lock:
+            current = {key: self.buckets[key][:2]
+                       for key, rate, burst in buckets if key in self.buckets}
+            wait, saved = _take(current, buckets, now)
+            self.buckets.update(saved)
+            self.takes += 1
+            if self.takes % PRUNE_EVERY == 0:
+                self.prune(now)
+        return wait
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                            if bucket[2] > now}
+
+
+class FileStore:
+    """Buckets in a local SQLite file shared by all processes on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.takes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            ' key TEXT PRIMARY KEY, tokens REAL NOT NULL,'
+            ' updated REAL NOT NULL, full_at REAL NOT NULL)')
+
+    def _conn(self):
+        # one connection per thread and process
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, buckets, now=None):
+        """Take a token from each of `buckets` ((key, rate, burst), ...)
+        if all have one; returns 0, or the seconds until they would.
+        """
+
+        now = time.time() if now is None else now
+        keys = [key for key, rate, burst in buckets]
+        conn = self._conn()
+        # IMMEDIATE takes the write lock up front, so no other process
+        # can spend the same tokens between our read and write
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = {key: (tokens, updated) for key, tokens, updated in conn.execute(
+                'SELECT key, tokens, updated FROM buckets WHERE key IN ({})'
+                .format(','.join('?' * len(keys))), keys)}
+            wait, saved = _take(current, buckets, now)
+            conn.executemany('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)',
+                             [(key,) + values for key, values in saved.items()])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        self.takes += 1
+        if self.takes % PRUNE_EVERY == 0:
+            self.prune(now)
+        return wait
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        self._conn().execute('DELETE FROM buckets WHERE full_at <= ?', (now,))
+
+
+class RateLimiter:
+    """Checks each request against RATELIMIT_LIMITS."""
+
+    def __init__(self, store, limits, user_key):
+        self.store = store
+        self.limits = {endpoint: {scope: parse_limit(limit)
+                                  for scope, limit in scopes.items()}
+                       for endpoint, scopes in limits.items()}
+        self.user_key = user_key
+
+    def _identity(self, scope):
+        if scope == 'ip':
+            return request.remote_addr
+        if scope == 'user':
+            return session.get(self.user_key)
+        if scope == 'username':
+            username = request.form.get('username')
+            return f"{request.remote_addr}:{username}" if username else None
+        raise ValueError(f"unknown rate limit scope {scope!r}")
+
+    def check(self):
+        """before_request hook: a 429 response when over the limit."""
+
+        if request.method != 'POST':
+            return None
+        limits = self.limits.get(request.endpoint)
+        if not limits:
+            return None
+
+        buckets = []
+        for scope, (rate, burst) in limits.items():
+            who = self._identity(scope)
+            if who is not None:
+                buckets.append((f"{request.endpoint}:{scope}:{who}", rate, burst))
+        if not buckets:
+            return None
+
+        wait = self.store.take(buckets)
+        if not wait:
+            return None
+
+        metrics.registry.inc('warbler_rate_limited_total',
+                             {'endpoint': request.endpoint})
+        return Response('Too many requests, slow down.\n', 429,
+                        {'Retry-After': str(math.ceil(wait))},
+                        mimetype='text/plain')
+
+
+def init_rate_limits(app, user_key):
+    """Limit the endpoints in RATELIMIT_LIMITS, if RATELIMIT_ENABLED.
+
+    `user_key` is the session key holding the logged-in user's id.
+    Call before any before_request hook that touches the database is
+    registered, so a refused request never reaches it.
+    """
+
+    if not app.config['RATELIMIT_ENABLED']:
+        return None
+
+    if app.config['RATELIMIT_STORE'] == 'file':
+        store = FileStore(app.config['RATELIMIT_PATH'])
+    else:
+        store = MemoryStore()
+
+    limiter = RateLimiter(store, app.config['RATELIMIT_LIMITS'], user_key)
+    app.before_request(limiter.check)
+    app.extensions['rate_limiter'] = limiter
+    return limiter
@@ -0,0 +1,163 @@
+"""Lightweight read models for hot pages.
+
+Pages like the home timeline only render a handful of columns, so
+instead of full ORM entities (every column, an identity-map entry and
+change tracking each) these queries select just those columns into
+small rows:
+
+- AuthorRow: id, username, image_url
+- MessageRow: id, text, timestamp and its AuthorRow (shared between
+  messages by the same author)
+- UserStats: message/following/follower/like counts in one query
+- UserCard: what a follower/following card shows
+
+plus id-only queries for follow sets and keyset-paginated follow
+listings. Rows are read-only; use the
+models for anything that writes.
+
+bench_read_models.py compares the memory these use with the ORM path.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import func, select
+
+from models import db, Follows, Likes, Message, User
+
+AuthorRow = namedtuple('AuthorRow', 'id username image_url')
+
+UserStats = namedtuple('UserStats', 'messages following followers likes')
+
+UserCard = namedtuple('UserCard', 'id username image_url header_image_url bio')
+
+FOLLOW_PAGE_SIZE = 60
+
+
+class MessageRow:
+    """What a timeline needs to render one message."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user')
+
+    def __init__(self, id, text, timestamp, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user = user
+
+    def __repr__(self):
+        return f"<MessageRow #{self.id}: @{self.user.username}>"
+
+
+def followed_ids(user_id):
+    """Ids of the users `user_id` follows."""
+
+    return [id for (id,) in (db.session
+                             .query(Follows.user_being_followed_id)
+                             .filter(Follows.user_following_id == user_id))]
+
+
+def follower_ids(user_id):
+    """Ids of the users following `user_id`."""
+
+    return [id for (id,) in (db.session
+                             .query(Follows.user_following_id)
+                             .filter(Follows.user_being_followed_id == user_id))]
+
+
+def followed_among(user_id, ids):
+    """The subset of `ids` that `user_id` follows, in one query."""
+
+    if not ids:
+        return set()
+    return {id for (id,) in (db.session
+                             .query(Follows.user_being_followed_id)
+                             .filter(Follows.user_following_id == user_id,
+                                     Follows.user_being_followed_id.in_(ids)))}
+
+
+def follow_page(user_id, followers=False, after=0, limit=FOLLOW_PAGE_SIZE):
+    """One page of the users `user_id` follows (or their followers).
+
+    Users come in id order, starting after id `after`; returns
+    ([UserCard, ...], the `after` of the next page or None). Each page
+    is an index range scan, however deep it is.
+    """
+
+    if followers:
+        other, this = Follows.user_following_id, Follows.user_being_followed_id
+    else:
+        other, this = Follows.user_being_followed_id, Follows.user_following_id
+
+    ids = [id for (id,) in (db.session
+                            .query(other)
+                            .filter(this == user_id, other > after)
+                            .order_by(other)
+                            .limit(limit + 1))]
+    # sharded, followers come from every shard; each sends its first page
+    ids = sorted(ids)[:limit + 1]
+
+    next_after = ids[limit - 1] if len(ids) > limit else None
+    return user_cards(ids[:limit]), next_after
+
+
+def user_cards(ids):
+    """UserCards for `ids`, in the order of `ids`."""
+
+    if not ids:
+        return []
+    found = {row.id: UserCard(*row)
+             for row in (db.session
+                         .query(User.id, User.username, User.image_url,
+                                User.header_image_url, User.bio)
+                         .filter(User.id.in_(ids)))}
+    return [found[id] for id in ids if id in found]
+
+
+def author_rows(ids):
+    """AuthorRows for `ids`, in the order of `ids`."""
+
+    if not ids:
+        return []
+    found = {row.id: AuthorRow(*row)
+             for row in (db.session
+                         .query(User.id, User.username, User.image_url)
+                         .filter(User.id.in_(ids)))}
+    return [found[id] for id in ids if id in found]
+
+
+def message_rows(ids):
+    """MessageRows for `ids`, in the order of `ids`, in one query."""
+
+    if not ids:
+        return []
+
+    authors = {}
+    found = {}
+    for (id, text, timestamp,
+         user_id, username, image_url) in (db.session
+                                           .query(Message.id, Message.text,
+                                                  Message.timestamp, User.id,
+                                                  User.username, User.image_url)
+                                           .join(User, Message.user_id == User.id)
+                                           .filter(Message.id.in_(ids))):
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = AuthorRow(user_id, username, image_url)
+        found[id] = MessageRow(id, text, timestamp, author)
+    return [found[id] for id in ids if id in found]
+
+
+def user_stats(user_id):
+    """Counts for a user's profile card, in one query."""
+
+    def count(column, where):
+        return select([func.count(column)]).where(where).as_scalar()
+
+    rows = db.session.query(
+        count(Message.id, Message.user_id == user_id),
+        count(Follows.user_being_followed_id, Follows.user_following_id == user_id),
+        count(Follows.user_following_id, Follows.user_being_followed_id == user_id),
+        count(Likes.id, Likes.user_id == user_id),
+    ).all()
+    # one row per database; more than one when sharded
+    return UserStats(*(sum(column) for column in zip(*rows)))
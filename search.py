@@ -0,0 +1,345 @@
+"""Full-text search over message text.
+
+On Postgres, search uses a GIN index on to_tsvector('english', text)
+(created with the tables; run `flask create-search-index` on an
+existing database) and ranks matches with ts_rank.
+
+Elsewhere (SQLite in development and tests) each app keeps an
+inverted index in memory instead (see extensions.py): for every term, the ids of the
+messages using it and how often, as a delta-encoded varint byte
+string. It is read from the messages table on the first search and
+then kept up to date from message.created / message.deleted outbox
+events (see projections.py). Matches must contain every query term
+and are ranked by tf-idf.
+
+Either way results come newest-first within equal rank, a page at a
+time: search() returns one page plus a cursor naming its last result,
+and passing that cursor back continues after it.
+"""
+
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left
+
+import click
+from flask import current_app
+from sqlalchemy import cast, func, or_, and_
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from extensions import app_local
+from models import db, Message, MESSAGE_SEARCH_INDEX
+from readmodels import message_rows
+
+PAGE_SIZE = 20
+LOAD_BATCH = 5000
+
+# rebuild posting lists once this share of the indexed messages is deleted
+COMPACT_RATIO = 0.2
+
+# what Postgres' 'english' configuration would also leave out
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for if in into is it its no not of on or
+    so such that the their then there these they this to was will with
+""".split())
+
+TOKEN = re.compile(r"\w+")
+
+
+def terms(text):
+    """Lowercased words of `text`, without stop words."""
+
+    return [word for word in TOKEN.findall(text.lower())
+            if word not in STOP_WORDS]
+
+
+def format_cursor(rank, id):
+    return f"{rank!r}:{id}"
+
+
+def parse_cursor(cursor):
+    """(rank, id) from a cursor string, or None if it isn't one."""
+
+    try:
+        rank, id = cursor.split(':')
+        return float(rank), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _put_varint(buf, n):
+    while n >= 0x80:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _get_varint(buf, i):
+    n = shift = 0
+    while True:
+        byte = buf[i]
+        i += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, i
+        shift += 7
+
+
+class PostingList:
+    """(message id, term count) pairs in id order, delta-encoded."""
+
+    __slots__ = ('data', 'last', 'count')
+
+    def __init__(self, pairs=()):
+        self.data = bytearray()
+        self.last = 0
+        self.count = 0
+        for id, tf in pairs:
+            self._append(id, tf)
+
+    def _append(self, id, tf):
+        _put_varint(self.data, id - self.last)
+        _put_varint(self.data, tf)
+        self.last = id
+        self.count += 1
+
+    def __iter__(self):
+        data = self.data
+        id = i = 0
+        while i < len(data):
+            delta, i = _get_varint(data, i)
+            tf, i = _get_varint(data, i)
+            id += delta
+            yield id, tf
+
+    def __len__(self):
+        return self.count
+
+    def add(self, id, tf):
+        """Add `id`; ids are time-ordered, so this is nearly always an append."""
+
+        if id > self.last:
+            self._append(id, tf)
+            return
+        pairs = dict(self)
+        if id not in pairs:
+            pairs[id] = tf
+            self.__init__(sorted(pairs.items()))
+
+    def without(self, ids):
+        return PostingList((id, tf) for id, tf in self if id not in ids)
+
+
+class InvertedIndex:
+    """An in-memory inverted index of message text."""
+
+    def __init__(self, compact_ratio=COMPACT_RATIO):
+        self.compact_ratio = compact_ratio
+        self.postings = {}
+        self.ids = array('q')
+        self.deleted = set()
+        self.loaded = False
+        self.pending = set()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, text):
+        """Index message `id` with `text` (again adding it is a no-op)."""
+
+        counts = {}
+        for term in terms(text):
+            counts[term] = counts.get(term, 0) + 1
+
+        with self.lock:
+            i = bisect_left(self.ids, id)
+            if i < len(self.ids) and self.ids[i] == id:
+                return
+            self.ids.insert(i, id)
+            self.deleted.discard(id)
+            for term, tf in counts.items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = PostingList()
+                postings.add(id, tf)
+
+    def remove(self, id):
+        """Drop message `id`; its postings are skipped until compacted."""
+
+        with self.lock:
+            self.pending.discard(id)
+            i = bisect_left(self.ids, id)
+            if i == len(self.ids) or self.ids[i] != id:
+                return
+            del self.ids[i]
+            self.deleted.add(id)
+            if len(self.deleted) > self.compact_ratio * max(len(self.ids), 1):
+                self.compact()
+
+    def compact(self):
+        """Rewrite the posting lists without deleted messages."""
+
+        with self.lock:
+            deleted = self.deleted
+            postings = {}
+            for term, old in self.postings.items():
+                new = old.without(deleted)
+                if new.count:
+                    postings[term] = new
+            self.postings = postings
+            self.deleted = set()
+
+    def clear(self):
+        with self.lock:
+            self.postings = {}
+            self.ids = array('q')
+            self.deleted = set()
+            self.pending = set()
+            self.loaded = False
+
+    def created(self, id):
+        """Note that message `id` was committed; it is read on next search."""
+
+        with self.lock:
+            if self.loaded:
+                self.pending.add(id)
+
+    def _refresh(self):
+        """Read all messages on first use, then any pending new ones."""
+
+        with self.lock:
+            if not self.loaded:
+                after = 0
+                while True:
+                    rows = sorted(db.session
+                                  .query(Message.id, Message.text)
+                                  .filter(Message.id > after)
+                                  .order_by(Message.id)
+                                  .limit(LOAD_BATCH))
+                    # sharded, every shard returns a batch; keep the
+                    # lowest ids so no shard is skipped past
+                    for id, text in rows[:LOAD_BATCH]:
+                        self.add(id, text)
+                    if len(rows) < LOAD_BATCH:
+                        break
+                    after = rows[LOAD_BATCH - 1][0]
+                self.loaded = True
+
+            if self.pending:
+                ids, self.pending = list(self.pending), set()
+                for id, text in (db.session
+                                 .query(Message.id, Message.text)
+                                 .filter(Message.id.in_(ids))):
+                    self.add(id, text)
+
+    def search(self, query, after=None, limit=PAGE_SIZE):
+        """[(rank, id), ...] for the best `limit` matches past `after`."""
+
+        words = set(terms(query))
+        if not words:
+            return []
+
+        self._refresh()
+
+        with self.lock:
+            lists = [self.postings.get(word) for word in words]
+            if not all(lists):
+                return []
+            lists.sort(key=len)
+            total = len(self.ids)
+
+            scores = None
+            for postings in lists:
+                idf = math.log(1 + total / len(postings))
+                weights = {id: (1 + math.log(tf)) * idf
+                           for id, tf in postings
+                           if id not in self.deleted and
+                           (scores is None or id in scores)}
+                if scores is None:
+                    scores = weights
+                else:
+                    scores = {id: scores[id] + weight
+                              for id, weight in weights.items()}
+                if not scores:
+                    return []
+
+        found = [(rank, id) for id, rank in scores.items()]
+        if after is not None:
+            found = [hit for hit in found if hit < after]
+        found.sort(reverse=True)
+        return found[:limit]
+
+
+def _postgres_search(query, after, limit):
+    vector = func.to_tsvector('english', Message.text)
+    tsquery = func.plainto_tsquery('english', query)
+    # ts_rank is a real; as a double the rank read and the cursor
+    # compared against it are the same number
+    rank = cast(func.ts_rank(vector, tsquery), DOUBLE_PRECISION)
+
+    q = (db.session
+         .query(rank, Message.id)
+         .filter(vector.op('@@')(tsquery)))
+    if after is not None:
+        q = q.filter(or_(rank < after[0],
+                         and_(rank == after[0], Message.id < after[1])))
+    hits = q.order_by(rank.desc(), Message.id.desc()).limit(limit)
+
+    # sharded, each shard returns its own best `limit`
+    return sorted(((float(r), id) for r, id in hits), reverse=True)[:limit]
+
+
+def use_postgres():
+    backend = current_app.config['SEARCH_BACKEND']
+    if backend == 'auto':
+        return db.engine.dialect.name == 'postgresql'
+    return backend == 'postgres'
+
+
+def search(query, cursor=None, limit=PAGE_SIZE):
+    """A page of MessageRows best matching `query`, and the next cursor.
+
+    The cursor is None on the last page.
+    """
+
+    after = parse_cursor(cursor) if cursor else None
+    postgres = use_postgres()
+    if postgres:
+        hits = _postgres_search(query, after, limit + 1)
+    else:
+        hits = message_index.search(query, after, limit + 1)
+
+    page = hits[:limit]
+    messages = message_rows([id for rank, id in page])
+    if not postgres and len(messages) < len(page):
+        # deleted along with their author; no event names them
+        for id in {id for rank, id in page} - {msg.id for msg in messages}:
+            message_index.remove(id)
+
+    next_cursor = format_cursor(*page[-1]) if len(hits) > limit else None
+    return messages, next_cursor
+
+
+def init_search(app):
+    """Give `app` its own in-memory index and add the
+    `flask create-search-index` command.
+    """
+
+    app.extensions['message_index'] = InvertedIndex()
+
+    @app.cli.command('create-search-index')
+    def create_search_index():
+        """Create the Postgres full-text index on messages."""
+
+        shards = app.extensions.get('shards')
+        engines = shards.engines.values() if shards else [db.engine]
+        for engine in engines:
+            if engine.dialect.name == 'postgresql':
+                with engine.begin() as conn:
+                    conn.execute(MESSAGE_SEARCH_INDEX)
+        click.echo("created the search index")
+
+
+message_index = app_local('message_index', InvertedIndex())
@@ -1,8 +1,12 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
+from app import create_app
+from models import db, User, Message, Follows
+from snowflake import message_ids
+
+app = create_app()
 
 
 db.drop_all()
@@ -11,8 +15,15 @@ db.create_all()
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+# give historical messages ids from their own timestamps so that id
+# order is still time order
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    rows = list(DictReader(messages))
+    for i, row in enumerate(rows):
+        row['timestamp'] = datetime.strptime(row['timestamp'],
+                                             '%Y-%m-%d %H:%M:%S.%f')
+        row['id'] = message_ids.id_for(row['timestamp'], sequence=i)
+    db.session.bulk_insert_mappings(Message, rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,357 @@
+"""Preforking production server for Warbler.
+
+    python serve.py --bind 0.0.0.0:8000 --config prod
+
+The master process builds the app once (importing every module and,
+with TEMPLATE_WARM, compiling the templates) and then forks workers
+that share that memory copy-on-write. Each worker serves the one
+listening socket from a pool of threads.
+
+After the fork each worker throws away any database connections
+inherited from the master (connections can't be shared between
+processes) and takes WORKER_ID (default 0) + its slot as its
+message-id worker id (see snowflake.py), so give each host a block of
+SERVER_WORKERS ids. Only the worker in slot 0 runs the durable outbox
+projections (see outbox.py), so each event is published once.
+
+A worker accepts at most two connections per thread, one being served
+and one waiting; the rest wait in the listen queue for whichever
+worker frees up first.
+
+A worker is recycled once it has served SERVER_MAX_REQUESTS requests
+(give or take SERVER_MAX_REQUESTS_JITTER, so workers don't all restart
+at once) or its resident memory passes SERVER_MAX_MEMORY_MB: it stops
+accepting, finishes the requests it has, exits, and the master starts
+a fresh one. SIGHUP recycles every worker this way; SIGTERM or SIGINT
+shuts down, killing workers still busy after SERVER_GRACEFUL_TIMEOUT.
+"""
+
+import argparse
+import os
+import random
+import resource
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+from app import create_app
+from cache import init_cache
+from models import db
+from snowflake import generator_for, IMPORT_WORKER
+
+# don't restart a slot more often than this, should workers keep dying
+MIN_WORKER_LIFETIME = 1.0
+
+# requests mostly wait on the database, so a few threads per core,
+# shared out between the workers
+THREADS_PER_CORE = 4
+
+# connections a worker takes on per thread: one served, one waiting
+CONNECTIONS_PER_THREAD = 2
+
+
+def cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_workers():
+    return max(2, cores())
+
+
+def default_threads(workers):
+    return max(1, (THREADS_PER_CORE * cores() + workers - 1) // workers)
+
+
+def rss_mb():
+    """This process's resident memory in MB."""
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        # peak rather than current, in KB (bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def dispose_engines(app):
+    """Drop pooled connections, e.g. ones inherited across a fork."""
+
+    with app.app_context():
+        db.get_engine(app).dispose()
+    shards = app.extensions.get('shards')
+    if shards:
+        for engine in shards.engines.values():
+            engine.dispose()
+
+
+def reset_after_fork(app, slot):
+    """Make a freshly forked worker safe to serve from."""
+
+    dispose_engines(app)
+    base = int(app.config['WORKER_ID'] or 0)
+    app.extensions['message_ids'] = generator_for((base + slot) % IMPORT_WORKER)
+    if slot != 0:
+        app.config['OUTBOX_DURABLE'] = False
+
+
+class Recycler:
+    """WSGI middleware asking for a restart once a worker has done enough."""
+
+    def __init__(self, app, max_requests=None, max_memory_mb=None,
+                 on_limit=None):
+        self.app = app
+        self.max_requests = max_requests
+        self.max_memory_mb = max_memory_mb
+        self.on_limit = on_limit
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self.lock:
+                self.requests += 1
+                done = self.requests
+            if self._over_limit(done) and self.on_limit:
+                self.on_limit()
+
+    def _over_limit(self, requests):
+        if self.max_requests and requests >= self.max_requests:
+            return True
+        return bool(self.max_memory_mb) and rss_mb() >= self.max_memory_mb
+
+
+class PoolServer(BaseWSGIServer):
+    """A WSGI server on an inherited socket, handling requests on a
+    fixed pool of threads.
+    """
+
+    multithread = True
+
+    def __init__(self, host, app, fd, threads):
+        super().__init__(host, 0, app, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(threads * CONNECTIONS_PER_THREAD)
+        self.stopping = False
+
+    def get_request(self):
+        # full up, leave connections in the listen queue for other workers
+        self.slots.acquire()
+        try:
+            return super().get_request()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def process_request(self, request, client_address):
+        try:
+            self.pool.submit(self._handle, request, client_address)
+        except RuntimeError:
+            # the pool is shutting down
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def stop(self):
+        """Stop accepting; serve_forever() returns once it notices."""
+
+        if not self.stopping:
+            self.stopping = True
+            # shutdown() waits for serve_forever(), so not on its thread
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def server_close(self):
+        # finish the requests already accepted
+        self.pool.shutdown(wait=True)
+        super().server_close()
+
+
+def run_worker(app, host, sock, slot, threads, max_requests, max_memory_mb):
+    """A worker's life: serve until told to stop or recycled, then exit."""
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    reset_after_fork(app, slot)
+
+    recycler = Recycler(app, max_requests, max_memory_mb)
+    server = PoolServer(host, recycler, sock.fileno(), threads)
+    recycler.on_limit = server.stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class Master:
+    """Forks and watches the workers."""
+
+    def __init__(self, app, host, port, workers, threads, max_requests=None,
+                 max_requests_jitter=0.0, max_memory_mb=None,
+                 graceful_timeout=30, backlog=2048):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_memory_mb = max_memory_mb
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+        self.sock = None
+
+    def listen(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(self.backlog)
+        self.sock.set_inheritable(True)
+        self.port = self.sock.getsockname()[1]
+        return self.sock
+
+    def _max_requests(self):
+        if not self.max_requests:
+            return None
+        jitter = int(self.max_requests * self.max_requests_jitter)
+        return self.max_requests + random.randint(0, jitter)
+
+    def spawn(self, slot):
+        self.started[slot] = time.time()
+        max_requests = self._max_requests()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.app, self.host, self.sock, slot, self.threads,
+                           max_requests, self.max_memory_mb)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self.children[pid] = slot
+
+    def reap(self):
+        """Collect exited workers and start replacements."""
+
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self.children.pop(pid, None)
+            if slot is None or self.stopping:
+                continue
+            if time.time() - self.started[slot] < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn(slot)
+
+    def signal_workers(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        """Serve until SIGTERM/SIGINT."""
+
+        if self.sock is None:
+            self.listen()
+        # nothing inherited by the workers may hold a connection
+        dispose_engines(self.app)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: self.signal_workers(signal.SIGTERM))
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while not self.stopping:
+            self.reap()
+            time.sleep(0.1)
+
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.signal_workers(signal.SIGKILL)
+        while self.children:
+            pid, status = os.wait()
+            self.children.pop(pid, None)
+        self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--bind', default=os.environ.get('BIND', '127.0.0.1:8000'),
+                        help="host:port to listen on")
+    parser.add_argument('--config', default=None,
+                        help="config profile (default: WARBLER_CONFIG or dev)")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--max-requests', type=int, default=None)
+    parser.add_argument('--max-memory-mb', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    app = create_app(args.config)
+    config = app.config
+
+    workers = args.workers or config['SERVER_WORKERS'] or default_workers()
+    # with CACHE_BACKEND 'auto', share the cache if there are several
+    init_cache(app, workers)
+
+    host, _, port = args.bind.rpartition(':')
+    master = Master(
+        app, host.strip('[]') or '0.0.0.0', int(port),
+        workers=workers,
+        threads=args.threads or config['SERVER_THREADS'] or default_threads(workers),
+        max_requests=args.max_requests or config['SERVER_MAX_REQUESTS'],
+        max_requests_jitter=config['SERVER_MAX_REQUESTS_JITTER'],
+        max_memory_mb=args.max_memory_mb or config['SERVER_MAX_MEMORY_MB'],
+        graceful_timeout=config['SERVER_GRACEFUL_TIMEOUT'])
+    master.listen()
+    print(f"warbler: {master.workers} workers x {master.threads} threads "
+          f"on {host}:{master.port}", flush=True)
+    master.run()
+
+
+if __name__ == '__main__':
+    main()
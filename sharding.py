@@ -0,0 +1,441 @@
+"""Optional horizontal sharding of user-owned rows by user id.
+
+With SHARD_URLS set to N database URLs, each user's row, their
+messages, their likes and the follows they made live on shard
+shard_for(user_id) — a hash of the user id, so ids spread evenly.
+The tables that aren't per-user (trending_snapshots, user_names) live
+on shard 0, which is also what `db.engine` points at.
+
+For an app with shards, `db.session` hands out a routing session built
+on SQLAlchemy's ShardedSession and `Model.query` builds its shard-aware
+queries, so the routes keep using both unchanged (apps without
+SHARD_URLS, even in the same process, keep plain sessions):
+
+- writes go to the shard of the row's owner;
+- Model.query.get() goes straight to the owner's shard for users and
+  tries every shard for everything else;
+- queries whose WHERE pins an owner column (users.id, messages.user_id,
+  likes.user_id, follows.user_following_id) to values go to those
+  shards; all other queries scatter to every shard and the results are
+  concatenated, so callers that sort or limit across users must merge
+  (see timeline_since and users_like in app.py).
+
+New users get app-generated ids (see snowflake.py) so a user's shard is
+known before the row exists. A user's shard only enforces uniqueness
+among its own users, so every username and email is also claimed in
+user_names on shard 0, in the same flush that writes the user; a name
+someone else holds fails the flush with an IntegrityError before any
+user row is written.
+
+Foreign keys that would cross shards (follows.user_being_followed_id)
+are not created on shards, and likes.message_id has none anyway (see
+archive.py); their cascades are done by delete_user_references() and
+delete_message_references(). The shards commit one after another,
+not atomically, so a failure part way through a commit can leave
+likes or follows pointing at a deleted row, or user_names out of step
+with users. `flask sweep-shards` (sweep()) finds and removes what
+those cleanups missed; it can be run any time, as often as wanted.
+
+Create the tables on every shard with `flask create-shards`, then run
+`flask sweep-shards` once to claim the names of existing users.
+"""
+
+import struct
+import zlib
+
+import click
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import create_engine, event, inspect, select
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.orm import class_mapper, sessionmaker
+from sqlalchemy.orm.exc import UnmappedClassError
+from sqlalchemy.schema import Column, CreateIndex, CreateTable
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import (BinaryExpression, BindParameter,
+                                     BooleanClauseList, ClauseList)
+
+from models import (db, ArchivedMessageIds, ArchivedMessages, Follows, Likes,
+                    Message, OutboxEvent, User, UserName)
+from snowflake import message_ids
+
+# (table, column) pairs naming the user that owns a row
+OWNER_COLUMNS = {
+    ('users', 'id'),
+    ('messages', 'user_id'),
+    ('likes', 'user_id'),
+    ('follows', 'user_following_id'),
+    ('outbox', 'user_id'),
+    ('message_archive', 'user_id'),
+}
+
+# tables kept whole on shard 0
+GLOBAL_TABLES = {'trending_snapshots', 'user_names'}
+
+# rows checked per query by sweep()
+SWEEP_BATCH = 500
+
+# foreign keys whose target usually lives on another shard
+CROSS_SHARD_KEYS = {
+    ('follows', 'user_being_followed_id'),
+}
+
+
+def shard_for(user_id, shard_count):
+    """The shard id ('0'...'N-1') holding `user_id`'s rows."""
+
+    return str(zlib.crc32(struct.pack('>q', int(user_id))) % shard_count)
+
+
+def owner_of(instance):
+    """The user id that owns `instance`, or None for unowned rows."""
+
+    if isinstance(instance, User):
+        return instance.id
+    if isinstance(instance, (Message, Likes, OutboxEvent, ArchivedMessages)):
+        return instance.user_id
+    if isinstance(instance, Follows):
+        return instance.user_following_id
+    return None
+
+
+def owner_values(clause):
+    """The owner ids a WHERE clause limits its rows to, or None.
+
+    Only `column == value` and `column IN (values)` on OWNER_COLUMNS,
+    alone or ANDed with other conditions, are understood.
+    """
+
+    if clause is None:
+        return None
+
+    if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+        found = None
+        for part in clause.clauses:
+            values = owner_values(part)
+            if values is not None:
+                found = values if found is None else found & values
+        return found
+
+    if isinstance(clause, BinaryExpression):
+        column = clause.left
+        if (isinstance(column, Column) and column.table is not None and
+                (column.table.name, column.name) in OWNER_COLUMNS and
+                clause.operator in (operators.eq, operators.in_op)):
+            return _bound_values(clause.right)
+
+    return None
+
+
+def _bound_values(clause):
+    # None when a value is only supplied at execution time
+    clause = getattr(clause, 'element', clause)
+    if isinstance(clause, BindParameter):
+        value = clause.effective_value
+        values = set(value) if isinstance(value, (list, tuple, set)) else {value}
+    elif isinstance(clause, ClauseList):
+        if not all(isinstance(part, BindParameter) for part in clause.clauses):
+            return None
+        values = {part.effective_value for part in clause.clauses}
+    else:
+        return None
+    return None if None in values else values
+
+
+class RoutingQuery(BaseQuery, ShardedQuery):
+    """Flask-SQLAlchemy's query class, made shard-aware."""
+
+
+class ShardRouter:
+    """Engines for each shard and the choosers that route between them."""
+
+    def __init__(self, urls, **engine_options):
+        self.engines = {str(i): create_engine(url, **engine_options)
+                        for i, url in enumerate(urls)}
+        self.session_factory = sessionmaker(class_=ShardedSession,
+                                            query_cls=RoutingQuery,
+                                            shards=self.engines,
+                                            shard_chooser=self.choose_shard,
+                                            id_chooser=self.choose_by_id,
+                                            query_chooser=self.choose_for_query)
+        event.listen(self.session_factory, 'before_flush', _assign_user_ids)
+        event.listen(self.session_factory, 'before_flush', _claim_names)
+
+    @property
+    def shard_ids(self):
+        return sorted(self.engines, key=int)
+
+    def shard_for(self, user_id):
+        return shard_for(user_id, len(self.engines))
+
+    def _shards_for(self, user_ids):
+        if not user_ids:
+            return self.shard_ids[:1]
+        return sorted({self.shard_for(id) for id in user_ids}, key=int)
+
+    def choose_shard(self, mapper, instance, clause=None, **kw):
+        """Where to write `instance` (or run `clause`)."""
+
+        owner = owner_of(instance) if instance is not None else None
+        if owner is None and clause is not None:
+            owners = owner_values(getattr(clause, 'whereclause', None))
+            if owners and len(owners) == 1:
+                owner = next(iter(owners))
+        return self.shard_for(owner) if owner is not None else '0'
+
+    def choose_by_id(self, query, ident):
+        """Shards that may hold the row with primary key `ident`."""
+
+        if query.column_descriptions[0]['entity'] is User:
+            return [self.shard_for(ident[0])]
+        return self.shard_ids
+
+    def choose_for_query(self, query):
+        """Shards that may hold rows matching `query`."""
+
+        entity = query.column_descriptions[0]['entity']
+        if getattr(entity, '__tablename__', None) in GLOBAL_TABLES:
+            return ['0']
+        owners = owner_values(query.whereclause)
+        if owners is None:
+            return self.shard_ids
+        return self._shards_for(owners)
+
+    def create_all(self, metadata=None):
+        """Create missing tables on every shard, minus cross-shard keys."""
+
+        metadata = metadata or db.metadata
+        for engine in self.engines.values():
+            with engine.begin() as conn:
+                for table in metadata.sorted_tables:
+                    if engine.dialect.has_table(conn, table.name):
+                        continue
+                    keys = [fk.constraint for fk in table.foreign_keys
+                            if (table.name, fk.parent.name) not in CROSS_SHARD_KEYS]
+                    conn.execute(CreateTable(
+                        table, include_foreign_key_constraints=keys))
+                    for index in table.indexes:
+                        conn.execute(CreateIndex(index))
+                    # DDL hooked to table creation, e.g. the search index
+                    table.dispatch.after_create(table, conn, checkfirst=False,
+                                                _ddl_runner=None)
+
+    def delete_user_references(self, session, user_id, archived=()):
+        """Do the cross-shard ON DELETE CASCADEs for deleting `user_id`.
+
+        `archived` are ids of the user's archived messages, whose likes
+        go too.
+        """
+
+        messages = [id for (id,) in (session
+                                     .query(Message.id)
+                                     .filter(Message.user_id == user_id))]
+        messages.extend(archived)
+        for shard_id in self.shard_ids:
+            conn = session.connection(shard_id=shard_id)
+            conn.execute(Follows.__table__.delete()
+                         .where(Follows.user_being_followed_id == user_id))
+            if messages:
+                conn.execute(Likes.__table__.delete()
+                             .where(Likes.message_id.in_(messages)))
+
+    def delete_message_references(self, session, message_id):
+        """Do the cross-shard ON DELETE CASCADEs for deleting a message."""
+
+        for shard_id in self.shard_ids:
+            session.connection(shard_id=shard_id).execute(
+                Likes.__table__.delete().where(Likes.message_id == message_id))
+
+    def _missing(self, ids, targets, candidates):
+        """Which of `ids` are in none of the `targets` columns on any of
+        `candidates`(id)."""
+
+        missing = set(ids)
+        by_shard = {}
+        for id in ids:
+            for shard_id in candidates(id):
+                by_shard.setdefault(shard_id, []).append(id)
+        for shard_id, shard_ids in by_shard.items():
+            with self.engines[shard_id].connect() as conn:
+                for target in targets:
+                    missing.difference_update(id for (id,) in conn.execute(
+                        select([target]).where(target.in_(shard_ids))))
+        return missing
+
+    def _sweep_column(self, table, column, targets, candidates):
+        """Delete rows of `table` whose `column` is in none of `targets`."""
+
+        removed = 0
+        for engine in self.engines.values():
+            with engine.connect() as conn:
+                ids = sorted(id for (id,) in conn.execute(
+                    select([column]).distinct()))
+            for i in range(0, len(ids), SWEEP_BATCH):
+                missing = self._missing(ids[i:i + SWEEP_BATCH], targets,
+                                        candidates)
+                if missing:
+                    with engine.begin() as conn:
+                        removed += conn.execute(table.delete().where(
+                            column.in_(missing))).rowcount
+        return removed
+
+    def sweep(self):
+        """Finish cross-shard cleanups that a failed commit left undone.
+
+        Deletes likes of messages (live or archived) and follows of
+        users that no longer exist, drops names of deleted users and
+        claims names of users that have none. Every step is idempotent.
+        Returns counts, plus any names held by two users.
+        """
+
+        likes = Likes.__table__
+        follows = Follows.__table__
+        names = UserName.__table__
+        every_shard = lambda id: self.shard_ids
+        owner_shard = lambda id: [self.shard_for(id)]
+
+        counts = dict(
+            likes=self._sweep_column(likes, likes.c.message_id,
+                                     [Message.__table__.c.id,
+                                      ArchivedMessageIds.__table__.c.message_id],
+                                     every_shard),
+            follows=self._sweep_column(follows, follows.c.user_being_followed_id,
+                                       [User.__table__.c.id], owner_shard))
+
+        with self.engines['0'].begin() as conn:
+            claimed = {(kind, name): user_id for kind, name, user_id
+                       in conn.execute(select([names]))}
+            gone = self._missing(set(claimed.values()),
+                                 [User.__table__.c.id], owner_shard)
+            counts['names_released'] = conn.execute(names.delete().where(
+                names.c.user_id.in_(gone))).rowcount if gone else 0
+
+            conflicts, added = [], []
+            for engine in self.engines.values():
+                with engine.connect() as users_conn:
+                    for id, username, email in users_conn.execute(select(
+                            [User.id, User.username, User.email])):
+                        for kind, name in (('username', username), ('email', email)):
+                            holder = claimed.get((kind, name))
+                            if holder is None:
+                                claimed[kind, name] = id
+                                added.append(dict(kind=kind, name=name, user_id=id))
+                            elif holder != id and holder not in gone:
+                                conflicts.append((kind, name))
+            if added:
+                conn.execute(names.insert(), added)
+            counts['names_claimed'] = len(added)
+        counts['conflicts'] = conflicts
+        return counts
+
+
+def _claim_names(session, flush_context, instances):
+    # claims go to shard 0 in this flush, before the users' own rows,
+    # so a name held by a user on another shard fails the flush
+    names = UserName.__table__
+    conn = None
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, User):
+            continue
+        if conn is None:
+            conn = session.connection(shard_id='0')
+
+        if obj in session.deleted:
+            conn.execute(names.delete().where(names.c.user_id == obj.id))
+            continue
+
+        state = inspect(obj)
+        for kind in ('username', 'email'):
+            history = state.attrs[kind].history
+            if obj in session.dirty:
+                if not history.has_changes():
+                    continue
+                for old in history.deleted:
+                    conn.execute(names.delete().where(
+                        (names.c.kind == kind) & (names.c.name == old) &
+                        (names.c.user_id == obj.id)))
+            conn.execute(names.insert().values(
+                kind=kind, name=getattr(obj, kind), user_id=obj.id))
+
+
+def _assign_user_ids(session, flush_context, instances):
+    # a user's shard comes from their id, so it must exist before the
+    # INSERT; one generator serves users and messages since its ids
+    # never repeat
+    for obj in session.new:
+        if isinstance(obj, User) and obj.id is None:
+            obj.id = message_ids.next_id()
+
+
+class SessionQueryProperty:
+    """`Model.query`, built with the query class of the session in use."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __get__(self, obj, type):
+        try:
+            mapper = class_mapper(type)
+        except UnmappedClassError:
+            return None
+        session = self.db.session()
+        return session._query_cls(mapper, session=session)
+
+
+def route_sessions(db):
+    """Have `db.session` make each app's own kind of session.
+
+    Sessions are created per app context, so the current app's
+    ShardRouter (if it has one) builds it; other apps get
+    Flask-SQLAlchemy's usual session. Safe to call more than once.
+    """
+
+    registry = db.session.registry
+    if getattr(registry, 'routed', False):
+        return
+    default = registry.createfunc
+
+    def create_session():
+        app = db.get_app()
+        router = app.extensions.get('shards')
+        if not router:
+            return default()
+        session = router.session_factory()
+        # as Flask-SQLAlchemy's own sessions have (see outbox.py)
+        session.app = app
+        return session
+
+    registry.createfunc = create_session
+    registry.routed = True
+    db.Model.query = SessionQueryProperty(db)
+
+
+def init_sharding(app, db):
+    """Route `db` over SHARD_URLS if it is set; call before connect_db."""
+
+    urls = app.config['SHARD_URLS']
+    if not urls:
+        return None
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = urls[0]
+    router = ShardRouter(urls)
+    route_sessions(db)
+
+    @app.cli.command('create-shards')
+    def create_shards():
+        """Create the tables on every shard."""
+
+        router.create_all()
+        click.echo(f"created tables on {len(router.engines)} shards")
+
+    @app.cli.command('sweep-shards')
+    def sweep_shards():
+        """Remove cross-shard leftovers of failed deletes; claim user names."""
+
+        counts = router.sweep()
+        for kind, name in counts.pop('conflicts'):
+            click.echo(f"{kind} {name!r} is used by more than one user", err=True)
+        click.echo(', '.join(f"{key.replace('_', ' ')}: {n}"
+                             for key, n in counts.items()))
+
+    app.extensions['shards'] = router
+    return router
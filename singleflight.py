@@ -0,0 +1,52 @@
+"""Coalescing of identical concurrent work ("single flight").
+
+When many threads ask for the same key at once, the first one computes
+the value and the rest wait for it and share the result (or the
+exception). A waiter that has waited `timeout` seconds gives up and
+computes the value itself, so one stuck leader can't stall everyone.
+"""
+
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one computation per key at a time."""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        """Return fn(), sharing the result with concurrent calls for `key`."""
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.value
+            return fn()
+
+        try:
+            call.value = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.value
@@ -0,0 +1,209 @@
+"""Slow-query log for the engine behind `db`.
+
+Any statement slower than SLOW_QUERY_MS is written as one JSON line to
+SLOW_QUERY_LOG (rotated by size) with its normalized SQL, the shape of
+its bound parameters, how long it took and which endpoint ran it.
+For a sampled SLOW_QUERY_EXPLAIN_RATE of slow SELECTs, a background
+thread also runs EXPLAIN on a separate connection and logs the plan
+as a follow-up line with the same fingerprint.
+
+At most SLOW_QUERY_MAX_PER_SECOND lines are written per second; the
+next line written reports how many were dropped.
+"""
+
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'%\(\w+\)s|%s|\?|:\w+')
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize(statement):
+    """Strip literals and placeholders so similar statements match."""
+
+    sql = _STRINGS.sub('?', statement)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _PLACEHOLDERS.sub('?', sql)
+    sql = _LISTS.sub('(...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+def parameter_shape(parameters, executemany=False):
+    """Describe parameters by type only, never by value."""
+
+    if executemany:
+        return {'rows': len(parameters),
+                'row': parameter_shape(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in sorted(parameters.items())}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class RateLimiter:
+    """Allow `per_second` events per wall-clock second."""
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.second = None
+        self.count = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return (allowed, dropped_since_last_allowed)."""
+
+        now = int(time.time())
+        with self.lock:
+            if now != self.second:
+                self.second, self.count = now, 0
+            if self.count >= self.per_second:
+                self.dropped += 1
+                return False, 0
+            self.count += 1
+            dropped, self.dropped = self.dropped, 0
+            return True, dropped
+
+
+class SlowQueryLog:
+    """Times statements on an engine and logs the slow ones."""
+
+    def __init__(self, path, threshold_ms, explain_rate=0.0, max_per_second=10,
+                 max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.threshold = threshold_ms / 1000.0
+        self.explain_rate = explain_rate
+        self.limiter = RateLimiter(max_per_second)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.logger = logging.getLogger('warbler.slow_queries.' + path)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+
+        self.explains = queue.Queue(maxsize=100)
+        self.worker = None
+        self.engines = set()
+
+    def instrument(self, engine):
+        """Start timing statements on `engine` (once per engine)."""
+
+        if engine in self.engines:
+            return
+        self.engines.add(engine)
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        # on the statement's own context, so a failed one leaves nothing behind
+        context._slowlog_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_slowlog_start', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        if elapsed < self.threshold:
+            return
+
+        allowed, dropped = self.limiter.allow()
+        if not allowed:
+            return
+
+        sql = normalize(statement)
+        entry = {
+            'type': 'slow_query',
+            'at': datetime.utcnow().isoformat() + 'Z',
+            'ms': round(elapsed * 1000, 2),
+            'fingerprint': fingerprint(sql),
+            'sql': sql,
+            'params': parameter_shape(parameters, executemany),
+            'endpoint': request.endpoint if has_request_context() else None,
+        }
+        if dropped:
+            entry['dropped_before'] = dropped
+        self.write(entry)
+
+        if (not executemany and statement.lstrip()[:6].upper() == 'SELECT' and
+                random.random() < self.explain_rate):
+            self._queue_explain(conn.engine, statement, parameters, entry['fingerprint'])
+
+    def write(self, entry):
+        self.logger.info(json.dumps(entry, default=str))
+
+    def _queue_explain(self, engine, statement, parameters, fp):
+        try:
+            self.explains.put_nowait((engine, statement, parameters, fp))
+        except queue.Full:
+            return
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._explain_loop, daemon=True)
+            self.worker.start()
+
+    def _explain_loop(self):
+        while True:
+            engine, statement, parameters, fp = self.explains.get()
+            try:
+                plan = explain(engine, statement, parameters)
+            except Exception as e:
+                plan = 'EXPLAIN failed: {}'.format(e)
+            self.write({'type': 'explain', 'fingerprint': fp, 'plan': plan})
+
+
+def explain(engine, statement, parameters):
+    """Run EXPLAIN for `statement` on its own raw connection."""
+
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        raw.close()
+    return [' '.join(str(col) for col in row) for row in rows]
+
+
+def init_slow_query_log(app, db):
+    """Log slow statements on `db`'s engine if SLOW_QUERY_MS is set."""
+
+    threshold = app.config['SLOW_QUERY_MS']
+    if threshold is None:
+        return None
+
+    slowlog = SlowQueryLog(app.config['SLOW_QUERY_LOG'], threshold,
+                           app.config['SLOW_QUERY_EXPLAIN_RATE'],
+                           app.config['SLOW_QUERY_MAX_PER_SECOND'])
+
+    @app.before_request
+    def instrument_engine():
+        slowlog.instrument(db.get_engine())
+
+    app.extensions['slow_query_log'] = slowlog
+    return slowlog
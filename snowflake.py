@@ -0,0 +1,172 @@
+"""Time-ordered 64-bit ids ("Snowflake" style) for messages.
+
+An id is, from the high bits down:
+
+- 41 bits: milliseconds since EPOCH (good for ~69 years)
+- 10 bits: worker id
+- 12 bits: per-millisecond sequence
+
+so ids from every worker sort by creation time, ORDER BY id DESC on the
+primary key gives newest first, and a timeline cursor is one integer.
+
+The worker id comes from WORKER_ID (set by create_app) or, failing
+that, from the process id, re-read after a fork. Apps with the same
+worker id share one generator (generator_for), so their ids can't
+collide. The last worker id, IMPORT_WORKER, is kept for ids of
+imported history (historical_id), so those never meet a live post's.
+Ids stay below 2**63, so they fit a signed BIGINT; they do not fit a
+JavaScript number, so send them to browsers as strings.
+"""
+
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from extensions import app_local
+
+EPOCH = datetime(2015, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# reserved for historical_id(); live workers are 0 to IMPORT_WORKER - 1
+IMPORT_WORKER = MAX_WORKER
+
+_EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def _millis(dt):
+    return int((dt - EPOCH).total_seconds() * 1000)
+
+
+def _check_worker(worker_id):
+    if not 0 <= worker_id < IMPORT_WORKER:
+        raise ValueError(f"worker id must be 0-{IMPORT_WORKER - 1}, not {worker_id}")
+
+
+class _HistorySequence:
+    """Sequence numbers for historical ids, shared by the whole process.
+
+    Starts at a random point, again after a fork, so processes importing
+    at once are unlikely to be in step.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.next = random.getrandbits(SEQUENCE_BITS)
+            sequence = self.next
+            self.next = (self.next + 1) & MAX_SEQUENCE
+            return sequence
+
+
+_history = _HistorySequence()
+
+
+class SnowflakeGenerator:
+    """Hand out unique, increasing ids for one worker."""
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id
+        self.last = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def configure(self, worker_id):
+        _check_worker(worker_id)
+        self.worker_id = worker_id
+
+    def _worker(self):
+        if self.worker_id is not None:
+            return self.worker_id
+        return os.getpid() % IMPORT_WORKER
+
+    def next_id(self):
+        """The next id for this worker.
+
+        Waits for the next millisecond when 4096 ids have been handed
+        out in this one, or when the clock has stepped backwards.
+        """
+
+        with self.lock:
+            now = int(time.time() * 1000) - _EPOCH_MS
+            while now < self.last:
+                time.sleep((self.last - now) / 1000.0)
+                now = int(time.time() * 1000) - _EPOCH_MS
+
+            if now == self.last:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while now <= self.last:
+                        now = int(time.time() * 1000) - _EPOCH_MS
+            else:
+                self.sequence = 0
+            self.last = now
+
+            return ((now << (WORKER_BITS + SEQUENCE_BITS)) |
+                    (self._worker() << SEQUENCE_BITS) |
+                    self.sequence)
+
+    def id_for(self, dt, sequence=0):
+        """An id for something created at `dt` (e.g. imported history).
+
+        Callers creating several ids for the same millisecond must pass
+        distinct `sequence` numbers.
+        """
+
+        return ((_millis(dt) << (WORKER_BITS + SEQUENCE_BITS)) |
+                (self._worker() << SEQUENCE_BITS) |
+                (sequence & MAX_SEQUENCE))
+
+    def historical_id(self, dt):
+        """A new id for something created at `dt`, e.g. an imported message.
+
+        It has IMPORT_WORKER as its worker and the process's next history
+        sequence number, so it can't collide with a live id or another
+        historical one from this process. Another process may, rarely,
+        pick the same one; callers should retry on a duplicate key.
+        """
+
+        return ((_millis(dt) << (WORKER_BITS + SEQUENCE_BITS)) |
+                (IMPORT_WORKER << SEQUENCE_BITS) |
+                _history.take())
+
+
+def first_id_at(dt):
+    """The lowest id anything created at `dt` can have, e.g. for ranges."""
+
+    return max(0, _millis(dt)) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+def timestamp_of(id):
+    """The (UTC) datetime encoded in `id`, to the millisecond."""
+
+    return EPOCH + timedelta(milliseconds=id >> (WORKER_BITS + SEQUENCE_BITS))
+
+
+_generators = {None: SnowflakeGenerator()}
+_generators_lock = threading.Lock()
+
+
+def generator_for(worker_id):
+    """The process's generator for `worker_id` (None: by process id)."""
+
+    if worker_id is not None:
+        _check_worker(worker_id)
+    with _generators_lock:
+        if worker_id not in _generators:
+            _generators[worker_id] = SnowflakeGenerator(worker_id)
+        return _generators[worker_id]
+
+
+message_ids = app_local('message_ids', _generators[None])
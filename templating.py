@@ -0,0 +1,60 @@
+"""Jinja bytecode caching and template precompilation.
+
+With TEMPLATE_BYTECODE_CACHE on, compiled templates are stored on disk
+and shared by every worker, so a fresh worker loads bytecode instead
+of parsing and compiling each template on its first request. Cached
+bytecode is executed as it is, so the directory must be writable by
+this user alone: left unset, Jinja makes a private one in the temp
+directory; a TEMPLATE_CACHE_DIR is created with mode 0700 and refused
+if anyone else owns or can write to it. Fill the cache ahead of a
+deploy with:
+
+    flask precompile-templates
+
+and/or set TEMPLATE_WARM to load every template when the app is built.
+"""
+
+import os
+import stat
+
+import click
+from jinja2 import FileSystemBytecodeCache
+
+
+def precompile(app):
+    """Compile every template `app` can find; return how many."""
+
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def private_dir(path):
+    """Create `path` for this user only; RuntimeError if it isn't safe."""
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & 0o022):
+        raise RuntimeError(f"template cache directory {path} must be a "
+                           f"directory owned and only writable by this user")
+    return path
+
+
+def init_templates(app):
+    """Set up the bytecode cache, the precompile command and warming."""
+
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        cache_dir = app.config['TEMPLATE_CACHE_DIR']
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            private_dir(cache_dir) if cache_dir else None)
+
+    @app.cli.command('precompile-templates')
+    def precompile_templates():
+        """Compile all templates into the bytecode cache."""
+
+        click.echo(f"Compiled {precompile(app)} templates.")
+
+    if app.config['TEMPLATE_WARM']:
+        precompile(app)
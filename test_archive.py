@@ -0,0 +1,221 @@
+"""Message archive tests."""
+
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Likes, ArchivedMessageIds, ArchivedMessages
+from app import create_app, CURR_USER_KEY
+from archive import (add_months, archive_messages, archived_by,
+                     delete_archived_by, find_archived, hot_cutoff, pack,
+                     save_chunks, unpack)
+from export import records
+from snowflake import first_id_at, message_ids, timestamp_of
+
+app = create_app('test')
+
+db.create_all()
+
+
+class ArchiveHelpersTestCase(TestCase):
+    """Tests for months and packing"""
+
+    def test_months(self):
+        self.assertEqual(add_months(datetime(2020, 11, 1), 3), datetime(2021, 2, 1))
+        self.assertEqual(add_months(datetime(2020, 1, 1), -1), datetime(2019, 12, 1))
+        self.assertEqual(hot_cutoff(12, datetime(2020, 5, 17, 9)), datetime(2019, 5, 1))
+
+    def test_first_id_at(self):
+        """Every id made in or after a month is at least its first id"""
+
+        month = datetime(2019, 5, 1)
+        self.assertLess(message_ids.id_for(datetime(2019, 4, 30, 23, 59, 59)),
+                        first_id_at(month))
+        self.assertEqual(timestamp_of(first_id_at(month)), month)
+
+    def test_pack_round_trip(self):
+        rows = [[1, 7, datetime(2019, 1, 1, 12), 'hello'],
+                [5, 8, datetime(2019, 1, 2, 3, 4, 5, 600), 'ünïcode']]
+        self.assertEqual(unpack(pack(rows)), rows)
+
+
+class ArchiveTestCase(TestCase):
+    """Tests for archiving old messages and reading them back"""
+
+    def setUp(self):
+        db.session.rollback()
+        ArchivedMessageIds.query.delete()
+        ArchivedMessages.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup('archivist', 'archivist@test.com', 'password', None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.old_ids = []
+        for i, day in enumerate([1, 2, 3, 4, 5]):
+            when = datetime(2018, 3, day)
+            msg = Message(id=message_ids.id_for(when), text=f'old {i}',
+                          timestamp=when, user_id=self.user_id)
+            db.session.add(msg)
+            self.old_ids.append(msg.id)
+        db.session.add(Message(text='new', user_id=self.user_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_archive_and_find(self):
+        """Old messages move to packed chunks and can still be read"""
+
+        moved = archive_messages(db.engine, datetime(2019, 1, 1), chunk_size=2)
+
+        self.assertEqual(moved, 5)
+        self.assertEqual([msg.text for msg in Message.query.all()], ['new'])
+        chunks = ArchivedMessages.query.order_by(ArchivedMessages.first_id).all()
+        self.assertEqual([chunk.count for chunk in chunks], [2, 2, 1])
+        self.assertEqual(chunks[0].first_id, self.old_ids[0])
+        self.assertEqual(chunks[-1].last_id, self.old_ids[-1])
+        self.assertEqual(sorted(entry.message_id
+                                for entry in ArchivedMessageIds.query),
+                         self.old_ids)
+
+        for i, id in enumerate(self.old_ids):
+            found = find_archived(id)
+            self.assertEqual(found.text, f'old {i}')
+            self.assertEqual(found.timestamp, datetime(2018, 3, i + 1))
+            self.assertEqual(found.user.username, 'archivist')
+        self.assertIsNone(find_archived(self.old_ids[0] + 1))
+
+        # nothing left to move
+        self.assertEqual(archive_messages(db.engine, datetime(2019, 1, 1)), 0)
+
+    def test_chunks_per_user(self):
+        """Each user's messages are packed apart, and read back alone"""
+
+        other = User.signup('other', 'other@test.com', 'password', None)
+        db.session.commit()
+        other_id = other.id
+        when = datetime(2018, 3, 2, 12)
+        other_msg = Message(id=message_ids.id_for(when), text='not mine',
+                            timestamp=when, user_id=other_id)
+        db.session.add(other_msg)
+        db.session.commit()
+        other_msg_id = other_msg.id
+
+        archive_messages(db.engine, datetime(2019, 1, 1))
+
+        chunks = ArchivedMessages.query.order_by(ArchivedMessages.first_id).all()
+        self.assertEqual([(chunk.user_id, chunk.count) for chunk in chunks],
+                         [(self.user_id, 5), (other_id, 1)])
+        self.assertEqual([id for rows in archived_by(self.user_id)
+                          for id, timestamp, text in rows], self.old_ids)
+        self.assertEqual(find_archived(other_msg_id).text, 'not mine')
+
+        with app.app_context():
+            self.assertEqual(delete_archived_by(other_id), [other_msg_id])
+            db.session.commit()
+        self.assertEqual([chunk.user_id for chunk in ArchivedMessages.query],
+                         [self.user_id])
+
+    def test_show_archived_message(self):
+        """/messages/<id> falls back to the archive"""
+
+        archive_messages(db.engine, datetime(2019, 1, 1))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f'/messages/{self.old_ids[2]}')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('old 2', html)
+            self.assertIn(f'/messages/{self.old_ids[2]}/delete', html)
+
+            self.assertEqual(c.get('/messages/12345').status_code, 404)
+            self.assertEqual(c.post('/messages/12345/delete').status_code, 404)
+
+            c.post(f'/messages/{self.old_ids[2]}/delete')
+            self.assertIsNone(find_archived(self.old_ids[2]))
+            self.assertIsNone(ArchivedMessageIds.query.get(self.old_ids[2]))
+            self.assertEqual(find_archived(self.old_ids[3]).text, 'old 3')
+            self.assertEqual(c.get(f'/messages/{self.old_ids[2]}').status_code, 404)
+
+    def test_overlapping_chunks(self):
+        """A message is found whichever of several overlapping chunks holds it"""
+
+        messages = Message.query.filter(Message.id.in_(self.old_ids)).all()
+        rows = sorted((msg.id, msg.user_id, msg.timestamp, msg.text)
+                      for msg in messages)
+        save_chunks(db.session.connection(), [rows[0], rows[4]])
+        save_chunks(db.session.connection(), rows[1:4])
+        Message.query.filter(Message.id.in_(self.old_ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+        for i, id in enumerate(self.old_ids):
+            self.assertEqual(find_archived(id).text, f'old {i}')
+
+    def test_delete_user_clears_archive(self):
+        """Deleting a user takes their archived messages and their messages' likes"""
+
+        fan = User.signup('fan', 'fan@test.com', 'password', None)
+        db.session.commit()
+        new_id = Message.query.filter_by(text='new').one().id
+        db.session.add(Likes(user_id=fan.id, message_id=new_id))
+        db.session.commit()
+        fan_id = fan.id
+        archive_messages(db.engine, datetime(2019, 1, 1))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            c.post('/users/delete')
+
+        self.assertEqual(ArchivedMessages.query.all(), [])
+        self.assertIsNone(find_archived(self.old_ids[0]))
+        self.assertEqual(Likes.query.filter_by(user_id=fan_id).all(), [])
+
+    def test_archiving_keeps_likes(self):
+        """Likes of archived messages stay and still show their messages"""
+
+        fan = User.signup('fan', 'fan@test.com', 'password', None)
+        db.session.commit()
+        fan_id = fan.id
+        new_id = Message.query.filter_by(text='new').one().id
+        for id in (self.old_ids[0], self.old_ids[4], new_id):
+            db.session.add(Likes(user_id=fan_id, message_id=id))
+        db.session.commit()
+
+        archive_messages(db.engine, datetime(2019, 1, 1))
+
+        self.assertEqual(sorted(like.message_id for like in Likes.query.all()),
+                         sorted([self.old_ids[0], self.old_ids[4], new_id]))
+        with app.app_context():
+            exported = list(records(fan_id, kinds=('likes',)))
+        self.assertEqual(sorted(r['text'] for r in exported),
+                         ['new', 'old 0', 'old 4'])
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = fan_id
+
+            html = c.get(f'/users/{fan_id}/likes').get_data(as_text=True)
+            self.assertIn('old 0', html)
+            self.assertIn('old 4', html)
+            self.assertIn('new', html)
+
+            # an archived message can be unliked, but not liked again
+            resp = c.post(f'/users/add_like/{self.old_ids[0]}',
+                          headers={'Referer': '/'})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(c.post(f'/users/add_like/{self.old_ids[0]}',
+                                    headers={'Referer': '/'}).status_code, 404)
+            self.assertEqual(c.post('/users/add_like/12345',
+                                    headers={'Referer': '/'}).status_code, 404)
+
+        self.assertEqual(sorted(like.message_id for like in Likes.query.all()),
+                         sorted([self.old_ids[4], new_id]))
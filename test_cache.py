@@ -0,0 +1,235 @@
+"""Cache tests."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+from app import create_app
+from cache import Cache, MemoryBackend, SQLiteBackend, cache
+
+app = create_app('test')
+
+db.create_all()
+
+
+def _write_shared(path):
+    Cache(SQLiteBackend(path)).set('users', 1, 'from another process')
+
+
+class MemoryBackendTestCase(TestCase):
+    """Tests for MemoryBackend"""
+
+    def test_lru_eviction(self):
+        """The least recently used key goes first"""
+
+        backend = MemoryBackend(max_items=2)
+        backend.set('a', b'1')
+        backend.set('b', b'2')
+        backend.get('a')
+        backend.set('c', b'3')
+
+        self.assertEqual(backend.get('a'), b'1')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('c'), b'3')
+
+    def test_byte_limit(self):
+        """Keys are evicted until the total size fits"""
+
+        backend = MemoryBackend(max_bytes=10)
+        backend.set('a', b'x' * 6)
+        backend.set('b', b'x' * 6)
+
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.bytes, 6)
+
+    def test_ttl(self):
+        """Expired keys are misses"""
+
+        backend = MemoryBackend()
+        backend.set('a', b'1', ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.bytes, 0)
+
+
+class SQLiteBackendTestCase(TestCase):
+    """Tests for SQLiteBackend"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared_between_processes(self):
+        """A value set in one process is seen by another"""
+
+        process = multiprocessing.Process(target=_write_shared, args=(self.path,))
+        process.start()
+        process.join()
+
+        self.assertEqual(Cache(SQLiteBackend(self.path)).get('users', 1),
+                         'from another process')
+
+    def test_invalidation_is_shared(self):
+        """Bumping a namespace orphans keys for every client of the file"""
+
+        one = Cache(SQLiteBackend(self.path))
+        two = Cache(SQLiteBackend(self.path))
+        one.set('users', 1, 'alice')
+        two.invalidate('users')
+
+        self.assertIsNone(one.get('users', 1))
+
+    def test_prune(self):
+        """Expired rows and rows over max_items are dropped"""
+
+        backend = SQLiteBackend(self.path, max_items=2)
+        backend.set('old', b'1', ttl=0.01)
+        for key in 'abc':
+            backend.set(key, b'1')
+        time.sleep(0.02)
+        backend.prune()
+
+        self.assertIsNone(backend.get('old'))
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('c'), b'1')
+
+
+class CacheTestCase(TestCase):
+    """Tests for Cache"""
+
+    def test_namespaces_and_stats(self):
+        """Namespaces keep keys apart and count hits and misses"""
+
+        c = Cache()
+        users = c.namespace('users')
+        users.set(1, {'name': 'alice'})
+
+        self.assertEqual(users.get(1), {'name': 'alice'})
+        self.assertIsNone(c.get('messages', 1))
+        self.assertEqual(users.get_or_set(2, lambda: 'bob'), 'bob')
+        self.assertEqual(users.get_or_set(2, lambda: 'carol'), 'bob')
+
+        self.assertEqual(c.stats(), {'users': {'hits': 2, 'misses': 1},
+                                     'messages': {'hits': 0, 'misses': 1}})
+
+    def test_invalidate(self):
+        """Invalidating one namespace leaves the others alone"""
+
+        c = Cache()
+        c.set('users', 1, 'alice')
+        c.set('messages', 1, 'hello')
+        c.invalidate('users')
+
+        self.assertIsNone(c.get('users', 1))
+        self.assertEqual(c.get('messages', 1), 'hello')
+
+    def test_invalidated_while_computing(self):
+        """A value computed across an invalidation isn't kept"""
+
+        c = Cache()
+
+        def stale():
+            c.invalidate('likes', 1)
+            return 'stale'
+
+        self.assertEqual(c.get_or_set('likes', 1, stale), 'stale')
+        self.assertEqual(c.get_or_set('likes', 1, lambda: 'fresh'), 'fresh')
+
+    def test_versions_survive_eviction(self):
+        """Evicting entries never resets a namespace's version"""
+
+        c = Cache(MemoryBackend(max_items=1))
+        c.set('users', 1, 'stale')
+        c.invalidate('users')
+        for i in range(5):
+            c.set('messages', i, i)
+
+        self.assertEqual(c.backend.version('users'), 1)
+
+
+class ModelInvalidationTestCase(TestCase):
+    """Tests for invalidation from model events"""
+
+    def setUp(self):
+        db.session.rollback()
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.user = User.signup('cacher', 'cacher@test.com', 'password', None)
+        db.session.commit()
+        self.message = Message(text='cache me', user_id=self.user.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_insert_and_delete_invalidate(self):
+        """Adding and removing likes drops cached like ids"""
+
+        cache.set('likes', self.user.id, [])
+        db.session.add(Likes(user_id=self.user.id, message_id=self.message.id))
+        db.session.commit()
+        self.assertIsNone(cache.get('likes', self.user.id))
+
+        cache.set('likes', self.user.id, [self.message.id])
+        Likes.query.filter_by(user_id=self.user.id).delete()
+        db.session.commit()
+        self.assertIsNone(cache.get('likes', self.user.id))
+
+    def test_collections_invalidate(self):
+        """Appending to User.likes drops cached like ids"""
+
+        cache.set('likes', self.user.id, [])
+        self.user.likes.append(self.message)
+        db.session.commit()
+
+        self.assertIsNone(cache.get('likes', self.user.id))
+
+    def test_update_invalidates(self):
+        """Updating a user drops cached users"""
+
+        cache.set('users', self.user.id, 'cacher')
+        self.user.bio = 'new bio'
+        db.session.commit()
+
+        self.assertIsNone(cache.get('users', self.user.id))
+
+    def test_waits_for_commit(self):
+        """Nothing is invalidated until the change commits, or if it rolls back"""
+
+        cache.set('users', self.user.id, 'cacher')
+        self.user.bio = 'rolled back'
+        db.session.flush()
+        self.assertEqual(cache.get('users', self.user.id), 'cacher')
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(cache.get('users', self.user.id), 'cacher')
+
+        self.user.bio = 'kept'
+        db.session.flush()
+        self.assertEqual(cache.get('users', self.user.id), 'cacher')
+        db.session.commit()
+        self.assertIsNone(cache.get('users', self.user.id))
+
+    def test_only_changed_keys(self):
+        """A like drops the liker's cached ids and nobody else's"""
+
+        other = User.signup('bystander', 'bystander@test.com', 'password', None)
+        db.session.commit()
+        cache.set('likes', self.user.id, [])
+        cache.set('likes', other.id, [])
+        db.session.add(Likes(user_id=self.user.id, message_id=self.message.id))
+        db.session.commit()
+
+        self.assertIsNone(cache.get('likes', self.user.id))
+        self.assertEqual(cache.get('likes', other.id), [])
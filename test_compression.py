@@ -0,0 +1,111 @@
+"""Response compression tests."""
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db
+from app import create_app
+from config import TestConfig
+from compression import choose_encoding, compress_static_files
+
+app = create_app('test')
+
+db.create_all()
+
+
+class ChooseEncodingTestCase(TestCase):
+    """Tests for choose_encoding"""
+
+    def test_choose_encoding(self):
+        """The highest-q encoding we offer wins; q=0 refuses it"""
+
+        offered = ['br', 'gzip']
+
+        self.assertEqual(choose_encoding('gzip, deflate, br', offered), 'br')
+        self.assertEqual(choose_encoding('gzip', offered), 'gzip')
+        self.assertEqual(choose_encoding('br;q=0.5, gzip;q=0.8', offered), 'gzip')
+        self.assertEqual(choose_encoding('*', ['gzip']), 'gzip')
+        self.assertIsNone(choose_encoding('gzip;q=0, identity', offered))
+        self.assertIsNone(choose_encoding('', offered))
+
+
+class CompressionTestCase(TestCase):
+    """Tests for compressing responses"""
+
+    def setUp(self):
+        config = type('CompressConfig', (TestConfig,),
+                      dict(COMPRESS_ENABLED=True, COMPRESS_MIN_SIZE=100))
+        self.app = create_app(config)
+
+        @self.app.route('/big')
+        def big():
+            return 'warble ' * 100
+
+        @self.app.route('/small')
+        def small():
+            return 'warble'
+
+        self.client = self.app.test_client()
+        self.static = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.static)
+
+    def test_large_response_is_gzipped(self):
+        """Large text responses are compressed when the client accepts it"""
+
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.get_data()), b'warble ' * 100)
+
+    def test_small_or_unaccepted_response_is_not_compressed(self):
+        """Small responses, and clients that don't ask, get plain bodies"""
+
+        resp = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get('/big')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(), b'warble ' * 100)
+
+    def test_precompressed_static_file(self):
+        """Static files are served from their precompressed sibling"""
+
+        with open(os.path.join(self.static, 'site.css'), 'w') as f:
+            f.write('body { color: red; }\n' * 50)
+        compress_static_files(self.static)
+        self.app.static_folder = self.static
+
+        resp = self.client.get('/static/site.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertEqual(gzip.decompress(resp.get_data()),
+                         b'body { color: red; }\n' * 50)
+        resp.close()
+
+        resp = self.client.get('/static/site.css')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp.close()
+
+    def test_stale_precompressed_file_is_ignored(self):
+        """A sibling older than its edited file isn't served"""
+
+        path = os.path.join(self.static, 'site.css')
+        with open(path, 'w') as f:
+            f.write('body { color: red; }\n' * 50)
+        compress_static_files(self.static)
+        with open(path, 'w') as f:
+            f.write('body { color: blue; }\n' * 50)
+        stamp = os.stat(path + '.gz').st_mtime + 10
+        os.utime(path, (stamp, stamp))
+        self.app.static_folder = self.static
+
+        resp = self.client.get('/static/site.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(), b'body { color: blue; }\n' * 50)
+        resp.close()
@@ -0,0 +1,167 @@
+"""Data export tests."""
+
+import csv
+import io
+import json
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import (db, ArchivedMessageIds, ArchivedMessages, User, Message,
+                    Likes, Follows)
+from app import create_app, CURR_USER_KEY
+from archive import save_chunks
+from export import parse_kinds, records, stream_export
+
+app = create_app('test')
+
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    """Tests for exporting a user's data"""
+
+    def setUp(self):
+        db.session.rollback()
+        ArchivedMessageIds.query.delete()
+        ArchivedMessages.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.user = User.signup('exporter', 'exporter@test.com', 'password', None)
+        other = User.signup('other', 'other@test.com', 'password', None)
+        db.session.commit()
+        self.user_id, self.other_id = self.user.id, other.id
+
+        for i in range(5):
+            db.session.add(Message(text=f'mine {i}', user_id=self.user_id))
+        liked = Message(text='theirs', user_id=self.other_id)
+        db.session.add(liked)
+        db.session.commit()
+        self.liked_id = liked.id
+
+        db.session.add_all([
+            Likes(user_id=self.user_id, message_id=self.liked_id),
+            Follows(user_following_id=self.user_id,
+                    user_being_followed_id=self.other_id)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_records(self):
+        """Every message, like and follow, across several chunks"""
+
+        with app.app_context():
+            exported = list(records(self.user_id, chunk_size=2))
+
+        self.assertEqual([r['type'] for r in exported],
+                         ['message'] * 5 + ['like', 'following'])
+        self.assertEqual([r['text'] for r in exported[:5]],
+                         [f'mine {i}' for i in range(5)])
+        self.assertEqual(exported[5]['id'], self.liked_id)
+        self.assertEqual(exported[5]['username'], 'other')
+        self.assertEqual(exported[6], dict(type='following', id=self.other_id,
+                                           username='other', text=None,
+                                           timestamp=None))
+
+    def test_archived_messages(self):
+        """Archived messages are exported first, and only the user's"""
+
+        when = datetime(2016, 1, 1)
+        save_chunks(db.session.connection(),
+                    [(1, self.user_id, when, 'archived'),
+                     (2, self.other_id, when, 'not mine')])
+        db.session.commit()
+
+        with app.app_context():
+            exported = list(records(self.user_id, kinds=('messages',)))
+
+        self.assertEqual(exported[0], dict(type='message', id=1,
+                                           username='exporter', text='archived',
+                                           timestamp=when.isoformat()))
+        self.assertEqual([r['text'] for r in exported[1:]],
+                         [f'mine {i}' for i in range(5)])
+
+    def test_no_connection_held_between_pages(self):
+        """A page is handed on with its connection back in the pool"""
+
+        held = []
+        engine = db.get_engine()
+
+        def checkout(*args):
+            held.append(True)
+
+        def checkin(*args):
+            held.pop()
+
+        event.listen(engine, 'checkout', checkout)
+        event.listen(engine, 'checkin', checkin)
+        try:
+            with app.app_context():
+                exported = records(self.user_id, chunk_size=2)
+                for _ in range(7):
+                    next(exported)
+                    self.assertEqual(held, [])
+        finally:
+            event.remove(engine, 'checkout', checkout)
+            event.remove(engine, 'checkin', checkin)
+
+    def test_parse_kinds(self):
+        self.assertEqual(parse_kinds(None), ('messages', 'likes', 'following'))
+        self.assertEqual(parse_kinds('likes, following'), ('likes', 'following'))
+        with self.assertRaises(ValueError):
+            parse_kinds('messages,passwords')
+
+    def test_first_line_goes_out_alone(self):
+        """The download starts before the rest is gathered"""
+
+        with app.app_context():
+            pieces = list(stream_export(self.user_id))
+
+        self.assertEqual(pieces[0].count('\n'), 1)
+        self.assertEqual(len(''.join(pieces).splitlines()), 7)
+
+    def test_download(self):
+        """The endpoint streams JSON lines or CSV for the logged-in user"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get('/users/export.jsonl')
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.mimetype, 'application/x-ndjson')
+            self.assertIn('warbler-exporter.jsonl',
+                          resp.headers['Content-Disposition'])
+            lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+            self.assertEqual(len(lines), 7)
+
+            resp = c.get('/users/export.csv?include=likes')
+            rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+            self.assertEqual(rows, [dict(type='like', id=str(self.liked_id),
+                                         username='other', text='theirs',
+                                         timestamp=rows[0]['timestamp'])])
+
+            self.assertEqual(c.get('/users/export.csv?include=bogus').status_code, 400)
+            self.assertEqual(c.get('/users/export.xml').status_code, 404)
+
+    def test_download_needs_login(self):
+        with app.test_client() as c:
+            resp = c.get('/users/export.jsonl')
+            self.assertEqual(resp.status_code, 302)
+
+    def test_command(self):
+        """`flask export-user` writes the same export"""
+
+        result = app.test_cli_runner().invoke(
+            args=['export-user', 'exporter', '--include', 'messages'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(len(result.output.splitlines()), 5)
+
+        result = app.test_cli_runner().invoke(args=['export-user', 'nobody'])
+        self.assertNotEqual(result.exit_code, 0)
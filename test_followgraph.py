@@ -0,0 +1,141 @@
+"""Follow graph tests."""
+
+from array import array
+from unittest import TestCase
+
+from models import db, User, Follows
+from app import create_app, CURR_USER_KEY
+from followgraph import FollowGraph, intersect
+
+app = create_app('test')
+follow_graph = app.extensions['follow_graph']
+
+db.create_all()
+
+
+class IntersectTestCase(TestCase):
+    """Tests for sorted-array intersection"""
+
+    def test_intersect(self):
+        """Common ids come back in order, whichever side is shorter"""
+
+        a = array('q', [1, 3, 5, 7, 9])
+        b = array('q', range(0, 100, 3))
+
+        self.assertEqual(intersect(a, b), [3, 9])
+        self.assertEqual(intersect(b, a), [3, 9])
+        self.assertEqual(intersect(a, array('q')), [])
+
+
+class FollowGraphTestCase(TestCase):
+    """Tests for building and updating the graph"""
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        follow_graph.clear()
+
+        self.ids = []
+        for i in range(4):
+            user = User.signup(f'graph{i}', f'graph{i}@test.com', 'password', None)
+            db.session.commit()
+            self.ids.append(user.id)
+
+        a, b, c, d = self.ids
+        db.session.add_all([Follows(user_following_id=a, user_being_followed_id=b),
+                            Follows(user_following_id=b, user_being_followed_id=a),
+                            Follows(user_following_id=a, user_being_followed_id=c),
+                            Follows(user_following_id=c, user_being_followed_id=d),
+                            Follows(user_following_id=b, user_being_followed_id=d)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_loads_from_follows(self):
+        """The graph answers from what the follows table held"""
+
+        a, b, c, d = self.ids
+        graph = FollowGraph()
+        graph.load()
+
+        self.assertTrue(graph.loaded)
+        self.assertTrue(graph.follows(a, b))
+        self.assertFalse(graph.follows(d, a))
+        self.assertEqual(graph.following_of(a), sorted([b, c]))
+        self.assertEqual(graph.followers_of(d), sorted([b, c]))
+        self.assertEqual(graph.mutuals(a), [b])
+        self.assertEqual(graph.followers_you_know(a, d), sorted([b, c]))
+
+    def test_updates(self):
+        """Follows, unfollows and deleted users apply in place"""
+
+        a, b, c, d = self.ids
+        graph = FollowGraph()
+        graph.load()
+
+        graph.add(d, a)
+        graph.add(d, a)
+        graph.remove(a, c)
+        self.assertEqual(graph.followers_of(a), sorted([b, d]))
+        self.assertEqual(graph.following_of(a), [b])
+
+        graph.remove_user(b)
+        self.assertEqual(graph.following_of(a), [])
+        self.assertEqual(graph.followers_of(d), [c])
+        self.assertEqual(graph.followers_of(b), [])
+
+    def test_answers_from_database_until_loaded(self):
+        """An unloaded graph gives the same answers, from the database"""
+
+        a, b, c, d = self.ids
+        graph = FollowGraph()
+
+        self.assertTrue(graph.follows(a, b))
+        self.assertFalse(graph.follows(d, a))
+        self.assertEqual(graph.following_of(a), sorted([b, c]))
+        self.assertEqual(graph.mutuals(a), [b])
+        self.assertEqual(graph.followers_you_know(a, d), sorted([b, c]))
+        self.assertFalse(graph.loaded)
+
+    def test_updates_during_load(self):
+        """Updates that arrive while the table is read are not lost"""
+
+        a, b, c, d = self.ids
+        graph = FollowGraph()
+        read = graph._read
+
+        def read_then_update():
+            rows = read()
+            graph.add(d, a)
+            graph.remove(a, c)
+            return rows
+
+        graph._read = read_then_update
+        graph.load()
+
+        self.assertEqual(graph.followers_of(a), sorted([b, d]))
+        self.assertEqual(graph.following_of(a), [b])
+        self.assertEqual(graph.missed, [])
+
+    def test_profile_shows_followers_you_know(self):
+        """Following through the app updates the graph the profile reads"""
+
+        a, b, c, d = self.ids
+        follow_graph.load()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = d
+            client.post(f'/users/follow/{a}')
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = a
+            html = client.get(f'/users/{d}').get_data(as_text=True)
+
+        self.assertIn('Follows you', html)
+        self.assertIn('Followed by', html)
+        self.assertIn('@graph1', html)
+        self.assertIn('@graph2', html)
@@ -0,0 +1,180 @@
+"""Bulk message import tests."""
+
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message
+from app import create_app, CURR_USER_KEY
+from importer import Importer, RowError, parse_row, parse_timestamp
+from snowflake import (IMPORT_WORKER, MAX_WORKER, SEQUENCE_BITS, message_ids,
+                       timestamp_of)
+
+app = create_app('test')
+dispatcher = app.extensions['outbox']
+message_index = app.extensions['message_index']
+
+db.create_all()
+
+NOW = datetime(2020, 1, 1)
+
+
+def lines(*rows):
+    return [json.dumps(row) + '\n' if not isinstance(row, str) else row
+            for row in rows]
+
+
+class ParseTestCase(TestCase):
+    """Tests for checking import lines"""
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('2016-04-01T12:30:00Z'),
+                         datetime(2016, 4, 1, 12, 30))
+        self.assertEqual(parse_timestamp('2016-04-01T12:30:00.250+02:00'),
+                         datetime(2016, 4, 1, 10, 30, 0, 250000))
+        self.assertEqual(parse_timestamp('2016-04-01'), datetime(2016, 4, 1))
+        with self.assertRaises(RowError):
+            parse_timestamp('yesterday')
+
+    def test_parse_row(self):
+        self.assertEqual(parse_row('{"text": "hi"}', NOW), ('hi', NOW))
+
+        for line, error in [('{"text": ', 'not valid JSON'),
+                            ('["hi"]', 'expected a JSON object'),
+                            ('{"text": " "}', 'text is missing'),
+                            (json.dumps({'text': 'x' * 141}), 'longer than 140'),
+                            ('{"text": "hi", "timestamp": "2010-01-01"}', 'before 2015'),
+                            ('{"text": "hi", "timestamp": "2030-01-01"}', 'future')]:
+            with self.assertRaises(RowError) as cm:
+                parse_row(line, NOW)
+            self.assertIn(error, str(cm.exception))
+
+
+class ImportTestCase(TestCase):
+    """Tests for importing messages"""
+
+    def setUp(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup('importer', 'importer@test.com', 'password', None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_batches_and_errors(self):
+        """Good lines are saved in batches; bad ones are reported and skipped"""
+
+        importer = Importer(self.user_id, batch_size=2, max_errors=1)
+        report = importer.run(lines(
+            {'text': 'one', 'timestamp': '2016-01-01T00:00:00Z'},
+            {'text': 'two', 'timestamp': '2016-01-01T00:00:00Z'},
+            'not json\n',
+            '\n',
+            {'text': 'three', 'timestamp': '2017-06-01T08:00:00Z'},
+            {'timestamp': '2017-06-01T08:00:00Z'}))
+
+        self.assertEqual(report['imported'], 3)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual(report['errors'], [dict(line=3, error='not valid JSON')])
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual([msg.text for msg in messages], ['one', 'two', 'three'])
+        self.assertEqual(timestamp_of(messages[2].id), datetime(2017, 6, 1, 8))
+        self.assertEqual(messages[2].timestamp, datetime(2017, 6, 1, 8))
+
+    def test_failed_batch_is_retried_row_by_row(self):
+        """A row the database refuses doesn't take its batch with it"""
+
+        existing = Message(text='already here', user_id=self.user_id)
+        db.session.add(existing)
+        db.session.commit()
+
+        importer = Importer(self.user_id, batch_size=10)
+        clashing = importer._message
+        calls = []
+
+        def message(text, timestamp):
+            # the first message reuses an id that's taken
+            msg = clashing(text, timestamp)
+            calls.append(msg)
+            if len(calls) == 1:
+                msg.id = existing.id
+            return msg
+
+        importer._message = message
+        report = importer.run(lines({'text': 'a'}, {'text': 'b'}))
+
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(Message.query.filter_by(user_id=self.user_id).count(), 3)
+
+    def test_ids_do_not_collide(self):
+        """Imports of the same moment get ids apart from each other and live posts"""
+
+        when = datetime(2016, 1, 1)
+        live = Message(id=message_ids.id_for(when, 1), text='live',
+                       timestamp=when, user_id=self.user_id)
+        db.session.add(live)
+        db.session.commit()
+
+        row = {'text': 'imported', 'timestamp': '2016-01-01T00:00:00Z'}
+        for _ in range(2):
+            report = Importer(self.user_id).run(lines(row, row))
+            self.assertEqual(report['failed'], 0)
+
+        ids = [id for (id,) in db.session.query(Message.id)
+               .filter(Message.text == 'imported')]
+        self.assertEqual(len(set(ids)), 4)
+        self.assertTrue(all((id >> SEQUENCE_BITS) & MAX_WORKER == IMPORT_WORKER
+                            for id in ids))
+        self.assertTrue(all(timestamp_of(id) == when for id in ids))
+
+    def test_endpoint(self):
+        """Logged-in users POST a JSON lines body and get a report"""
+
+        dispatcher.drain()
+        message_index.clear()
+        message_index.loaded = True
+
+        body = ''.join(lines({'text': 'migrated warble', 'timestamp': '2016-01-01'},
+                             {'text': ''}))
+        with app.test_client() as c:
+            resp = c.post('/messages/import', data=body,
+                          content_type='application/x-ndjson')
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.post('/messages/import', data=body,
+                          content_type='application/x-ndjson')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(), dict(
+            imported=1, failed=1, errors=[dict(line=2, error='text is missing')]))
+
+        # the search index hears about imported messages once they're delivered
+        with app.app_context():
+            dispatcher.drain()
+        [(rank, id)] = message_index.search('migrated')
+        self.assertEqual(Message.query.get(id).text, 'migrated warble')
+
+    def test_command(self):
+        """`flask import-messages` imports a file"""
+
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+            f.writelines(lines({'text': 'from a file'}))
+        try:
+            result = app.test_cli_runner().invoke(
+                args=['import-messages', 'importer', f.name])
+        finally:
+            os.remove(f.name)
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(json.loads(result.output)['imported'], 1)
@@ -0,0 +1,90 @@
+"""Live stream server tests."""
+
+import asyncio
+import json
+from unittest import TestCase
+
+from live import Hub, StreamServer, stream_token
+
+SECRET = "test secret"
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class HubTestCase(TestCase):
+    """Tests for Hub"""
+
+    def test_publish_reaches_followers_only(self):
+        """Events go to queues subscribed to the author"""
+
+        async def check():
+            hub = Hub()
+            q1 = hub.subscribe([1, 2])
+            q2 = hub.subscribe([3])
+
+            hub.publish({'id': 10, 'user': {'id': 2}})
+
+            self.assertEqual(q1.get_nowait()['id'], 10)
+            self.assertTrue(q2.empty())
+
+            hub.unsubscribe([1, 2], q1)
+            self.assertEqual(hub.subscribers, {3: {q2}})
+
+        run(check())
+
+
+class StreamServerTestCase(TestCase):
+    """Tests for StreamServer"""
+
+    async def request(self, server, target, event=None):
+        srv = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = srv.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {target} HTTP/1.1\r\nHost: x\r\n\r\n'.encode())
+
+        status = await reader.readline()
+        if event is not None:
+            while (await reader.readline()) != b'\r\n':
+                pass
+            await asyncio.sleep(0.01)
+            server.hub.publish(event)
+            lines = [await reader.readline() for _ in range(2)]
+        else:
+            lines = []
+
+        writer.close()
+        srv.close()
+        await srv.wait_closed()
+        return status, lines
+
+    def test_stream_delivers_events(self):
+        """A subscribed browser should get followed authors' messages"""
+
+        server = StreamServer(SECRET, {1: [2]}.get)
+        token = stream_token(SECRET, 1)
+        event = {'id': 5, 'text': 'hi', 'user': {'id': 2}}
+
+        status, lines = run(self.request(server, f'/live/stream?token={token}',
+                                         event))
+
+        self.assertIn(b'200', status)
+        self.assertLess(len(token), 100)
+        self.assertEqual(lines[0], b'id: 5\n')
+        self.assertEqual(json.loads(lines[1][len(b'data: '):]), event)
+
+    def test_bad_token(self):
+        """Tokens signed with another key are refused"""
+
+        server = StreamServer(SECRET, {1: [2]}.get)
+        token = stream_token("other secret", 1)
+
+        status, lines = run(self.request(server, f'/live/stream?token={token}'))
+        self.assertIn(b'403', status)
+
+    def test_unknown_path(self):
+        server = StreamServer(SECRET, {}.get)
+
+        status, lines = run(self.request(server, '/nope'))
+        self.assertIn(b'404', status)
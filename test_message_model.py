@@ -1,14 +1,12 @@
 """User model tests."""
 
-import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 from models import db, User, Message, Follows
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from app import create_app
 
-
-from app import app
+app = create_app('test')
 
 db.create_all()
 
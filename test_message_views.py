@@ -5,22 +5,17 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
 from unittest import TestCase
 
 from models import db, connect_db, Message, User
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# The 'test' profile uses a separate database (TEST_DATABASE_URL,
+# default postgresql:///warbler-test) and turns off CSRF.
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from app import create_app, CURR_USER_KEY
+from timelines import high_water_marks
 
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -28,10 +23,6 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -185,3 +176,57 @@ class MessageViewTestCase(TestCase):
             
 
     
+
+    def test_timeline_since(self):
+        """Polling the timeline returns only newer messages, then a 304"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            m = Message(text='first', user_id=self.testuser.id)
+            db.session.add(m)
+            db.session.commit()
+            mid = m.id
+
+            resp = c.get('/timeline?since=0')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([msg['text'] for msg in resp.get_json()['messages']],
+                             ['first'])
+
+            resp = c.get(f'/timeline?since={mid}')
+            self.assertEqual(resp.status_code, 304)
+
+            c.post("/messages/new", data={"text": "second"})
+
+            resp = c.get(f'/timeline?since={mid}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([msg['text'] for msg in resp.get_json()['messages']],
+                             ['second'])
+
+    def test_timeline_since_ignores_made_up_ids(self):
+        """A `since` past every message doesn't hide later posts"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "first"})
+            mid = Message.query.one().id
+
+            resp = c.get(f'/timeline?since={2 ** 62}')
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(high_water_marks.get(self.testuser.id), mid)
+
+            c.post("/messages/new", data={"text": "second"})
+            resp = c.get(f'/timeline?since={mid}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([msg['text'] for msg in resp.get_json()['messages']],
+                             ['second'])
+
+    def test_timeline_since_without_logging_in(self):
+        """Polling the timeline requires a login"""
+
+        with self.client as c:
+            resp = c.get('/timeline?since=0')
+            self.assertEqual(resp.status_code, 401)
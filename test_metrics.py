@@ -0,0 +1,164 @@
+"""Metrics tests."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+from app import create_app
+from config import TestConfig
+from metrics import MmapValues, Registry, read_entries
+import metrics
+
+app = create_app('test')
+
+db.create_all()
+
+
+class MmapValuesTestCase(TestCase):
+    """Tests for MmapValues"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_values_persist_and_grow(self):
+        """Values survive reopening, even after the file had to grow"""
+
+        path = os.path.join(self.dir, 'metrics.1.db')
+        values = MmapValues(path)
+        for i in range(3000):
+            values.add(f'key-{i}', i)
+        values.add('key-7', 1)
+        values.set('gauge', 2.5)
+
+        reopened = MmapValues(path)
+        found = {key: value for key, value, offset in read_entries(reopened.map)}
+
+        self.assertEqual(found['key-7'], 8)
+        self.assertEqual(found['key-2999'], 2999)
+        self.assertEqual(found['gauge'], 2.5)
+
+
+class RegistryTestCase(TestCase):
+    """Tests for Registry"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_counters_are_summed_across_processes(self):
+        """Another process's file is added into the totals"""
+
+        registry = Registry(self.dir)
+        registry.inc('warbler_requests_total', {'endpoint': 'a', 'status': '200'})
+
+        other = MmapValues(os.path.join(self.dir, 'metrics.999999999.db'))
+        other.add(metrics._key('warbler_requests_total',
+                               {'endpoint': 'a', 'status': '200'}), 2)
+        other.set(metrics._key('warbler_db_pool_size', {'pid': '999999999'}), 5)
+
+        text = registry.render()
+
+        self.assertIn('# TYPE warbler_requests_total counter', text)
+        self.assertIn('warbler_requests_total{endpoint="a",status="200"} 3', text)
+        self.assertNotIn('999999999', text)
+
+    def test_dead_processes_are_archived(self):
+        """A dead process's file is folded into the archive and removed"""
+
+        registry = Registry(self.dir)
+        registry.inc('warbler_requests_total', {'endpoint': 'a', 'status': '200'})
+        key = metrics._key('warbler_requests_total', {'endpoint': 'a', 'status': '200'})
+        for pid in (999999998, 999999999):
+            dead = MmapValues(os.path.join(self.dir, f'metrics.{pid}.db'))
+            dead.add(key, 2)
+            dead.close()
+
+        self.assertEqual(registry.collect()[key], 5)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['archive.db', f'metrics.{os.getpid()}.db', 'metrics.lock'])
+        self.assertEqual(registry.collect()[key], 5)
+
+    def test_reused_pid_starts_clean(self):
+        """A new process with an old pid archives what it finds first"""
+
+        key = metrics._key('warbler_db_pool_size', {'pid': str(os.getpid())})
+        old = MmapValues(os.path.join(self.dir, f'metrics.{os.getpid()}.db'))
+        old.add(metrics._key('warbler_requests_total', {}), 4)
+        old.set(key, 9)
+        old.close()
+
+        registry = Registry(self.dir)
+        registry.inc('warbler_requests_total', {})
+        totals = registry.collect()
+
+        self.assertEqual(totals[metrics._key('warbler_requests_total', {})], 5)
+        self.assertNotIn(key, totals)
+
+    def test_histogram(self):
+        """Histograms render cumulative buckets, sum and count"""
+
+        registry = Registry(self.dir)
+        registry.observe('warbler_request_duration_seconds', {'endpoint': 'a'}, 0.2)
+
+        text = registry.render()
+
+        self.assertIn('warbler_request_duration_seconds_bucket{endpoint="a",le="0.1"} 0', text)
+        self.assertIn('warbler_request_duration_seconds_bucket{endpoint="a",le="0.25"} 1', text)
+        self.assertIn('warbler_request_duration_seconds_bucket{endpoint="a",le="+Inf"} 1', text)
+        self.assertIn('warbler_request_duration_seconds_count{endpoint="a"} 1', text)
+
+
+class MetricsEndpointTestCase(TestCase):
+    """Tests for /metrics on an app with metrics enabled"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        config = type('MetricsConfig', (TestConfig,),
+                      dict(METRICS_ENABLED=True, METRICS_DIR=self.dir))
+        self.app = create_app(config)
+
+        User.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.dir)
+
+    def test_metrics_endpoint(self):
+        """Requests, DB/render time and bcrypt work all show up"""
+
+        client = self.app.test_client()
+        client.post('/signup', data={'username': 'testuser',
+                                     'email': 'test@test.com',
+                                     'password': 'testuser'})
+        client.get('/login')
+
+        text = client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('warbler_requests_total{endpoint="warbler.signup",status="302"} 1', text)
+        self.assertIn('warbler_request_duration_seconds_count{endpoint="warbler.login"} 1', text)
+        self.assertIn('warbler_request_render_seconds_total{endpoint="warbler.login"}', text)
+        self.assertIn('warbler_request_db_seconds_total{endpoint="warbler.signup"}', text)
+        self.assertIn('warbler_bcrypt_operations_total{op="hash"} 1', text)
+        self.assertIn('warbler_db_pool_checkout_wait_seconds_count', text)
+
+    def test_each_directory_gets_its_registry(self):
+        """An app with another METRICS_DIR records there"""
+
+        other = tempfile.mkdtemp()
+        try:
+            config = type('OtherMetricsConfig', (TestConfig,),
+                          dict(METRICS_ENABLED=True, METRICS_DIR=other))
+            other_app = create_app(config)
+            self.assertEqual(other_app.extensions['metrics'].directory, other)
+            self.assertEqual(self.app.extensions['metrics'].directory, self.dir)
+        finally:
+            shutil.rmtree(other)
@@ -0,0 +1,229 @@
+"""Outbox and dispatcher tests."""
+
+from unittest import TestCase
+
+from models import db, User, Message, OutboxEvent, ProjectionCheckpoint
+from app import create_app, CURR_USER_KEY
+from outbox import Dispatcher, Event, GAP_RESCAN, GAP_TIMEOUT, emit
+
+app = create_app('test')
+dispatcher = app.extensions['outbox']
+
+db.create_all()
+
+
+class OutboxTestCase(TestCase):
+    """Tests for emit() and local delivery"""
+
+    def setUp(self):
+        db.session.rollback()
+        OutboxEvent.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.user = User.signup('outboxer', 'outboxer@test.com', 'password', None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.seen = []
+        self.projection = dispatcher.subscribe('test', {'test.event'})(self.seen.extend)
+
+    def tearDown(self):
+        db.session.rollback()
+        dispatcher.projections = [p for p in dispatcher.projections if p.name != 'test']
+
+    def test_events_commit_with_the_change(self):
+        """Events are queued on commit, dropped on rollback, delivered by drain()"""
+
+        emit('test.event', self.user_id, n=1)
+        db.session.rollback()
+        dispatcher.drain()
+        self.assertEqual(self.seen, [])
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+        emit('test.event', self.user_id, n=2)
+        db.session.commit()
+        self.assertEqual(self.seen, [])
+        self.assertEqual(OutboxEvent.query.count(), 1)
+
+        dispatcher.drain()
+        self.assertEqual([e.payload for e in self.seen], [{'n': 2}])
+
+    def test_next_request_reads_own_writes(self):
+        """Queued events are delivered before the next request"""
+
+        emit('test.event', self.user_id, n=1)
+        db.session.commit()
+        with app.test_client() as c:
+            c.get('/login')
+        self.assertEqual([e.payload for e in self.seen], [{'n': 1}])
+
+    def test_routes_emit_events(self):
+        """Posting a message writes a message.created event"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            c.post('/messages/new', data={'text': 'hello'})
+
+        event = OutboxEvent.query.one()
+        msg = Message.query.one()
+        self.assertEqual(event.kind, 'message.created')
+        self.assertEqual(event.user_id, self.user_id)
+        self.assertIn(str(msg.id), event.payload)
+
+    def test_each_app_has_its_own_dispatcher(self):
+        """Events queue on the dispatcher of the app they commit in"""
+
+        other = create_app('test')
+        db.app = app
+        mine = other.extensions['outbox']
+        self.assertIsNot(mine, dispatcher)
+        self.assertEqual([p.name for p in mine.projections],
+                         [p.name for p in dispatcher.projections if p.name != 'test'])
+
+        with other.app_context():
+            emit('test.event', self.user_id, n=1)
+            db.session.commit()
+        self.assertEqual([e.payload for e in mine.pending], [{'n': 1}])
+        dispatcher.drain()
+        self.assertEqual(self.seen, [])
+
+        emit('test.event', self.user_id, n=2)
+        db.session.commit()
+        self.assertEqual(len(mine.pending), 1)
+        dispatcher.drain()
+        self.assertEqual([e.payload for e in self.seen], [{'n': 2}])
+
+    def test_tail_skips_own_events(self):
+        """Tailing delivers other processes' events, not our own"""
+
+        d = Dispatcher()
+        seen = []
+        d.subscribe('tail', {'test.event'})(seen.extend)
+        d.tail_local()
+
+        emit('test.event', self.user_id, n=1)
+        db.session.add(OutboxEvent(kind='test.event', user_id=self.user_id,
+                                   origin='elsewhere:1', payload='{"n": 2}'))
+        db.session.commit()
+
+        self.assertEqual(d.tail_local(), 2)
+        self.assertEqual([e.payload for e in seen], [{'n': 2}])
+        self.assertEqual(d.tail_local(), 0)
+
+
+class DurableDispatchTestCase(TestCase):
+    """Tests for durable projections, checkpoints and retries"""
+
+    def setUp(self):
+        db.session.rollback()
+        OutboxEvent.query.delete()
+        ProjectionCheckpoint.query.delete()
+        db.session.commit()
+
+        self.d = Dispatcher()
+        self.batches = []
+        self.fail = False
+
+        def handler(events):
+            if self.fail:
+                raise RuntimeError('down')
+            self.batches.append([e.payload['n'] for e in events])
+
+        self.d.subscribe('durable', {'test.event'}, durable=True,
+                         from_start=True)(handler)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add(self, *ns):
+        for n in ns:
+            emit('test.event', 1, n=n)
+        db.session.commit()
+
+    def test_batches_in_order_with_checkpoint(self):
+        """Events arrive in order, in batches, and only once"""
+
+        self.add(1, 2, 3)
+        self.assertEqual(self.d.run_durable(batch_size=2), 2)
+        self.assertEqual(self.d.run_durable(batch_size=2), 1)
+        self.assertEqual(self.d.run_durable(batch_size=2), 0)
+        self.assertEqual(self.batches, [[1, 2], [3]])
+
+        checkpoint = ProjectionCheckpoint.query.get(('durable', '0'))
+        self.assertEqual(checkpoint.position, OutboxEvent.query
+                         .order_by(OutboxEvent.id.desc()).first().id)
+
+    def test_prune_deletes_read_events(self):
+        """Only events every durable projection has read are pruned"""
+
+        self.add(1, 2, 3)
+        self.assertEqual(self.d.prune(-60, batch_size=2), 0)
+        self.d.run_durable(batch_size=2)
+        self.assertEqual(self.d.prune(-60, batch_size=2), 2)
+        self.assertEqual([e.payload for e in OutboxEvent.query], ['{"n": 3}'])
+        self.assertEqual(self.d.prune(3600), 0)
+
+        self.d.run_durable()
+        self.assertEqual(self.d.prune(-60, batch_size=2), 1)
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+    def test_failures_retry_with_backoff(self):
+        """A failing batch is retried after a delay, never skipped"""
+
+        self.add(1)
+        self.fail = True
+        self.assertEqual(self.d.run_durable(now=1000), 0)
+
+        checkpoint = ProjectionCheckpoint.query.get(('durable', '0'))
+        self.assertEqual(checkpoint.failures, 1)
+        self.assertIn('down', checkpoint.last_error)
+
+        self.fail = False
+        self.assertEqual(self.d.run_durable(now=1000.5), 0)
+        self.assertEqual(self.d.run_durable(now=1002), 1)
+        self.assertEqual(self.batches, [[1]])
+        self.assertEqual(ProjectionCheckpoint.query.get(('durable', '0')).failures, 0)
+
+    def test_gaps_wait_until_old(self):
+        """Events after a missing id wait for GAP_TIMEOUT"""
+
+        events = [Event(5, 'test.event', 1, {}, 'x'), Event(6, 'test.event', 1, {}, 'x')]
+
+        self.assertEqual(self.d._ready('k', events, 3, now=100), [])
+        self.assertEqual(self.d._ready('k', events, 3, now=100 + GAP_TIMEOUT), events)
+        self.assertEqual(self.d._ready('k', events, 4, now=100), events)
+
+    def test_late_commits_are_still_delivered(self):
+        """Events that commit after their gap was stepped over arrive later"""
+
+        self.add(1)
+        first = OutboxEvent.query.one().id
+        late = OutboxEvent(id=first + 1, kind='test.event', user_id=1,
+                           origin='x', payload='{"n": 2}')
+        db.session.add(OutboxEvent(id=first + 2, kind='test.event', user_id=1,
+                                   origin='x', payload='{"n": 3}'))
+        db.session.commit()
+
+        self.assertEqual(self.d.run_durable(now=100), 1)
+        self.assertEqual(self.d.run_durable(now=100 + GAP_TIMEOUT), 1)
+        checkpoint = ProjectionCheckpoint.query.get(('durable', '0'))
+        self.assertEqual(checkpoint.position, first + 2)
+        self.assertIn(str(first + 1), checkpoint.skipped)
+
+        # a fresh dispatcher still knows from the checkpoint
+        self.d.gaps.clear()
+        db.session.add(late)
+        db.session.commit()
+        self.assertEqual(self.d.run_durable(now=200), 1)
+        self.assertEqual(self.batches, [[1], [3], [2]])
+        self.assertIsNone(ProjectionCheckpoint.query.get(('durable', '0')).skipped)
+
+    def test_skipped_ids_are_forgotten(self):
+        """Ids that never turn up are dropped after GAP_RESCAN"""
+
+        skipped = {7: 100}
+        self.assertEqual(self.d._rescan(None, skipped, 100 + GAP_RESCAN), [])
+        self.assertEqual(skipped, {})
@@ -0,0 +1,87 @@
+"""Sampling profiler tests."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db
+from app import create_app
+from config import TestConfig
+from profiling import StackSampler
+
+app = create_app('test')
+
+db.create_all()
+
+
+def busy_wait(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class StackSamplerTestCase(TestCase):
+    """Tests for StackSampler"""
+
+    def test_samples_watched_thread(self):
+        """Samples should show the function the thread was busy in"""
+
+        sampler = StackSampler(interval=0.001)
+        thread_id = threading.get_ident()
+
+        sampler.start(thread_id)
+        busy_wait(0.05)
+        counts = sampler.stop(thread_id)
+
+        self.assertTrue(counts)
+        self.assertTrue(any('busy_wait (test_profiling.py' in stack
+                            for stack in counts))
+
+
+class ProfilerTestCase(TestCase):
+    """Tests for the profiling hooks on the app"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_app(self, **settings):
+        config = type('ProfiledConfig', (TestConfig,),
+                      dict(PROFILE_DIR=self.dir, PROFILE_INTERVAL=0.001,
+                           **settings))
+        return create_app(config)
+
+    def test_disabled_installs_nothing(self):
+        """Without a rate or header, no profiler hooks are installed"""
+
+        app = self.make_app(PROFILE_SAMPLE_RATE=0, PROFILE_HEADER=None)
+        self.assertNotIn('profiler', app.extensions)
+
+    def test_header_writes_collapsed_stacks(self):
+        """A request with the profile header writes a per-endpoint file"""
+
+        app = self.make_app(PROFILE_SAMPLE_RATE=0, PROFILE_HEADER='X-Profile')
+
+        @app.route('/slow')
+        def slow():
+            busy_wait(0.05)
+            return 'done'
+
+        client = app.test_client()
+        client.get('/slow')
+        self.assertEqual(os.listdir(self.dir), [])
+
+        client.get('/slow', headers={'X-Profile': '1'})
+
+        path = os.path.join(self.dir, f'slow.{os.getpid()}.collapsed')
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+        self.assertTrue(lines)
+        self.assertTrue(any('slow (test_profiling.py' in line for line in lines))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
@@ -0,0 +1,135 @@
+"""Rate limiting tests."""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+from app import create_app, CURR_USER_KEY
+from config import TestConfig
+from ratelimit import FileStore, MemoryStore, parse_limit
+
+app = create_app(type('LimitedConfig', (TestConfig,), dict(
+    RATELIMIT_ENABLED=True,
+    RATELIMIT_STORE='memory',
+    RATELIMIT_LIMITS={
+        'warbler.login': {'ip': '3/minute', 'username': '2/minute'},
+        'warbler.like_user_post': {'user': '1/hour'},
+    })))
+
+db.create_all()
+
+
+class BucketTestCase(TestCase):
+    """Tests for the token buckets"""
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit('10/minute'), (10 / 60, 10))
+        self.assertEqual(parse_limit('2/seconds'), (2, 2))
+
+    def check_store(self, store):
+        buckets = [('a', 1.0, 2), ('b', 0.5, 5)]
+
+        self.assertEqual(store.take(buckets, now=100), 0)
+        self.assertEqual(store.take(buckets, now=100), 0)
+        # 'a' is empty: refused, and 'b' keeps its tokens
+        self.assertEqual(store.take(buckets, now=100), 1.0)
+        self.assertEqual(store.take([('b', 0.5, 5)], now=100), 0)
+        # half a second refills half a token
+        self.assertEqual(store.take(buckets, now=100.5), 0.5)
+        self.assertEqual(store.take(buckets, now=101), 0)
+
+    def test_memory_store(self):
+        """Buckets refill over time and a refused take spends nothing"""
+
+        self.check_store(MemoryStore())
+
+    def test_file_store(self):
+        """The SQLite store behaves the same, and is shared by instances"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'limits.sqlite')
+            self.check_store(FileStore(path))
+
+            other = FileStore(path)
+            self.assertEqual(other.take([('a', 1.0, 2)], now=101), 1.0)
+
+            other.prune(now=1000)
+            self.assertEqual(other._conn().execute(
+                'SELECT count(*) FROM buckets').fetchone()[0], 0)
+
+
+class RateLimitedViewsTestCase(TestCase):
+    """Tests for the 429s"""
+
+    def setUp(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions['rate_limiter'].store = MemoryStore()
+
+    def test_login_limits(self):
+        """Repeated logins get a 429, per username and per address"""
+
+        with app.test_client() as c:
+            for _ in range(2):
+                resp = c.post('/login', data={'username': 'bob', 'password': 'x'})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post('/login', data={'username': 'bob', 'password': 'x'})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers['Retry-After'], '30')
+
+            resp = c.post('/login', data={'username': 'alice', 'password': 'x'})
+            self.assertEqual(resp.status_code, 200)
+            resp = c.post('/login', data={'username': 'carol', 'password': 'x'})
+            self.assertEqual(resp.status_code, 429)
+
+            # showing the form isn't limited
+            self.assertEqual(c.get('/login').status_code, 200)
+
+    def test_username_limit_is_per_address(self):
+        """Failed logins from one address don't lock the user out elsewhere"""
+
+        with app.test_client() as c:
+            for _ in range(2):
+                c.post('/login', data={'username': 'bob', 'password': 'x'})
+            resp = c.post('/login', data={'username': 'bob', 'password': 'x'})
+            self.assertEqual(resp.status_code, 429)
+
+            resp = c.post('/login', data={'username': 'bob', 'password': 'x'},
+                          environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_refused_requests_skip_the_database(self):
+        """A 429 is answered before the user is loaded"""
+
+        user = User.signup('limited', 'limited@test.com', 'password', None)
+        author = User.signup('author', 'author@test.com', 'password', None)
+        db.session.commit()
+        message = Message(text='like me', user_id=author.id)
+        db.session.add(message)
+        db.session.commit()
+        url = f'/users/add_like/{message.id}'
+
+        queries = []
+
+        def count(*args):
+            queries.append(args)
+
+        from sqlalchemy import event
+        engine = db.get_engine(app)
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+            c.post(url)
+
+            event.listen(engine, 'before_cursor_execute', count)
+            try:
+                resp = c.post(url)
+            finally:
+                event.remove(engine, 'before_cursor_execute', count)
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(queries, [])
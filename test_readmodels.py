@@ -0,0 +1,106 @@
+"""Read model tests."""
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+from app import create_app
+from readmodels import (MessageRow, followed_among, followed_ids, follower_ids,
+                        follow_page, author_rows, message_rows, user_stats)
+
+app = create_app('test')
+
+db.create_all()
+
+
+class ReadModelsTestCase(TestCase):
+    """Tests for the projected read paths"""
+
+    def setUp(self):
+        db.session.rollback()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup('reader1', 'reader1@test.com', 'password', None)
+        u2 = User.signup('reader2', 'reader2@test.com', 'password', None)
+        u3 = User.signup('reader3', 'reader3@test.com', 'password', None)
+        db.session.commit()
+        u1.following.extend([u2, u3])
+        u3.following.append(u1)
+
+        m1 = Message(text='one', user_id=u2.id)
+        m2 = Message(text='two', user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+        db.session.add(Likes(user_id=u1.id, message_id=m1.id))
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = u1.id, u2.id, u3.id
+        self.m1_id, self.m2_id = m1.id, m2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_follow_ids(self):
+        """Follow sets come back as plain ids"""
+
+        self.assertEqual(sorted(followed_ids(self.u1_id)),
+                         sorted([self.u2_id, self.u3_id]))
+        self.assertEqual(follower_ids(self.u1_id), [self.u3_id])
+
+    def test_follow_page(self):
+        """Follow listings page by id and carry just the card columns"""
+
+        first, after = follow_page(self.u1_id, limit=1)
+        second, last = follow_page(self.u1_id, after=after, limit=1)
+
+        ids = sorted([self.u2_id, self.u3_id])
+        self.assertEqual([card.id for card in first + second], ids)
+        self.assertEqual(after, ids[0])
+        self.assertIsNone(last)
+        self.assertEqual(first[0]._fields,
+                         ('id', 'username', 'image_url', 'header_image_url', 'bio'))
+
+        followers, after = follow_page(self.u1_id, followers=True)
+        self.assertEqual([card.username for card in followers], ['reader3'])
+        self.assertIsNone(after)
+
+        self.assertEqual(followed_among(self.u1_id, [self.u2_id, self.u1_id]),
+                         {self.u2_id})
+
+    def test_message_rows(self):
+        """Rows keep the requested order and share their author"""
+
+        rows = message_rows([self.m2_id, 12345, self.m1_id])
+
+        self.assertEqual([r.text for r in rows], ['two', 'one'])
+        self.assertIsInstance(rows[0], MessageRow)
+        self.assertIs(rows[0].user, rows[1].user)
+        self.assertEqual(rows[0].user.username, 'reader2')
+        self.assertFalse(hasattr(rows[0], '__dict__'))
+        self.assertEqual(message_rows([]), [])
+
+    def test_author_rows(self):
+        """Authors carry only what the templates render"""
+
+        rows = author_rows([self.u3_id, self.u1_id])
+
+        self.assertEqual([r.username for r in rows], ['reader3', 'reader1'])
+        self.assertEqual(rows[0]._fields, ('id', 'username', 'image_url'))
+
+    def test_user_stats(self):
+        """Counts for the profile card"""
+
+        self.assertEqual(tuple(user_stats(self.u1_id)), (0, 2, 1, 1))
+        self.assertEqual(tuple(user_stats(self.u2_id)), (2, 0, 1, 0))
+
+    def test_no_entities_loaded(self):
+        """Read paths leave the identity map alone"""
+
+        db.session.expunge_all()
+        followed_ids(self.u1_id)
+        message_rows([self.m1_id, self.m2_id])
+        user_stats(self.u1_id)
+
+        self.assertEqual(len(db.session.identity_map), 0)
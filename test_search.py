@@ -0,0 +1,133 @@
+"""Message search tests."""
+
+from unittest import TestCase
+
+from models import db, User, Message
+from app import create_app, CURR_USER_KEY
+from search import InvertedIndex, PostingList, format_cursor, parse_cursor, terms
+
+app = create_app('test')
+message_index = app.extensions['message_index']
+
+db.create_all()
+
+
+class InvertedIndexTestCase(TestCase):
+    """Tests for the in-memory index"""
+
+    def setUp(self):
+        self.index = InvertedIndex(compact_ratio=0.5)
+        # loaded, so nothing is read from the database
+        self.index.loaded = True
+
+    def test_posting_list_round_trip(self):
+        """Postings stay in id order however they are added"""
+
+        postings = PostingList()
+        for id, tf in [(5, 1), (300, 2), (2 ** 60, 1), (7, 3), (300, 9)]:
+            postings.add(id, tf)
+
+        self.assertEqual(list(postings), [(5, 1), (7, 3), (300, 2), (2 ** 60, 1)])
+        self.assertEqual(len(postings), 4)
+        self.assertEqual(list(postings.without({7})), [(5, 1), (300, 2), (2 ** 60, 1)])
+
+    def test_terms(self):
+        """Words are lowercased and stop words dropped"""
+
+        self.assertEqual(terms("The Cat sat on the mat, cat!"),
+                         ['cat', 'sat', 'mat', 'cat'])
+
+    def test_ranking(self):
+        """Every term must match; rarer terms and repeats rank higher"""
+
+        self.index.add(1, "coffee and cake")
+        self.index.add(2, "coffee coffee coffee")
+        self.index.add(3, "tea and cake")
+        self.index.add(4, "more coffee please")
+
+        self.assertEqual([id for rank, id in self.index.search("coffee")], [2, 4, 1])
+        self.assertEqual([id for rank, id in self.index.search("coffee cake")], [1])
+        self.assertEqual(self.index.search("coffee scones"), [])
+        self.assertEqual(self.index.search("the"), [])
+
+    def test_pages_follow_the_cursor(self):
+        """Pages continue after the cursor without repeats or gaps"""
+
+        for id in range(1, 8):
+            self.index.add(id, "hello world")
+
+        seen = []
+        after = None
+        while True:
+            page = self.index.search("hello", after, limit=3)
+            if not page:
+                break
+            seen.extend(id for rank, id in page)
+            after = parse_cursor(format_cursor(*page[-1]))
+
+        self.assertEqual(seen, [7, 6, 5, 4, 3, 2, 1])
+
+    def test_remove_and_compact(self):
+        """Removed messages stop matching and are compacted away"""
+
+        for id in range(1, 5):
+            self.index.add(id, "hello")
+        self.index.remove(2)
+        self.assertEqual([id for rank, id in self.index.search("hello")], [4, 3, 1])
+        self.assertEqual(self.index.deleted, {2})
+
+        self.index.remove(3)
+        self.assertEqual(self.index.deleted, set())
+        self.assertEqual(list(self.index.postings['hello']), [(1, 1), (4, 1)])
+
+
+class SearchViewTestCase(TestCase):
+    """Tests for /search"""
+
+    def setUp(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        message_index.clear()
+
+        self.user = User.signup('searcher', 'searcher@test.com', 'password', None)
+        db.session.add(Message(text="an early warble about birds", user=self.user))
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_index_follows_new_and_deleted_messages(self):
+        """Posted messages become searchable and deleted ones vanish"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            html = c.get('/search?q=birds').get_data(as_text=True)
+            self.assertIn('an early warble about birds', html)
+
+            c.post('/messages/new', data={'text': 'more birds today'})
+            html = c.get('/search?q=birds').get_data(as_text=True)
+            self.assertIn('more birds today', html)
+
+            msg = Message.query.filter_by(text='more birds today').one()
+            c.post(f'/messages/{msg.id}/delete')
+            html = c.get('/search?q=birds').get_data(as_text=True)
+            self.assertNotIn('more birds today', html)
+            self.assertIn('an early warble about birds', html)
+
+    def test_more_link(self):
+        """A 'More' link carries the cursor to the next page"""
+
+        for i in range(25):
+            db.session.add(Message(text=f"birds {i}", user_id=self.user_id))
+        db.session.commit()
+
+        html = self.client.get('/search?q=birds').get_data(as_text=True)
+        self.assertIn('after=', html)
+        self.assertEqual(html.count('class="message-link"'), 20)
@@ -0,0 +1,98 @@
+"""Preforking server tests."""
+
+import http.client
+import os
+import signal
+import subprocess
+import sys
+from unittest import TestCase
+
+from models import db
+from app import create_app
+from serve import Recycler, THREADS_PER_CORE, cores, default_threads, reset_after_fork
+
+app = create_app('test')
+
+db.create_all()
+
+
+class RecyclerTestCase(TestCase):
+    """Tests for the worker recycling middleware"""
+
+    def test_asks_for_restart_after_max_requests(self):
+        """on_limit fires once the request budget is spent"""
+
+        calls = []
+        recycler = Recycler(lambda environ, start_response: [b'ok'],
+                            max_requests=2, on_limit=lambda: calls.append(1))
+
+        recycler({}, None)
+        self.assertEqual(calls, [])
+        recycler({}, None)
+        self.assertEqual(calls, [1])
+
+
+class SizingTestCase(TestCase):
+    """Tests for the default pool sizes"""
+
+    def test_threads_shared_between_workers(self):
+        """Workers split a few threads per core between them"""
+
+        total = THREADS_PER_CORE * cores()
+        self.assertEqual(default_threads(1), total)
+        self.assertGreaterEqual(default_threads(cores()) * cores(), total)
+        self.assertEqual(default_threads(total * 2), 1)
+
+
+class ResetAfterForkTestCase(TestCase):
+    """Tests for setting up a forked worker"""
+
+    def setUp(self):
+        self.message_ids = app.extensions['message_ids']
+
+    def tearDown(self):
+        app.config['OUTBOX_DURABLE'] = True
+        app.extensions['message_ids'] = self.message_ids
+
+    def test_slots(self):
+        """Workers get their slot as worker id; only slot 0 runs durable projections"""
+
+        reset_after_fork(app, 0)
+        self.assertEqual(app.extensions['message_ids'].worker_id, 0)
+        self.assertTrue(app.config['OUTBOX_DURABLE'])
+
+        reset_after_fork(app, 3)
+        self.assertEqual(app.extensions['message_ids'].worker_id, 3)
+        self.assertFalse(app.config['OUTBOX_DURABLE'])
+
+
+class ServerTestCase(TestCase):
+    """Tests for serve.py as a running server"""
+
+    def test_serves_through_recycling_and_stops(self):
+        """Requests keep succeeding while workers recycle; SIGTERM stops it"""
+
+        proc = subprocess.Popen(
+            [sys.executable, 'serve.py', '--config', 'test',
+             '--bind', '127.0.0.1:0', '--workers', '2', '--threads', '2',
+             '--max-requests', '3'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            banner = proc.stdout.readline()
+            port = int(banner.rsplit(':', 1)[1])
+
+            statuses = []
+            for _ in range(12):
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                conn.request('GET', '/login')
+                statuses.append(conn.getresponse().status)
+                conn.close()
+            self.assertEqual(statuses, [200] * 12)
+
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(proc.wait(timeout=30), 0)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
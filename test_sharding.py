@@ -0,0 +1,247 @@
+"""Sharding tests, run against three SQLite files.
+
+db.session makes sessions for the current app, so the tests run inside
+the sharded app's context.
+"""
+
+import os
+import shutil
+import tempfile
+from collections import Counter
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+
+from models import (db, ArchivedMessageIds, ArchivedMessages, User, UserName,
+                    Message, Follows, Likes)
+from app import create_app, CURR_USER_KEY
+from archive import save_chunks
+from config import TestConfig
+from sharding import RoutingQuery, shard_for, owner_values
+
+SHARD_DIR = tempfile.mkdtemp()
+SHARD_URLS = ['sqlite:///' + os.path.join(SHARD_DIR, f'shard{i}.db')
+              for i in range(3)]
+
+app = create_app(type('ShardConfig', (TestConfig,), dict(SHARD_URLS=SHARD_URLS)))
+router = app.extensions['shards']
+router.create_all()
+
+context = app.app_context()
+
+
+def setUpModule():
+    db.session.remove()
+    context.push()
+
+
+def tearDownModule():
+    context.pop()
+    for engine in router.engines.values():
+        engine.dispose()
+    shutil.rmtree(SHARD_DIR)
+
+
+class ShardChoiceTestCase(TestCase):
+    """Tests for picking shards"""
+
+    def test_shard_for_is_stable_and_spread(self):
+        """A user always maps to the same shard, and users spread out"""
+
+        self.assertEqual(shard_for(12345, 3), shard_for(12345, 3))
+        counts = Counter(shard_for(id << 22, 3) for id in range(3000))
+        self.assertEqual(set(counts), {'0', '1', '2'})
+        self.assertTrue(all(n > 800 for n in counts.values()))
+
+    def test_owner_values(self):
+        """Only conditions that pin owner columns route a query"""
+
+        self.assertEqual(owner_values(Message.user_id == 5), {5})
+        self.assertEqual(owner_values(db.and_(Follows.user_following_id == 5,
+                                              Follows.user_being_followed_id == 6)),
+                         {5})
+        self.assertEqual(owner_values(User.id.in_([1, 2])), {1, 2})
+        self.assertIsNone(owner_values(User.username == 'bob'))
+        self.assertIsNone(owner_values(db.or_(User.id == 1, User.username == 'bob')))
+
+    def test_other_apps_keep_plain_sessions(self):
+        """Sharding one app leaves another app's sessions alone"""
+
+        self.assertIsInstance(db.session(), ShardedSession)
+
+        plain = create_app('test')
+        with plain.app_context():
+            db.session.remove()
+            self.assertNotIsInstance(db.session(), ShardedSession)
+            self.assertNotIsInstance(User.query, RoutingQuery)
+        db.session.remove()
+        self.assertIsInstance(db.session(), ShardedSession)
+
+
+class ShardedAppTestCase(TestCase):
+    """Tests for the app running over several shards"""
+
+    def setUp(self):
+        db.session.rollback()
+        for shard_id in router.shard_ids:
+            conn = db.session.connection(shard_id=shard_id)
+            for table in (Likes, Follows, ArchivedMessageIds, ArchivedMessages,
+                          Message, User, UserName):
+                conn.execute(table.__table__.delete())
+        db.session.commit()
+
+        self.users = [User.signup(f'sharded{i}', f'sharded{i}@test.com',
+                                  'password', None)
+                      for i in range(6)]
+        db.session.commit()
+        self.ids = [u.id for u in self.users]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def rows_on(self, shard_id, table):
+        with router.engines[shard_id].connect() as conn:
+            return conn.execute(select([table.__table__])).fetchall()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_users_live_on_their_shard(self):
+        """Each user row is on shard_for(id) and nowhere else"""
+
+        for shard_id in router.shard_ids:
+            ids = {row.id for row in self.rows_on(shard_id, User)}
+            self.assertEqual(ids, {id for id in self.ids
+                                   if router.shard_for(id) == shard_id})
+        self.assertEqual(len(User.query.all()), 6)
+        self.assertEqual(User.query.get(self.ids[3]).username, 'sharded3')
+
+    def test_home_timeline_gathers_across_shards(self):
+        """Posts by followed users on other shards reach the home page"""
+
+        me = self.ids[0]
+        with self.client as c:
+            self.login(c, me)
+            for other in self.ids[1:]:
+                c.post(f'/users/follow/{other}')
+            for i, author in enumerate(self.ids):
+                self.login(c, author)
+                c.post('/messages/new', data={'text': f'post {i}'})
+
+            # messages and follows live with their authors
+            for shard_id in router.shard_ids:
+                for row in self.rows_on(shard_id, Message):
+                    self.assertEqual(router.shard_for(row.user_id), shard_id)
+            self.assertEqual(len(self.rows_on(router.shard_for(me), Follows)), 5)
+
+            self.login(c, me)
+            html = c.get('/').get_data(as_text=True)
+            for i in range(6):
+                self.assertIn(f'post {i}', html)
+
+            texts = [m['text'] for m in c.get('/timeline?since=0').get_json()['messages']]
+            self.assertEqual(texts, [f'post {i}' for i in reversed(range(6))])
+
+            html = c.get(f'/users/{me}/following').get_data(as_text=True)
+            self.assertIn('sharded5', html)
+
+    def test_likes_and_deletes_across_shards(self):
+        """Likes route to the liker and deleting cascades across shards"""
+
+        author, fan = self.ids[0], self.ids[1]
+        with self.client as c:
+            self.login(c, author)
+            c.post('/messages/new', data={'text': 'likeable'})
+            msg_id = Message.query.filter(Message.user_id == author).one().id
+
+            self.login(c, fan)
+            c.post(f'/users/follow/{author}')
+            c.post(f'/users/add_like/{msg_id}', headers={'Referer': '/'})
+            self.assertEqual(len(self.rows_on(router.shard_for(fan), Likes)), 1)
+
+            html = c.get(f'/users/{fan}/likes').get_data(as_text=True)
+            self.assertIn('likeable', html)
+
+            self.login(c, author)
+            c.post('/users/delete')
+
+        self.assertIsNone(User.query.get(author))
+        self.assertEqual(Follows.query.filter(
+            Follows.user_being_followed_id == author).all(), [])
+        self.assertEqual(Likes.query.filter(Likes.message_id == msg_id).all(), [])
+
+    def test_names_are_unique_across_shards(self):
+        """A username or email taken on one shard can't be reused on another"""
+
+        holders = {'sharded0': self.ids[0], 'newcomer': self.ids[1]}
+        shards = set()
+        for username, email in (('sharded0', 'new@test.com'),
+                                ('newcomer', 'sharded1@test.com')):
+            # new users land on random shards; try until others are hit
+            for attempt in range(6):
+                user = User.signup(username, email, 'password', None)
+                with self.assertRaises(IntegrityError):
+                    db.session.commit()
+                shards.add(router.shard_for(user.id) !=
+                           router.shard_for(holders[username]))
+                db.session.rollback()
+        self.assertIn(True, shards)
+        self.assertEqual(len(User.query.all()), 6)
+
+        with self.client as c:
+            resp = c.post('/signup', data={'username': 'sharded2',
+                                           'email': 'other@test.com',
+                                           'password': 'password'})
+            self.assertIn('Username already taken', resp.get_data(as_text=True))
+
+        # renaming frees the old name
+        user = User.query.get(self.ids[4])
+        user.username = 'renamed'
+        db.session.commit()
+        User.signup('sharded4', 'again@test.com', 'password', None)
+        db.session.commit()
+        names = {row.name for row in self.rows_on('0', UserName)}
+        self.assertIn('renamed', names)
+        self.assertIn('sharded4', names)
+
+    def test_sweep_finishes_failed_cleanups(self):
+        """sweep() removes likes and follows left by half-done deletes"""
+
+        author, fan = self.ids[0], self.ids[1]
+        msg = Message(text='gone soon', user_id=author)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Likes(user_id=fan, message_id=msg.id))
+        db.session.add(Follows(user_following_id=fan, user_being_followed_id=author))
+        # a like of an archived message is kept
+        archived_author = self.ids[2]
+        with router.engines[router.shard_for(archived_author)].begin() as conn:
+            save_chunks(conn, [(1, archived_author, datetime(2016, 1, 1), 'old')])
+        db.session.add(Likes(user_id=fan, message_id=1))
+        db.session.commit()
+
+        # the author's shard committed, the fan's never did
+        with router.engines[router.shard_for(author)].begin() as conn:
+            conn.execute(Message.__table__.delete())
+            conn.execute(User.__table__.delete().where(User.id == author))
+        with router.engines['0'].begin() as conn:
+            conn.execute(UserName.__table__.delete().where(
+                UserName.user_id == self.ids[2]))
+
+        counts = router.sweep()
+        self.assertEqual((counts['likes'], counts['follows']), (1, 1))
+        self.assertEqual((counts['names_released'], counts['names_claimed']), (2, 2))
+        self.assertEqual(counts['conflicts'], [])
+        self.assertEqual([like.message_id for like
+                          in self.rows_on(router.shard_for(fan), Likes)], [1])
+        self.assertEqual(self.rows_on(router.shard_for(fan), Follows), [])
+
+        counts = router.sweep()
+        self.assertEqual(counts, dict(likes=0, follows=0, names_released=0,
+                                      names_claimed=0, conflicts=[]))
@@ -0,0 +1,79 @@
+"""Single-flight coalescing tests."""
+
+import threading
+import time
+from unittest import TestCase
+
+from singleflight import SingleFlight
+
+
+class SingleFlightTestCase(TestCase):
+    """Tests for SingleFlight"""
+
+    def run_concurrently(self, n, target):
+        results = [None] * n
+
+        def run(i):
+            try:
+                results[i] = target()
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_one_computation(self):
+        """Only one of many concurrent callers should do the work"""
+
+        flights = SingleFlight()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'profile'
+
+        results = self.run_concurrently(10, lambda: flights.do('k', compute))
+
+        self.assertEqual(results, ['profile'] * 10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.calls, {})
+
+    def test_errors_are_shared(self):
+        """Waiters should see the leader's exception"""
+
+        flights = SingleFlight()
+
+        def compute():
+            time.sleep(0.1)
+            raise LookupError('missing')
+
+        results = self.run_concurrently(5, lambda: flights.do('k', compute))
+
+        self.assertTrue(all(isinstance(r, LookupError) for r in results))
+
+    def test_timeout_falls_back_to_own_computation(self):
+        """A waiter that times out computes the value itself"""
+
+        flights = SingleFlight()
+        release = threading.Event()
+        leader = threading.Thread(
+            target=lambda: flights.do('k', lambda: release.wait(1)))
+        leader.start()
+        time.sleep(0.05)
+
+        self.assertEqual(flights.do('k', lambda: 'own', timeout=0.05), 'own')
+
+        release.set()
+        leader.join()
+
+    def test_different_keys_do_not_wait(self):
+        """Each key is computed independently"""
+
+        flights = SingleFlight()
+        self.assertEqual(flights.do('a', lambda: 1), 1)
+        self.assertEqual(flights.do('b', lambda: 2), 2)
@@ -0,0 +1,105 @@
+"""Slow-query log tests."""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User
+from app import create_app
+from config import TestConfig
+from slowlog import normalize, parameter_shape, RateLimiter
+
+app = create_app('test')
+
+db.create_all()
+
+
+class NormalizeTestCase(TestCase):
+    """Tests for normalize and parameter_shape"""
+
+    def test_normalize(self):
+        """Literals, placeholders and IN lists collapse"""
+
+        self.assertEqual(
+            normalize("SELECT * FROM users\n  WHERE id IN (%(id_1)s, %(id_2)s) "
+                      "AND username = 'bob' AND age > 30"),
+            "SELECT * FROM users WHERE id IN (...) AND username = ? AND age > ?")
+        self.assertEqual(normalize("SELECT anon_1 FROM t WHERE x = ?"),
+                         "SELECT anon_1 FROM t WHERE x = ?")
+
+    def test_parameter_shape(self):
+        """Only parameter types are kept, never values"""
+
+        self.assertEqual(parameter_shape({'b': 'secret', 'a': 1}),
+                         {'a': 'int', 'b': 'str'})
+        self.assertEqual(parameter_shape((1, 'x')), ['int', 'str'])
+        self.assertEqual(parameter_shape([(1,), (2,)], executemany=True),
+                         {'rows': 2, 'row': ['int']})
+
+
+class RateLimiterTestCase(TestCase):
+    """Tests for RateLimiter"""
+
+    def test_reports_dropped_lines(self):
+        """Lines over the limit are dropped and counted on the next one"""
+
+        limiter = RateLimiter(2)
+        second = int(time.time())
+        while int(time.time()) == second:
+            pass
+
+        self.assertEqual(limiter.allow(), (True, 0))
+        self.assertEqual(limiter.allow(), (True, 0))
+        self.assertEqual(limiter.allow(), (False, 0))
+
+        time.sleep(1)
+        self.assertEqual(limiter.allow(), (True, 1))
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Tests for logging slow statements from requests"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'slow.jsonl')
+        config = type('SlowConfig', (TestConfig,),
+                      dict(SLOW_QUERY_MS=0, SLOW_QUERY_LOG=self.path,
+                           SLOW_QUERY_EXPLAIN_RATE=1.0,
+                           SLOW_QUERY_MAX_PER_SECOND=1000))
+        self.app = create_app(config)
+
+        @self.app.route('/count')
+        def count():
+            return str(User.query.filter(User.username == 'someone').count())
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.dir)
+
+    def read_log(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_slow_queries_are_logged_with_explain(self):
+        """Each slow statement is logged with its endpoint and a plan"""
+
+        self.app.test_client().get('/count')
+
+        for _ in range(50):
+            entries = self.read_log()
+            if any(e['type'] == 'explain' for e in entries):
+                break
+            time.sleep(0.05)
+
+        slow = [e for e in entries if e['type'] == 'slow_query'
+                and 'FROM users' in e['sql']]
+        self.assertTrue(slow)
+        self.assertEqual(slow[0]['endpoint'], 'count')
+        self.assertNotIn('someone', json.dumps(entries))
+
+        explains = [e for e in entries if e['type'] == 'explain']
+        self.assertTrue(explains)
+        self.assertEqual(explains[0]['fingerprint'], slow[0]['fingerprint'])
@@ -0,0 +1,101 @@
+"""Snowflake id tests."""
+
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message
+from app import create_app
+from snowflake import SnowflakeGenerator, timestamp_of, SEQUENCE_BITS
+
+app = create_app('test')
+
+db.create_all()
+
+
+class SnowflakeGeneratorTestCase(TestCase):
+    """Tests for SnowflakeGenerator"""
+
+    def test_ids_increase_and_encode_time(self):
+        """Ids are increasing and carry their creation time"""
+
+        ids = SnowflakeGenerator(worker_id=3)
+        before = datetime.utcnow() - timedelta(milliseconds=1)
+        generated = [ids.next_id() for _ in range(10000)]
+        after = datetime.utcnow() + timedelta(milliseconds=1)
+
+        self.assertEqual(generated, sorted(set(generated)))
+        self.assertTrue(before <= timestamp_of(generated[0]) <= after)
+        self.assertTrue(all(0 < id < 2 ** 63 for id in generated))
+        self.assertEqual((generated[0] >> SEQUENCE_BITS) & 1023, 3)
+
+    def test_unique_across_threads(self):
+        """Concurrent callers never get the same id"""
+
+        ids = SnowflakeGenerator(worker_id=1)
+        generated = []
+
+        def run():
+            generated.extend(ids.next_id() for _ in range(2000))
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(generated)), 8000)
+
+    def test_workers_differ(self):
+        """Two workers in the same millisecond get different ids"""
+
+        self.assertNotEqual(SnowflakeGenerator(worker_id=1).next_id(),
+                            SnowflakeGenerator(worker_id=2).next_id())
+
+    def test_id_for(self):
+        """Ids for past times sort with their times"""
+
+        ids = SnowflakeGenerator(worker_id=0)
+        old = datetime(2017, 1, 21, 11, 4, 53, 522000)
+
+        self.assertEqual(timestamp_of(ids.id_for(old)), old)
+        self.assertLess(ids.id_for(old), ids.next_id())
+
+    def test_bad_worker_id(self):
+        """Worker ids must fit in 10 bits"""
+
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator().configure(1024)
+
+
+class MessageIdTestCase(TestCase):
+    """Tests for ids and timestamps of new messages"""
+
+    def setUp(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+
+        self.user = User.signup('ider', 'ider@test.com', 'password', None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_new_messages_are_time_ordered(self):
+        """Each insert gets its own timestamp and a later id"""
+
+        first = Message(text='first', user_id=self.user.id)
+        db.session.add(first)
+        db.session.commit()
+        time.sleep(0.01)
+        second = Message(text='second', user_id=self.user.id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreater(second.timestamp, first.timestamp)
+        self.assertEqual([m.text for m in
+                          Message.query.order_by(Message.id.desc())],
+                         ['second', 'first'])
@@ -0,0 +1,65 @@
+"""Template precompilation tests."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from app import create_app
+from config import TestConfig
+
+
+class TemplatingTestCase(TestCase):
+    """Tests for the bytecode cache and precompile command"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_app(self, **settings):
+        config = type('TemplateConfig', (TestConfig,),
+                      dict(TEMPLATE_BYTECODE_CACHE=True,
+                           TEMPLATE_CACHE_DIR=self.dir, **settings))
+        return create_app(config)
+
+    def test_precompile_command_fills_cache(self):
+        """Every template should get a bytecode cache entry"""
+
+        app = self.make_app()
+        result = app.test_cli_runner().invoke(args=['precompile-templates'])
+
+        count = len(app.jinja_env.list_templates())
+        self.assertIn(f"Compiled {count} templates.", result.output)
+        self.assertEqual(len(os.listdir(self.dir)), count)
+
+    def test_warm_start_loads_from_cache(self):
+        """A warmed app should load templates from the shared cache"""
+
+        self.make_app(TEMPLATE_WARM=True)
+        self.assertTrue(os.listdir(self.dir))
+
+        app = self.make_app()
+        loaded = []
+        cache = app.jinja_env.bytecode_cache
+        load_bytecode = cache.load_bytecode
+
+        def spy(bucket):
+            load_bytecode(bucket)
+            loaded.append(bucket.code is not None)
+
+        cache.load_bytecode = spy
+        app.jinja_env.get_template('home.html')
+
+        self.assertTrue(loaded and all(loaded))
+
+    def test_refuses_shared_directory(self):
+        """A cache directory others can write to is refused"""
+
+        os.chmod(self.dir, 0o777)
+        with self.assertRaises(RuntimeError):
+            self.make_app()
+
+        os.chmod(self.dir, 0o700)
+        self.make_app()
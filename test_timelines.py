@@ -0,0 +1,166 @@
+"""Recent-message buffer tests."""
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+from app import create_app
+from cache import cache
+from timelines import (RecentMessages, HighWaterMarks, high_water_marks,
+                       recent_messages)
+from trending import trending
+
+app = create_app('test')
+
+db.create_all()
+
+
+class RecentMessagesTestCase(TestCase):
+    """Tests for RecentMessages"""
+
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.u1 = User(email="test1@test.com", username="testuser1",
+                       password="HASHED_PASSWORD")
+        self.u2 = User(email="test2@test.com", username="testuser2",
+                       password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        for i in range(6):
+            author = self.u1 if i % 2 == 0 else self.u2
+            db.session.add(Message(text=f"msg{i}", user_id=author.id,
+                                   timestamp=start + timedelta(minutes=i)))
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_timeline_merges_authors_newest_first(self):
+        """Timeline should interleave authors by timestamp"""
+
+        recent = RecentMessages(size=10)
+        messages = recent.timeline([self.u1_id, self.u2_id])
+
+        self.assertEqual([m.text for m in messages],
+                         ["msg5", "msg4", "msg3", "msg2", "msg1", "msg0"])
+
+    def test_timeline_respects_limit_and_buffer_size(self):
+        """Buffers hold at most `size` messages per author"""
+
+        recent = RecentMessages(size=2)
+        buffers = recent.get([self.u1_id])
+        self.assertEqual(len(buffers[self.u1_id]), 2)
+
+        messages = recent.timeline([self.u1_id, self.u2_id], limit=3)
+        self.assertEqual([m.text for m in messages], ["msg5", "msg4", "msg3"])
+
+    def test_invalidate(self):
+        """A buffer is only re-read after it has been invalidated"""
+
+        recent = RecentMessages(size=10)
+        recent.get([self.u1_id])
+
+        db.session.add(Message(text="new", user_id=self.u1_id,
+                               timestamp=datetime(2021, 1, 1)))
+        db.session.commit()
+
+        self.assertEqual(recent.timeline([self.u1_id], limit=1)[0].text, "msg4")
+
+        recent.invalidate(self.u1_id)
+        self.assertEqual(recent.timeline([self.u1_id], limit=1)[0].text, "new")
+
+    def test_unknown_author(self):
+        """Authors without messages give an empty timeline"""
+
+        recent = RecentMessages()
+        self.assertEqual(recent.timeline([99999]), [])
+
+    def test_buffers_are_bounded(self):
+        """Past max_entries the least recently used buffer goes"""
+
+        recent = RecentMessages(max_entries=2)
+        recent.get([self.u1_id, 99999])
+        recent.get([self.u1_id])
+        recent.get([self.u2_id])
+
+        self.assertEqual(list(recent.buffers), [self.u1_id, self.u2_id])
+
+
+class HighWaterMarksTestCase(TestCase):
+    """Tests for HighWaterMarks"""
+
+    def test_bump_raises_watching_users_only(self):
+        """A post raises the marks of users following its author"""
+
+        marks = HighWaterMarks()
+        marks.set(1, [1, 2], 10)
+        marks.set(3, [3], 5)
+
+        marks.bump(2, 12)
+        marks.bump(2, 11)
+
+        self.assertEqual(marks.get(1), 12)
+        self.assertEqual(marks.get(3), 5)
+
+    def test_forget_and_expiry(self):
+        """Forgotten or stale marks must be recomputed"""
+
+        marks = HighWaterMarks(max_age=0)
+        marks.set(1, [2], 10)
+        self.assertIsNone(marks.get(1))
+
+        marks = HighWaterMarks()
+        marks.set(1, [2], 10)
+        marks.forget(1)
+        self.assertIsNone(marks.get(1))
+        self.assertEqual(marks.watchers, {})
+
+    def test_marks_are_bounded(self):
+        """Old and expired marks are dropped with their watchers"""
+
+        marks = HighWaterMarks(max_entries=2)
+        marks.set(1, [10], 1)
+        marks.set(2, [20], 2)
+        marks.set(3, [30], 3)
+
+        self.assertEqual(list(marks.marks), [2, 3])
+        self.assertNotIn(10, marks.watchers)
+
+        marks.max_age = 0
+        marks.set(4, [40], 4)
+        self.assertEqual(list(marks.marks), [4])
+        self.assertEqual(set(marks.watchers), {40})
+
+
+class PerAppStateTestCase(TestCase):
+    """Tests for state kept per app rather than per process"""
+
+    def test_apps_do_not_share_state(self):
+        """Each app reads and writes its own buffers, marks, trackers and cache"""
+
+        other = create_app('test')
+
+        with app.app_context():
+            high_water_marks.set(1, [2], 10)
+            cache.set('users', 1, 'first app')
+            mine = (recent_messages._get_current_object(),
+                    trending._get_current_object())
+
+        with other.app_context():
+            self.assertIsNone(high_water_marks.get(1))
+            self.assertIsNone(cache.get('users', 1))
+            self.assertNotIn(recent_messages._get_current_object(), mine)
+            self.assertNotIn(trending._get_current_object(), mine)
+
+        with app.app_context():
+            self.assertEqual(high_water_marks.get(1), 10)
+            self.assertEqual(cache.get('users', 1), 'first app')
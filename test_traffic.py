@@ -0,0 +1,113 @@
+"""Traffic recording and replay tests."""
+
+import glob
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from werkzeug.serving import make_server
+
+from models import db, User, Message
+from app import create_app
+from config import TestConfig
+from traffic import (Replayer, Result, Trace, format_trace, login_cookies,
+                     parse_trace, percentile, read_traces, summarize)
+
+TRAFFIC_DIR = tempfile.mkdtemp()
+
+app = create_app(type('TrafficConfig', (TestConfig,),
+                      dict(TRAFFIC_DIR=TRAFFIC_DIR)))
+
+db.create_all()
+
+
+def tearDownModule():
+    shutil.rmtree(TRAFFIC_DIR)
+
+
+class ReportTestCase(TestCase):
+    """Tests for trace lines and reports"""
+
+    def test_trace_round_trip(self):
+        """A trace survives its line format"""
+
+        trace = Trace(1500000000000, 'POST', 'warbler.messages_add',
+                      '/messages/new', 42, 302, 1234, 'text=hi+there')
+        self.assertEqual(parse_trace(format_trace(trace)), trace)
+
+        anon = trace._replace(user_id=None, body=None)
+        self.assertEqual(parse_trace(format_trace(anon)), anon)
+
+    def test_percentile(self):
+        """Nearest-rank percentiles"""
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summarize(self):
+        """Rows per route plus a total, counting 5xx and failures as errors"""
+
+        results = [Result('a', 200, 0.01), Result('a', 500, 0.03),
+                   Result('b', 404, 0.02), Result('b', 0, 0.5)]
+        rows = {row['route']: row for row in summarize(results, 2.0)}
+
+        self.assertEqual(rows['a']['requests'], 2)
+        self.assertEqual(rows['a']['error_rate'], 0.5)
+        self.assertEqual(rows['b']['client_errors'], 1)
+        self.assertEqual(rows['ALL']['rps'], 2.0)
+        self.assertEqual(rows['ALL']['p99'], 0.5)
+
+
+class RecordReplayTestCase(TestCase):
+    """Tests for recording requests and replaying them over HTTP"""
+
+    def setUp(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        for path in glob.glob(os.path.join(TRAFFIC_DIR, '*.tsv')):
+            os.remove(path)
+
+        self.user = User.signup('replayer', 'replayer@test.com', 'password', None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_record_and_replay(self):
+        """Recorded requests replay as the same user, without passwords"""
+
+        with app.test_client() as c:
+            c.post('/login', data={'username': 'replayer', 'password': 'password'})
+            c.post('/messages/new', data={'text': 'recorded'})
+            c.get(f'/users/{self.user_id}')
+
+        traces = read_traces(glob.glob(os.path.join(TRAFFIC_DIR, '*.tsv')))
+        self.assertEqual([t.endpoint for t in traces],
+                         ['warbler.login', 'warbler.messages_add',
+                          'warbler.users_show'])
+        self.assertEqual(traces[0].body, 'username=replayer')
+        self.assertEqual(traces[1].user_id, self.user_id)
+        self.assertEqual(traces[1].status, 302)
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            replayer = Replayer(f'http://127.0.0.1:{server.server_port}',
+                                login_cookies(app), concurrency=2, speedup=0)
+            replayer.run(traces[1:])
+        finally:
+            server.shutdown()
+
+        statuses = {r.endpoint: r.status for r in replayer.results}
+        self.assertEqual(statuses, {'warbler.messages_add': 302,
+                                    'warbler.users_show': 200})
+        self.assertEqual(Message.query.filter_by(text='recorded').count(), 2)
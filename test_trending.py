@@ -0,0 +1,151 @@
+"""Trending tracker tests."""
+
+from unittest import TestCase
+
+from models import db, User, Message, TrendingSnapshot
+
+from app import create_app
+from outbox import Event
+from projections import update_trending
+from trending import CountMinSketch, DecayedTopK, Trending, trending
+
+app = create_app('test')
+
+db.create_all()
+
+
+class CountMinSketchTestCase(TestCase):
+    """Tests for CountMinSketch"""
+
+    def test_estimate_never_undercounts(self):
+        """Estimates should be at least the true count, even when crowded"""
+
+        sketch = CountMinSketch(width=16, depth=3)
+        for key in range(100):
+            for _ in range(key % 5):
+                sketch.add(key)
+
+        for key in range(100):
+            self.assertGreaterEqual(sketch.estimate(key), key % 5)
+
+
+class DecayedTopKTestCase(TestCase):
+    """Tests for DecayedTopK"""
+
+    def test_top_keeps_heaviest_keys(self):
+        """Only the k heaviest keys should be kept, highest first"""
+
+        top = DecayedTopK(k=3, half_life=100, now=0)
+        for key, count in [(1, 5), (2, 1), (3, 7), (4, 3), (5, 2)]:
+            for _ in range(count):
+                top.add(key, now=0)
+
+        self.assertEqual([key for key, score in top.top(now=0)], [3, 1, 4])
+        self.assertEqual(top.top(1, now=0), [(3, 7.0)])
+
+    def test_scores_decay_over_time(self):
+        """A score should halve every half-life"""
+
+        top = DecayedTopK(k=3, half_life=100, now=0)
+        top.add(1, 8, now=0)
+
+        self.assertAlmostEqual(top.top(now=100)[0][1], 4.0)
+        self.assertAlmostEqual(top.top(now=300)[0][1], 1.0)
+
+    def test_recent_events_outrank_old_ones(self):
+        """Fresh activity should beat older, larger activity"""
+
+        top = DecayedTopK(k=3, half_life=100, now=0)
+        top.add(1, 4, now=0)
+        top.add(2, 2, now=200)
+
+        self.assertEqual([key for key, score in top.top(now=200)], [2, 1])
+
+    def test_remove_takes_back_events(self):
+        """Adding and removing over and over should never build a score"""
+
+        top = DecayedTopK(k=3, half_life=100, now=0)
+        top.add(1, now=0)
+        for now in range(1, 200):
+            top.add(2, now=now)
+            top.remove(2, now=now)
+        top.remove(3, now=200)
+
+        scores = dict(top.top(now=200))
+        self.assertAlmostEqual(scores[1], 0.25)
+        self.assertAlmostEqual(scores[2], 0.0)
+        self.assertNotIn(3, scores)
+        self.assertGreaterEqual(top.sketch.estimate(1), 1.0)
+
+    def test_rescale_keeps_scores(self):
+        """Moving the landmark forward should not change decayed scores"""
+
+        top = DecayedTopK(k=3, half_life=1, now=0)
+        top.add(1, 1, now=0)
+        top.add(2, 1, now=50)
+
+        self.assertEqual(top.landmark, 50)
+        self.assertAlmostEqual(top.top(now=50)[0], (2, 1.0))
+
+
+class TrendingSnapshotTestCase(TestCase):
+    """Tests for saving and restoring trending snapshots"""
+
+    def setUp(self):
+        TrendingSnapshot.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+
+        m = Message(text="trending", user_id=u.id)
+        db.session.add(m)
+        db.session.commit()
+
+        self.u_id = u.id
+        self.m_id = m.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_snapshot_and_restore(self):
+        """A restarted tracker should come back with the saved top-K"""
+
+        t = Trending(half_life=100, now=1000)
+        t.record_like(self.m_id, self.u_id, now=1000)
+        t.record_message(self.u_id, now=1000)
+        t.snapshot(now=1000)
+
+        restored = Trending(half_life=100, now=1100)
+        restored.restore(now=1100)
+
+        self.assertEqual(restored.top_message_ids(), [self.m_id])
+        self.assertAlmostEqual(restored.trackers['author'].top(now=1100)[0][1], 1.0)
+
+        messages, authors = restored.panel()
+        self.assertEqual([m.text for m in messages], ["trending"])
+        self.assertEqual([u.username for u in authors], ["testuser"])
+
+
+class TrendingProjectionTestCase(TestCase):
+    """Tests for feeding trending from outbox events"""
+
+    def test_unlikes_take_likes_back(self):
+        """like.deleted cancels like.created; other kinds aren't posts"""
+
+        like = dict(message_id=7, author_id=3)
+        with app.app_context():
+            trending.reset()
+            update_trending([Event(1, 'like.created', 5, like, None),
+                             Event(2, 'like.deleted', 5, like, None),
+                             Event(3, 'like.created', 5, like, None),
+                             Event(4, 'like.deleted', 5, like, None),
+                             Event(5, 'message.deleted', 3, {}, None)])
+            scores = dict(trending.trackers['message'].top())
+            authors = dict(trending.trackers['author'].top())
+
+        self.assertAlmostEqual(scores[7], 0.0, places=3)
+        self.assertAlmostEqual(authors[3], 0.0, places=3)
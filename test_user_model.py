@@ -5,22 +5,16 @@
 #    python -m unittest test_user_model.py
 
 
-import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 from models import db, User, Message, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# The 'test' profile uses a separate database (TEST_DATABASE_URL,
+# default postgresql:///warbler-test) and turns off CSRF.
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from app import create_app
 
-
-# Now we can import app
-
-from app import app
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
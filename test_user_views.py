@@ -1,19 +1,17 @@
 """User View tests."""
 
-import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows
+from sqlalchemy import event
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from models import db, connect_db, Message, User, Follows
 
+from app import create_app, load_profile, CURR_USER_KEY
 
-from app import app, CURR_USER_KEY
+app = create_app('test')
 
 db.create_all()
 
-app.config['WTF_CSRF_ENABLED'] = False
-
 
 class UserViewTestCase(TestCase):
     """Test views for User."""
@@ -269,14 +267,49 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn('Access unauthorized', html)
 
+    def test_list_users_follows_in_one_query(self):
+        """The user list looks up who you follow once, not per card"""
 
+        for i in range(3):
+            User.signup(f"stranger{i}", f"stranger{i}@test.com", "password", None)
+        db.session.commit()
 
+        statements = []
 
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
 
+        engine = db.get_engine(app)
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.t1_id
 
+            event.listen(engine, 'before_cursor_execute', record)
+            try:
+                resp = c.get("/users")
+            finally:
+                event.remove(engine, 'before_cursor_execute', record)
+            html = resp.get_data(as_text=True)
 
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(html.count('Unfollow'), 1)
+        self.assertEqual(html.count('>Follow<'), 4)
+        self.assertEqual(len([s for s in statements if 'FROM follows' in s]), 1)
 
+    def test_profile_shares_only_plain_rows(self):
+        """Profiles coalesce rows, not model instances tied to one session"""
 
+        db.session.add(Message(text="shared warble", user_id=self.t1_id))
+        db.session.commit()
 
+        with app.app_context():
+            likes, messages, stats = load_profile(self.t1_id)
+        self.assertFalse(any(isinstance(msg, Message) for msg in messages))
+        self.assertEqual([msg.text for msg in messages], ["shared warble"])
+        self.assertEqual(stats.messages, 1)
 
-    
\ No newline at end of file
+        with app.test_client() as c:
+            resp = c.get(f"/users/{self.t1_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("shared warble", resp.get_data(as_text=True))
+            self.assertEqual(c.get("/users/0").status_code, 404)
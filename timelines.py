@@ -0,0 +1,194 @@
+"""Per-author recent-message buffers for building home timelines.
+
+Each app keeps, per author, a bounded buffer of their most recent
+message ids (which are time-ordered, see snowflake.py). A timeline is a
+k-way merge of the followed authors' buffers; only the message rows
+that make the cut are then loaded, in a single query.
+
+Buffers are warmed on demand (all cold authors in one query) and
+dropped when the author posts or deletes a message here. Other
+processes can't tell us about their writes, so buffers also expire
+after MAX_AGE seconds. Buffers and high-water marks are kept for at
+most MAX_ENTRIES authors and users each, least recently used going
+first, and expired ones are swept as new ones come in.
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+from sqlalchemy import func
+
+from extensions import app_local
+from models import db, Message
+from readmodels import message_rows
+
+BUFFER_SIZE = 100
+MAX_AGE = 30
+MAX_ENTRIES = 10000
+
+
+class RecentMessages:
+    """Bounded newest-first message id buffers keyed by author."""
+
+    def __init__(self, size=BUFFER_SIZE, max_age=MAX_AGE, max_entries=MAX_ENTRIES):
+        self.size = size
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.buffers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def invalidate(self, author_id):
+        """Forget `author_id`'s buffer; it is re-read on next use."""
+
+        with self.lock:
+            self.buffers.pop(author_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.buffers.clear()
+
+    def get(self, author_ids):
+        """Return {author_id: [id, ...]} newest first."""
+
+        now = time.time()
+        found = {}
+        cold = []
+
+        with self.lock:
+            for author_id in author_ids:
+                entry = self.buffers.get(author_id)
+                if entry and now - entry[0] < self.max_age:
+                    self.buffers.move_to_end(author_id)
+                    found[author_id] = entry[1]
+                else:
+                    cold.append(author_id)
+
+        if cold:
+            warmed = self._load(cold)
+            with self.lock:
+                for author_id in cold:
+                    buffer = warmed.get(author_id, [])
+                    self.buffers[author_id] = (now, buffer)
+                    self.buffers.move_to_end(author_id)
+                    found[author_id] = buffer
+                _trim(self.buffers, self.max_entries, now - self.max_age,
+                      lambda: self.buffers.popitem(last=False))
+
+        return found
+
+    def _load(self, author_ids):
+        """Read the newest `size` messages of each author in one query."""
+
+        rank = (func.row_number()
+                .over(partition_by=Message.user_id,
+                      order_by=Message.id.desc())
+                .label('rank'))
+        ranked = (db.session
+                  .query(Message.user_id, Message.id, rank)
+                  .filter(Message.user_id.in_(author_ids))
+                  .subquery())
+        rows = (db.session
+                .query(ranked.c.user_id, ranked.c.id)
+                .filter(ranked.c.rank <= self.size)
+                .order_by(ranked.c.user_id, ranked.c.rank))
+
+        buffers = {}
+        for user_id, id in rows:
+            buffers.setdefault(user_id, []).append(id)
+        return buffers
+
+    def timeline_ids(self, author_ids, limit=BUFFER_SIZE):
+        """Return the newest `limit` message ids across `author_ids`."""
+
+        buffers = self.get(author_ids).values()
+        merged = heapq.merge(*buffers, reverse=True)
+        return list(islice(merged, limit))
+
+    def timeline(self, author_ids, limit=BUFFER_SIZE):
+        """Return the newest `limit` messages across `author_ids`.
+
+        Messages are MessageRows (see readmodels.py), not entities.
+        """
+
+        return message_rows(self.timeline_ids(author_ids, limit))
+
+
+class HighWaterMarks:
+    """Newest message id known to be in each user's home timeline.
+
+    Lets pollers asking "anything newer than X?" be answered from memory.
+    A mark is raised when a followed author posts in this process and
+    expires after `max_age` seconds so posts made through other
+    processes are picked up.
+    """
+
+    def __init__(self, max_age=MAX_AGE, max_entries=MAX_ENTRIES):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.marks = OrderedDict()
+        self.watchers = {}
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return `user_id`'s mark, or None if it must be recomputed."""
+
+        entry = self.marks.get(user_id)
+        if entry and time.time() - entry[0] < self.max_age:
+            return entry[1]
+        return None
+
+    def set(self, user_id, author_ids, newest_id):
+        """Record that nothing newer than `newest_id` from `author_ids` exists."""
+
+        now = time.time()
+        with self.lock:
+            self._unwatch(user_id)
+            self.marks[user_id] = (now, newest_id, author_ids)
+            for author_id in author_ids:
+                self.watchers.setdefault(author_id, set()).add(user_id)
+            # marks are in the order they were set, oldest first
+            _trim(self.marks, self.max_entries, now - self.max_age,
+                  lambda: self._unwatch(next(iter(self.marks))))
+
+    def bump(self, author_id, message_id):
+        """`author_id` just posted `message_id`."""
+
+        with self.lock:
+            for user_id in self.watchers.get(author_id, ()):
+                set_at, newest_id, author_ids = self.marks[user_id]
+                if message_id > newest_id:
+                    self.marks[user_id] = (set_at, message_id, author_ids)
+
+    def forget(self, user_id):
+        """Drop `user_id`'s mark, e.g. after they (un)follow someone."""
+
+        with self.lock:
+            self._unwatch(user_id)
+
+    def _unwatch(self, user_id):
+        entry = self.marks.pop(user_id, None)
+        if entry is None:
+            return
+        for author_id in entry[2]:
+            users = self.watchers.get(author_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self.watchers[author_id]
+
+
+def _trim(entries, max_entries, expired_before, evict_first):
+    """Evict the first of `entries` while over `max_entries` or expired."""
+
+    while entries:
+        set_at = next(iter(entries.values()))[0]
+        if len(entries) <= max_entries and set_at >= expired_before:
+            return
+        evict_first()
+
+
+recent_messages = app_local('recent_messages', RecentMessages())
+high_water_marks = app_local('high_water_marks', HighWaterMarks())
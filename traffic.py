@@ -0,0 +1,317 @@
+"""Record production-like traffic and replay it as a load test.
+
+With TRAFFIC_DIR set, every request (or a TRAFFIC_SAMPLE_RATE share
+of them) is appended to TRAFFIC_DIR/trace-<pid>.tsv, one line each:
+
+    <epoch ms> <method> <endpoint> <path?query> <user id|-> <status> <µs> <form|->
+
+tab-separated, after a "# warbler-trace 1" header. Form bodies are
+kept url-encoded, minus passwords and CSRF tokens.
+
+Replay the traces against a running instance, seeded the same way as
+the one that recorded them:
+
+    flask replay-traffic traces/*.tsv --url http://localhost:5000 \\
+        --concurrency 16 --speedup 4
+
+Requests go out in recorded order, spaced out by their recorded gaps
+divided by --speedup (0 sends as fast as the workers allow), each
+logged in as its recorded user with a session cookie signed with this
+app's SECRET_KEY. So the target needs the same SECRET_KEY, and for
+form posts WTF_CSRF_ENABLED off. The report gives throughput, p50, p95
+and p99 latency, and error rates per route. `flask traffic-report`
+reports on the recorded timings themselves.
+"""
+
+import http.client
+import json
+import math
+import os
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlencode, urlsplit
+
+import click
+from flask import g, request
+
+HEADER = '# warbler-trace 1\n'
+
+# form fields never written to a trace
+SECRET_FIELDS = frozenset({'password', 'csrf_token'})
+
+Trace = namedtuple('Trace', 'time method endpoint path user_id status micros body')
+
+Result = namedtuple('Result', 'endpoint status seconds')
+
+
+def format_trace(trace):
+    return '\t'.join([str(trace.time), trace.method, trace.endpoint, trace.path,
+                      str(trace.user_id) if trace.user_id is not None else '-',
+                      str(trace.status), str(trace.micros),
+                      trace.body or '-']) + '\n'
+
+
+def parse_trace(line):
+    (t, method, endpoint, path, user_id,
+     status, micros, body) = line.rstrip('\n').split('\t')
+    return Trace(int(t), method, endpoint, path,
+                 None if user_id == '-' else int(user_id),
+                 int(status), int(micros), None if body == '-' else body)
+
+
+def read_traces(paths):
+    """Every trace in `paths`, merged into time order."""
+
+    traces = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    traces.append(parse_trace(line))
+    traces.sort(key=lambda trace: trace.time)
+    return traces
+
+
+class Recorder:
+    """Appends a trace line per request to this process's trace file."""
+
+    def __init__(self, directory, sample_rate=1.0):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.file = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _file(self):
+        # reopened after a fork so workers never share a file
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'trace-{self.pid}.tsv')
+            new = not os.path.exists(path)
+            self.file = open(path, 'a', buffering=1)
+            if new:
+                self.file.write(HEADER)
+        return self.file
+
+    def before_request(self):
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            g._trace_start = (time.time(), time.perf_counter())
+
+    def record(self, status):
+        start = g.pop('_trace_start', None)
+        if start is None:
+            return
+
+        micros = int((time.perf_counter() - start[1]) * 1e6)
+        body = None
+        if request.method == 'POST' and request.form:
+            body = urlencode([(key, value)
+                              for key, value in request.form.items(multi=True)
+                              if key not in SECRET_FIELDS])
+        user = getattr(g, 'user', None)
+        trace = Trace(int(start[0] * 1000), request.method,
+                      request.endpoint or 'unknown',
+                      request.full_path.rstrip('?'),
+                      user.id if user is not None else None,
+                      status, micros, body)
+
+        with self.lock:
+            self._file().write(format_trace(trace))
+
+
+def percentile(values, p):
+    """The nearest-rank `p`th percentile of sorted `values`."""
+
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def summarize(results, elapsed):
+    """Per-route rows (plus an 'ALL' row) for a report.
+
+    Errors are 5xx responses and failed connections (status 0).
+    """
+
+    groups = {}
+    for result in results:
+        groups.setdefault(result.endpoint, []).append(result)
+
+    rows = []
+    for endpoint, group in sorted(groups.items()) + [('ALL', results)]:
+        seconds = sorted(r.seconds for r in group)
+        errors = sum(1 for r in group if r.status == 0 or r.status >= 500)
+        rows.append(dict(
+            route=endpoint,
+            requests=len(group),
+            rps=len(group) / elapsed if elapsed else None,
+            p50=percentile(seconds, 50),
+            p95=percentile(seconds, 95),
+            p99=percentile(seconds, 99),
+            client_errors=sum(1 for r in group if 400 <= r.status < 500),
+            errors=errors,
+            error_rate=errors / len(group) if group else 0.0,
+        ))
+    return rows
+
+
+def format_report(rows):
+    lines = ['{:<32} {:>8} {:>8} {:>9} {:>9} {:>9} {:>6} {:>7}'.format(
+        'route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', '4xx', 'err %')]
+    for row in rows:
+        ms = ['{:.1f}'.format(row[p] * 1000) if row[p] is not None else '-'
+              for p in ('p50', 'p95', 'p99')]
+        lines.append('{:<32} {:>8} {:>8} {:>9} {:>9} {:>9} {:>6} {:>7.2f}'.format(
+            row['route'][:32], row['requests'],
+            '{:.1f}'.format(row['rps']) if row['rps'] is not None else '-',
+            *ms, row['client_errors'], row['error_rate'] * 100))
+    return '\n'.join(lines)
+
+
+class Replayer:
+    """Sends traces to `url` from `concurrency` worker threads."""
+
+    def __init__(self, url, cookie_for, concurrency=8, speedup=1.0, timeout=30):
+        """`cookie_for(user_id)` gives the Cookie header logging them in."""
+
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.https = parts.scheme == 'https'
+        self.prefix = parts.path.rstrip('/')
+        self.cookie_for = cookie_for
+        self.concurrency = concurrency
+        self.speedup = speedup
+        self.timeout = timeout
+        self.results = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def _send(self, conn, trace):
+        headers = {}
+        if trace.user_id is not None:
+            headers['Cookie'] = self.cookie_for(trace.user_id)
+        if trace.body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(trace.method, self.prefix + trace.path,
+                     body=trace.body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+
+    def _work(self, jobs):
+        conn = self._connect()
+        while True:
+            trace = jobs.get()
+            if trace is None:
+                return
+            start = time.perf_counter()
+            try:
+                status = self._send(conn, trace)
+            except (OSError, http.client.HTTPException):
+                status = 0
+                conn.close()
+                conn = self._connect()
+            result = Result(trace.endpoint, status, time.perf_counter() - start)
+            with self.lock:
+                self.results.append(result)
+
+    def run(self, traces):
+        """Replay `traces`; returns the wall-clock seconds taken."""
+
+        jobs = queue.Queue(maxsize=self.concurrency * 4)
+        workers = [threading.Thread(target=self._work, args=(jobs,), daemon=True)
+                   for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+
+        started = time.perf_counter()
+        first = traces[0].time if traces else 0
+        for trace in traces:
+            if self.speedup:
+                delay = (trace.time - first) / 1000 / self.speedup
+                wait = started + delay - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            jobs.put(trace)
+
+        for _ in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - started
+
+
+def login_cookies(app):
+    """A cookie_for(user_id) giving `app` session cookies that log users in."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = {}
+
+    def cookie_for(user_id):
+        if user_id not in cookies:
+            cookies[user_id] = '{}={}'.format(
+                app.session_cookie_name,
+                serializer.dumps({CURR_USER_KEY: user_id}))
+        return cookies[user_id]
+    return cookie_for
+
+
+def init_traffic(app):
+    """Record traffic if TRAFFIC_DIR is set, and add the replay commands."""
+
+    directory = app.config['TRAFFIC_DIR']
+    if directory:
+        recorder = Recorder(directory, app.config['TRAFFIC_SAMPLE_RATE'])
+        app.before_request(recorder.before_request)
+
+        @app.after_request
+        def record_traffic(response):
+            recorder.record(response.status_code)
+            return response
+
+        @app.teardown_request
+        def record_failed_traffic(exc):
+            if exc is not None:
+                recorder.record(500)
+
+        app.extensions['traffic'] = recorder
+
+    @app.cli.command('replay-traffic')
+    @click.argument('traces', nargs=-1, required=True, type=click.Path(exists=True))
+    @click.option('--url', default='http://localhost:5000', help="Where to send requests.")
+    @click.option('--concurrency', default=8, help="Requests in flight at once.")
+    @click.option('--speedup', default=1.0,
+                  help="Replay this many times faster than recorded; 0 for flat out.")
+    @click.option('--as-json', is_flag=True, help="Print the report as JSON.")
+    def replay_traffic(traces, url, concurrency, speedup, as_json):
+        """Replay recorded traces against a running instance."""
+
+        traces = read_traces(traces)
+        replayer = Replayer(url, login_cookies(app), concurrency, speedup)
+        elapsed = replayer.run(traces)
+        rows = summarize(replayer.results, elapsed)
+        click.echo(json.dumps(rows, indent=2) if as_json else format_report(rows))
+
+    @app.cli.command('traffic-report')
+    @click.argument('traces', nargs=-1, required=True, type=click.Path(exists=True))
+    def traffic_report(traces):
+        """Report on the timings recorded in traces."""
+
+        traces = read_traces(traces)
+        elapsed = (traces[-1].time - traces[0].time) / 1000 if traces else 0
+        click.echo(format_report(summarize(
+            [Result(t.endpoint, t.status, t.micros / 1e6) for t in traces],
+            elapsed)))
+
+    return app.extensions.get('traffic')
@@ -0,0 +1,273 @@
+"""Streaming "trending" counts for Warbler.
+
+Trending messages and hot authors are computed from like and
+message-creation events as they happen, instead of running a
+``GROUP BY`` over the whole likes table. An unlike takes a like back
+at the weight a like would have now, so liking and unliking over and
+over never adds up.
+
+Each tracker keeps a count-min sketch of exponentially time-decayed
+counts plus a bounded top-K candidate set. Decay uses a forward
+"landmark": an event at time t is added with weight 2**((t - landmark) /
+half_life), so old events never need to be touched; scores are scaled
+back down when read. The top-K is snapshotted to the database every so
+often so a restarted process starts warm. Each app has its own
+trackers (see extensions.py).
+"""
+
+import heapq
+import threading
+import time
+from datetime import datetime
+
+from extensions import app_local
+from models import db, TrendingSnapshot
+from readmodels import author_rows, message_rows
+
+HALF_LIFE = 6 * 60 * 60
+TOP_K = 20
+SNAPSHOT_INTERVAL = 5 * 60
+
+# rescale everything once forward-decayed weights reach 2**MAX_EXPONENT
+MAX_EXPONENT = 40
+
+
+class CountMinSketch:
+    """Fixed-size approximate counter (never under-counts)."""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0.0] * width for _ in range(depth)]
+
+    def _cells(self, key):
+        return [hash((row, key)) % self.width for row in range(self.depth)]
+
+    def add(self, key, amount=1.0):
+        """Add `amount` to `key` and return the new estimate for it."""
+
+        estimate = None
+        for row, cell in zip(self.rows, self._cells(key)):
+            row[cell] += amount
+            if estimate is None or row[cell] < estimate:
+                estimate = row[cell]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(key)))
+
+    def scale(self, factor):
+        for row in self.rows:
+            for i in range(self.width):
+                row[i] *= factor
+
+
+class DecayedTopK:
+    """Top-K keys by exponentially time-decayed count."""
+
+    def __init__(self, k=TOP_K, half_life=HALF_LIFE, width=2048, depth=4,
+                 now=None):
+        self.k = k
+        self.half_life = half_life
+        self.landmark = time.time() if now is None else now
+        self.sketch = CountMinSketch(width, depth)
+        self.scores = {}
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def _exponent(self, now):
+        return (now - self.landmark) / self.half_life
+
+    def _rescale(self, now):
+        """Move the landmark up to `now` so weights stay small."""
+
+        factor = 2.0 ** -self._exponent(now)
+        self.sketch.scale(factor)
+        self.scores = {key: score * factor
+                       for key, score in self.scores.items()}
+        self._rebuild_heap()
+        self.landmark = now
+
+    def _rebuild_heap(self):
+        self.heap = [(score, key) for key, score in self.scores.items()]
+        heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        """Drop and return the lowest-scoring live candidate."""
+
+        while self.heap:
+            score, key = heapq.heappop(self.heap)
+            if self.scores.get(key) == score:
+                del self.scores[key]
+                return score
+        return None
+
+    def _peek_min(self):
+        while self.heap:
+            score, key = self.heap[0]
+            if self.scores.get(key) == score:
+                return score
+            heapq.heappop(self.heap)
+        return None
+
+    def _weight(self, now):
+        if self._exponent(now) > MAX_EXPONENT:
+            self._rescale(now)
+        return 2.0 ** self._exponent(now)
+
+    def add(self, key, amount=1.0, now=None):
+        """Record `amount` events for `key` at time `now`."""
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            estimate = self.sketch.add(key, amount * self._weight(now))
+
+            if key not in self.scores and len(self.scores) >= self.k:
+                if estimate <= self._peek_min():
+                    return
+                self._pop_min()
+
+            self.scores[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+
+            # superseded heap entries are left behind lazily; compact them
+            if len(self.heap) > 4 * self.k:
+                self._rebuild_heap()
+
+    def remove(self, key, amount=1.0, now=None):
+        """Take back `amount` events for `key`, weighted as at time `now`.
+
+        Never more than `key`'s estimate, so no cell goes below zero.
+        """
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            weight = self._weight(now)
+            taken = min(amount * weight, self.sketch.estimate(key))
+            estimate = self.sketch.add(key, -taken)
+            if key in self.scores:
+                self.scores[key] = estimate
+                heapq.heappush(self.heap, (estimate, key))
+
+    def top(self, n=None, now=None):
+        """Return [(key, score), ...] highest first, decayed to `now`."""
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            decay = 2.0 ** -self._exponent(now)
+            items = list(self.scores.items())
+
+        items.sort(key=lambda item: item[1], reverse=True)
+        return [(key, score * decay) for key, score in items[:n or self.k]]
+
+    def seed(self, key, score, now=None):
+        """Restore `key` with a `score` that was current at time `now`."""
+
+        now = time.time() if now is None else now
+        self.add(key, score, now=now)
+
+
+class Trending:
+    """Trending messages and hot authors for this process."""
+
+    def __init__(self, k=TOP_K, half_life=HALF_LIFE,
+                 snapshot_interval=SNAPSHOT_INTERVAL, now=None):
+        self.k = k
+        self.half_life = half_life
+        self.snapshot_interval = snapshot_interval
+        self.trackers = {}
+        self.last_snapshot = None
+        self.lock = threading.Lock()
+        self.reset(now)
+
+    def reset(self, now=None):
+        self.trackers = {
+            'message': DecayedTopK(self.k, self.half_life, now=now),
+            'author': DecayedTopK(self.k, self.half_life, now=now),
+        }
+        self.last_snapshot = None
+
+    def record_like(self, message_id, author_id, now=None):
+        """A message by `author_id` was liked."""
+
+        self.trackers['message'].add(message_id, now=now)
+        self.trackers['author'].add(author_id, now=now)
+        self.maybe_snapshot(now)
+
+    def record_unlike(self, message_id, author_id, now=None):
+        """A like of a message by `author_id` was taken back."""
+
+        self.trackers['message'].remove(message_id, now=now)
+        if author_id is not None:
+            self.trackers['author'].remove(author_id, now=now)
+        self.maybe_snapshot(now)
+
+    def record_message(self, author_id, now=None):
+        """`author_id` posted a new message."""
+
+        self.trackers['author'].add(author_id, now=now)
+        self.maybe_snapshot(now)
+
+    def top_message_ids(self, n=None):
+        return [key for key, score in self.trackers['message'].top(n)]
+
+    def top_author_ids(self, n=None):
+        return [key for key, score in self.trackers['author'].top(n)]
+
+    def panel(self, n=5):
+        """Return (messages, authors) for the trending panel.
+
+        Reads only the top-K candidates and loads them as read-model
+        rows with one query per kind.
+        """
+
+        return (message_rows(self.top_message_ids(n)),
+                author_rows(self.top_author_ids(n)))
+
+    def maybe_snapshot(self, now=None):
+        now = time.time() if now is None else now
+
+        with self.lock:
+            if self.last_snapshot is None:
+                self.last_snapshot = now
+                return
+            if now - self.last_snapshot < self.snapshot_interval:
+                return
+            self.last_snapshot = now
+
+        self.snapshot(now)
+
+    def snapshot(self, now=None):
+        """Replace the stored snapshot with the current top-K."""
+
+        now = time.time() if now is None else now
+        taken_at = datetime.utcfromtimestamp(now)
+        rows = [dict(kind=kind, key=key, score=score, taken_at=taken_at)
+                for kind, tracker in self.trackers.items()
+                for key, score in tracker.top(now=now)]
+
+        table = TrendingSnapshot.__table__
+        with db.engine.begin() as conn:
+            conn.execute(table.delete())
+            if rows:
+                conn.execute(table.insert(), rows)
+
+    def restore(self, now=None):
+        """Warm the trackers from the last stored snapshot."""
+
+        now = time.time() if now is None else now
+
+        for snap in TrendingSnapshot.query.all():
+            tracker = self.trackers.get(snap.kind)
+            if tracker is None:
+                continue
+            age = now - (snap.taken_at - datetime(1970, 1, 1)).total_seconds()
+            tracker.seed(snap.key, snap.score * 2.0 ** (-age / tracker.half_life),
+                         now=now)
+        self.last_snapshot = now
+
+
+trending = app_local('trending', Trending())